@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from etd import etd
+from etd import sketch
 import os
 import sys
 import argparse
@@ -53,14 +54,42 @@ if __name__ == '__main__':
                         type=lambda x: is_valid_file(parser, x),
                         required=True,
                         help="assembled bacterial contigs in fasta format")
+    subparser_run.add_argument('--cohort', action='store_true', default=False,
+                        help="Run on a cohort of genomes: --input_genome is "
+                             "a directory of fastas or a file listing one "
+                             "genome path per line")
     subparser_run.add_argument('-d', '--database_dir', type=str, required=True,
                         help="ETD/CARD prevalence database directory")
     subparser_run.add_argument('-o', '--output_dir', default=False,
                         help="Output directory path")
     subparser_run.add_argument('-x', '--mash_distance', default=0.01, type=float,
                         help="Maximum mash distance to retain")
+    subparser_run.add_argument('--containment', action='store_true',
+                        default=False,
+                        help="Rank relatives by how much of the input genome "
+                             "they contain (like mash screen) instead of mash "
+                             "distance, for plasmids or partial assemblies. "
+                             "--mash_distance then bounds one minus the "
+                             "screen identity")
     subparser_run.add_argument('-j', '--num_threads', default=1, type=int,
                         help="Number of threads to use")
+    subparser_run.add_argument('--rgi_cache', default=None,
+                        help="Directory of a persistent RGI result cache "
+                             "shared between runs (default: no caching)")
+    subparser_run.add_argument('--rgi_cache_size', default=10, type=float,
+                        help="Maximum size of the RGI result cache in GB")
+    subparser_run.add_argument('--rgi_shards', default=1, type=int,
+                        help="Split the contigs into this many length-balanced "
+                             "shards and run RGI on them in parallel (results "
+                             "may differ slightly from a single RGI run)")
+    subparser_run.add_argument('--card_json', default=None,
+                        type=lambda x: is_valid_file(parser, x),
+                        help="CARD's card.json, to score how novel each ARG "
+                             "unique to the isolate is within its gene family "
+                             "(default: not scored)")
+    subparser_run.add_argument('--card_cache', default=None,
+                        help="Directory to keep the compiled card.json in so "
+                             "it is only parsed once per CARD version")
     subparser_run.add_argument('--debug', action='store_true', default=False,
                         help="Run in debug mode")
     subparser_run.add_argument('--verbose', action='store_true', default=False,
@@ -73,6 +102,12 @@ if __name__ == '__main__':
                                           description="Format and build \
                                                   database files needed for \
                                                   run execution")
+    subparser_db.add_argument('mode', nargs='?', default='build',
+                            choices=['build', 'add'],
+                            help="build (or update) the database from the "
+                                 "CARD prevalence tarballs, or add genomes "
+                                 "to a taxa of a built database "
+                                 "(default: build)")
     subparser_db.add_argument('-v', '--version', action='version',
                         version=f"%(prog)s {etd.__version__}")
     subparser_db.add_argument('--verbose', action='store_true', default=False,
@@ -83,6 +118,32 @@ if __name__ == '__main__':
                             help='Number of threads to use')
     subparser_db.add_argument('--force', default=False,
                             help='Force rebuild database')
+    subparser_db.add_argument('--stream', action='store_true', default=False,
+                            help='Sketch and index genomes and RGI results '
+                                 'straight from the tarballs without '
+                                 'extracting them to disk')
+    subparser_db.add_argument('--collapse_distance', type=float,
+                            default=sketch.COLLAPSE_DISTANCE,
+                            help='Collapse genomes closer than this mash '
+                                 'distance into near-duplicate clusters '
+                                 'whose leaders are searched first and '
+                                 'joined into the genome trees (0 to only '
+                                 'collapse identical sketches)')
+    subparser_db.add_argument('--verify', action='store_true', default=False,
+                            help='Check the database bundle of an up to date '
+                                 'database against its checksums and rewrite '
+                                 'it if corrupt (bundles are always checked '
+                                 'when written)')
+    subparser_db.add_argument('--taxa', default=None,
+                            help='add: taxa to add the genomes to '
+                                 '(e.g. Salmonella_enterica_FASTA)')
+    subparser_db.add_argument('-i', '--input_genomes', default=None,
+                            help='add: directory of genome fastas or a file '
+                                 'listing one genome path per line, named '
+                                 '<accession>.fa')
+    subparser_db.add_argument('--rgi_results', default=None,
+                            help='add: directory of the RGI results '
+                                 '(<accession>.json and .txt) of the genomes')
 
 
 
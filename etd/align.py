@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+# residues of the substitution matrices, anything else is scored as X
+ALPHABET = 'ARNDCQEGHILKMFPSTWYVBZX*'
+ENCODING = np.full(256, ALPHABET.index('X'), dtype=np.int64)
+for ix, residue in enumerate(ALPHABET):
+    ENCODING[ord(residue)] = ix
+    ENCODING[ord(residue.lower())] = ix
+PAD = len(ALPHABET)
+
+# BLAST's default gap penalties for BLOSUM62
+GAP_OPEN = 11
+GAP_EXTEND = 1
+
+# pairs aligned at once
+PAIR_BLOCK = 256
+
+# score of padding past the end of a sequence (and of impossible states),
+# low enough to never be part of an alignment but far from int32 overflow
+NEG_SCORE = -(1 << 20)
+
+
+def substitution_array(matrix):
+    """
+    Substitution scores as an array indexed by ALPHABET position, with a
+    last row and column for padding
+
+    Parameters:
+        matrix: substitution matrix, either a Bio.Align.substitution_matrices
+                Array or a Bio.SubsMat.MatrixInfo {(a, b): score} dict of
+                one triangle of the matrix
+    Returns:
+        scores: (np.array) int32 (len(ALPHABET) + 1)^2 scores
+    """
+    scores = np.full((PAD + 1, PAD + 1), NEG_SCORE, dtype=np.int32)
+    missing = []
+    for i, a in enumerate(ALPHABET):
+        for j, b in enumerate(ALPHABET):
+            if isinstance(matrix, dict):
+                score = matrix.get((a, b), matrix.get((b, a)))
+            else:
+                score = matrix[a, b] if a in matrix.alphabet \
+                        and b in matrix.alphabet else None
+            if score is None:
+                missing.append((i, j))
+            else:
+                scores[i, j] = score
+    # residues the matrix lacks (e.g. stops) score as its worst substitution
+    lowest = scores[:PAD, :PAD][scores[:PAD, :PAD] > NEG_SCORE].min()
+    for i, j in missing:
+        scores[i, j] = lowest
+    return scores
+
+
+def encode(sequences):
+    """
+    Protein sequences as a padded array of ALPHABET positions
+
+    Returns:
+        encoded: (np.array) len(sequences) x longest sequence
+    """
+    length = max([len(sequence) for sequence in sequences] + [1])
+    encoded = np.full((len(sequences), length), PAD, dtype=np.int64)
+    for row, sequence in enumerate(sequences):
+        residues = np.frombuffer(sequence.encode(), dtype=np.uint8)
+        encoded[row, :len(residues)] = ENCODING[residues]
+    return encoded
+
+
+def align_block(queries, references, scores, gap_open, gap_extend):
+    """
+    Smith-Waterman scores of a block of pairs, filled one query residue (row)
+    at a time for every pair and reference residue at once
+
+    Vertical gaps and matches only depend on the previous row.  The best
+    horizontal gap into each cell (Gotoh's E) is a running maximum along the
+    row of the cells without horizontal gaps, which is exact as long as
+    opening a gap costs at least as much as extending one.
+    """
+    query_residues = encode(queries)
+    reference_residues = encode(references)
+    n_pairs, n_columns = reference_residues.shape
+    # gap extension penalty accumulated up to each column
+    extension = np.arange(n_columns, dtype=np.int32) * gap_extend
+
+    H = np.zeros((n_pairs, n_columns), dtype=np.int32)
+    F = np.full((n_pairs, n_columns), NEG_SCORE, dtype=np.int32)
+    E = np.full((n_pairs, n_columns), NEG_SCORE, dtype=np.int32)
+    diagonal = np.zeros((n_pairs, n_columns), dtype=np.int32)
+    best = np.zeros(n_pairs, dtype=np.int32)
+    for row in range(query_residues.shape[1]):
+        diagonal[:, 1:] = H[:, :-1]
+        F = np.maximum(H - gap_open, F - gap_extend)
+        H = np.maximum(diagonal + scores[query_residues[:, row, None],
+                                         reference_residues], F)
+        np.maximum(H, 0, out=H)
+        # best gap from a cell to the left: max over k < j of
+        # H[k] - gap_open - (j - 1 - k) * gap_extend
+        running = np.maximum.accumulate(H + extension, axis=1)
+        E[:, 1:] = running[:, :-1] - gap_open - extension[:-1]
+        np.maximum(H, E, out=H)
+        np.maximum(best, H.max(axis=1), out=best)
+    return best
+
+
+def smith_waterman(queries, references, scores, gap_open=GAP_OPEN,
+                   gap_extend=GAP_EXTEND):
+    """
+    Local alignment scores (affine gaps) of many protein pairs at once
+
+    Pairs are sorted by length so each block of PAIR_BLOCK pairs is padded
+    to similar lengths and the block is aligned in one vectorised pass (see
+    align_block).
+
+    Parameters:
+        queries: (list) query protein sequences
+        references: (list) reference protein sequences, one per query
+        scores: (np.array) substitution scores (see substitution_array)
+        gap_open: (int) penalty of the first residue of a gap
+        gap_extend: (int) penalty of each further residue of a gap
+    Returns:
+        scores: (np.array) best local alignment score of each pair
+    """
+    if gap_open < gap_extend:
+        raise ValueError("Gap opening penalty must be at least the gap "
+                         "extension penalty")
+    best = np.zeros(len(queries), dtype=np.int64)
+    order = np.lexsort(([len(reference) for reference in references],
+                        [len(query) for query in queries]))
+    for block in range(0, len(order), PAIR_BLOCK):
+        pairs = order[block:block + PAIR_BLOCK]
+        best[pairs] = align_block([queries[pair] for pair in pairs],
+                                  [references[pair] for pair in pairs],
+                                  scores, gap_open, gap_extend)
+    return best
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import struct
+import hashlib
+import logging
+import functools
+import numpy as np
+
+from etd import sketch
+from etd import presence
+
+# single-file database written by `etd.py database` next to the index
+BUNDLE_NAME = 'etd_db.bundle'
+
+MAGIC = b'ETDBNDL\x00'
+VERSION = 1
+
+# magic, format version, header length and header SHA-256
+PREAMBLE = struct.Struct('<8sIQ32s')
+
+# sections start on page boundaries so arrays are memory-mapped in place
+ALIGNMENT = 4096
+
+
+def bundle_path(database_dir):
+    """
+    Path of the database bundle
+    """
+    return os.path.join(database_dir, 'etd_db', BUNDLE_NAME)
+
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def encode_section(value):
+    """
+    Header entry and buffer of a section value
+
+    numpy arrays are stored raw (and memory-mapped when read), bytes as is
+    and anything else as JSON
+    """
+    if isinstance(value, np.ndarray):
+        array = np.ascontiguousarray(value)
+        return {'kind': 'array', 'dtype': array.dtype.str,
+                'shape': list(array.shape)}, array
+    if isinstance(value, bytes):
+        return {'kind': 'bytes'}, value
+    return {'kind': 'json'}, json.dumps(value).encode()
+
+
+def write_bundle(bundle_fp, sections):
+    """
+    Write sections to a single versioned and checksummed bundle file, the
+    checksums are verified once it is written
+
+    bundle
+        preamble            magic, version, header length, header SHA-256
+        header              JSON {'version', 'created', 'sections':
+                                  {name: {'kind', 'offset', 'length',
+                                          'sha256', ['dtype', 'shape']}}}
+        sections            page-aligned, offsets relative to the first
+
+    Parameters:
+        bundle_fp: path to write the bundle to
+        sections: (dict) {name: np.array, bytes or JSON serialisable value}
+    """
+    entries = {}
+    buffers = []
+    offset = 0
+    for name, value in sections.items():
+        entry, buffer = encode_section(value)
+        length = memoryview(buffer).nbytes
+        entry.update({'offset': offset, 'length': length,
+                      'sha256': hashlib.sha256(buffer).hexdigest()})
+        entries[name] = entry
+        buffers.append(buffer)
+        offset = align(offset + length)
+
+    header = json.dumps({'version': VERSION, 'created': int(time.time()),
+                         'sections': entries}).encode()
+    data_start = align(PREAMBLE.size + len(header))
+
+    # written to a temporary file and renamed so readers never see a
+    # partial bundle
+    tmp_fp = bundle_fp + '.tmp'
+    with open(tmp_fp, 'wb') as fh:
+        fh.write(PREAMBLE.pack(MAGIC, VERSION, len(header),
+                               hashlib.sha256(header).digest()))
+        fh.write(header)
+        for entry, buffer in zip(entries.values(), buffers):
+            fh.seek(data_start + entry['offset'])
+            fh.write(buffer)
+        fh.truncate(data_start + offset)
+
+    # checked before it replaces the previous bundle
+    corrupt = Bundle(tmp_fp).verify()
+    if len(corrupt) > 0:
+        os.remove(tmp_fp)
+        raise ValueError(f"{bundle_fp} sections don't match their checksums "
+                         f"after writing: {corrupt}")
+    os.replace(tmp_fp, bundle_fp)
+
+
+class Bundle():
+    """
+    Memory-mapped database bundle (see write_bundle)
+
+    Opening only reads and checks the header, sections are read (or
+    memory-mapped for arrays) when they are first used.
+    """
+    def __init__(self, bundle_fp):
+        self.bundle_fp = bundle_fp
+        with open(bundle_fp, 'rb') as fh:
+            preamble = fh.read(PREAMBLE.size)
+            if len(preamble) < PREAMBLE.size:
+                raise ValueError(f"{bundle_fp} is not an ETD database bundle")
+            magic, version, header_length, header_digest = \
+                    PREAMBLE.unpack(preamble)
+            if magic != MAGIC:
+                raise ValueError(f"{bundle_fp} is not an ETD database bundle")
+            if version != VERSION:
+                raise ValueError(f"{bundle_fp} is bundle version {version} "
+                                 f"but version {VERSION} is supported")
+            header = fh.read(header_length)
+
+        if hashlib.sha256(header).digest() != header_digest:
+            raise ValueError(f"{bundle_fp} header is corrupt")
+        self.header = json.loads(header)
+        self.sections = self.header['sections']
+        self.data_start = align(PREAMBLE.size + header_length)
+        self.data = np.memmap(bundle_fp, dtype=np.uint8, mode='r')
+
+    def __contains__(self, name):
+        return name in self.sections
+
+    def offset(self, name):
+        """
+        Offset of a section in the bundle file
+        """
+        return self.data_start + self.sections[name]['offset']
+
+    def raw(self, name):
+        """
+        Memory-mapped bytes of a section
+        """
+        start = self.offset(name)
+        return self.data[start:start + self.sections[name]['length']]
+
+    def array(self, name):
+        """
+        Memory-mapped numpy array stored in a section
+        """
+        entry = self.sections[name]
+        return self.raw(name).view(np.dtype(entry['dtype'])) \
+                             .reshape(entry['shape'])
+
+    def bytes(self, name):
+        return self.raw(name).tobytes()
+
+    def json(self, name):
+        return json.loads(self.bytes(name))
+
+    def verify(self):
+        """
+        Check every section against its stored checksum
+
+        Returns:
+            corrupt: (list) names of the sections that don't match
+        """
+        return [name for name, entry in self.sections.items() \
+                    if hashlib.sha256(self.raw(name)).hexdigest() != entry['sha256']]
+
+
+def verify_bundle(bundle_fp):
+    """
+    Check a bundle's header and every section against its checksum
+
+    Parameters:
+        bundle_fp: path to the bundle
+    Returns:
+        problems: (list) descriptions of what is corrupt, empty if intact
+    """
+    try:
+        etd_bundle = Bundle(bundle_fp)
+    except (ValueError, OSError) as error:
+        return [str(error)]
+    return [f"section {name} doesn't match its checksum" \
+                for name in etd_bundle.verify()]
+
+
+@functools.lru_cache(maxsize=None)
+def load_bundle(database_dir):
+    """
+    Open the database bundle once per process
+
+    Parameters:
+        database_dir: (str) path to the directory containing card-prev data
+    Returns:
+        bundle: (Bundle) or None if the database has no bundle
+    """
+    bundle_fp = bundle_path(database_dir)
+    if not os.path.exists(bundle_fp):
+        return None
+    try:
+        etd_bundle = Bundle(bundle_fp)
+    except ValueError as error:
+        logging.error(f"Can't open database bundle: {error}, (re)build the "
+                      "database with `etd.py database`")
+        sys.exit(1)
+    logging.debug(f"Using database bundle: {bundle_fp}")
+    return etd_bundle
+
+
+def write_database_bundle(database_dir, etd_db):
+    """
+    Bundle the index, reference sketches, presence matrix, CARD prevalence
+    metadata and refpkg index of a built database into one file
+
+    Parameters:
+        database_dir: (str) path to the directory containing card-prev data
+        etd_db: (dict) database index
+    Returns:
+        bundle_fp: path to the bundle
+    """
+    reference = sketch.ReferenceSketch(os.path.join(database_dir,
+                                                    etd_db['reference_sketch']))
+    matrix = presence.PresenceMatrix(os.path.join(database_dir,
+                                                  etd_db['presence']))
+
+    sections = {'index': etd_db,
+                'sketch/params': reference.params,
+                'sketch/names': reference.names.tolist(),
+                'sketch/taxa': reference.taxa.tolist(),
+                'sketch/counts': reference.counts,
+                'sketch/hashes': reference.hashes,
+                'presence/columns': matrix.columns,
+                'presence/presence': matrix.presence,
+                'presence/arg_offsets': matrix.arg_offsets,
+                'presence/arg_genomes': matrix.arg_genomes}
+    if reference.representatives is not None:
+        sections['sketch/representatives'] = \
+                reference.representatives.to_dict('list')
+    if reference.leaders is not None:
+        sections['sketch/leaders'] = reference.leaders
+        sections['sketch/leader_distances'] = reference.leader_distances
+
+    # stored as the original files so they are parsed in the same way
+    for name, path in [('metadata', os.path.join('index',
+                                                 'card_prevalence.txt.gz')),
+                       ('refpkg_index', os.path.join('phylo', 'index.tsv'))]:
+        path = os.path.join(database_dir, path)
+        if os.path.exists(path):
+            with open(path, 'rb') as fh:
+                sections[name] = fh.read()
+        else:
+            logging.warning(f"{path} doesn't exist, not adding it to the bundle")
+
+    bundle_fp = bundle_path(database_dir)
+    logging.info(f"Writing database bundle: {bundle_fp}")
+    write_bundle(bundle_fp, sections)
+    return bundle_fp
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import fcntl
+import shutil
+import tempfile
+import hashlib
+import logging
+import contextlib
+
+# entries being written, and how old (in seconds) one has to be to have
+# been abandoned by a killed writer
+TMP_PREFIX = '.tmp-'
+TMP_MAX_AGE = 24 * 60 * 60
+
+
+def file_digest(fp, chunk_size=1 << 20):
+    """
+    SHA-256 of a file's content
+
+    Parameters:
+        fp: path to the file
+    Returns:
+        digest: (str) hex digest
+    """
+    digest = hashlib.sha256()
+    with open(fp, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remove_abandoned(cache_dir):
+    """
+    Remove the temporary directories of a cache left behind by writers that
+    were killed (older than TMP_MAX_AGE)
+    """
+    for name in os.listdir(cache_dir):
+        tmp_dir = os.path.join(cache_dir, name)
+        try:
+            abandoned = name.startswith(TMP_PREFIX) and \
+                    time.time() - os.path.getmtime(tmp_dir) > TMP_MAX_AGE
+        except FileNotFoundError:
+            # finished by its writer
+            continue
+        if abandoned:
+            logging.debug(f"Removing abandoned cache write {tmp_dir}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class ResultCache():
+    """
+    Persistent content-addressed cache of output files shared between
+    concurrent ETD processes.
+
+    Each entry is a directory named by its key.  Entries are written to a
+    temporary directory and renamed into place, readers hold a shared lock
+    and writers/eviction an exclusive one, and the least recently used
+    entries are evicted once the cache grows beyond max_bytes.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock_fp = os.path.join(cache_dir, '.lock')
+
+    @contextlib.contextmanager
+    def lock(self, mode):
+        with open(self.lock_fp, 'a') as fh:
+            fcntl.flock(fh, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def get(self, key, files):
+        """
+        Copy the files of a cached entry to their destinations
+
+        Parameters:
+            key: (str) entry key
+            files: (dict) {cached file name: destination path}
+        Returns:
+            hit: (bool) whether the key was cached
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        with self.lock(fcntl.LOCK_SH):
+            if not os.path.isdir(entry_dir):
+                return False
+            for name, destination in files.items():
+                shutil.copy(os.path.join(entry_dir, name), destination)
+            # mark as recently used
+            os.utime(entry_dir)
+        return True
+
+    def put(self, key, files):
+        """
+        Store files under a key and evict old entries if over the size limit
+
+        Parameters:
+            key: (str) entry key
+            files: (dict) {cached file name: path of the file to cache}
+        """
+        # unique per call so concurrent writers of a key don't collide
+        tmp_dir = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=self.cache_dir)
+        try:
+            for name, fp in files.items():
+                shutil.copy(fp, os.path.join(tmp_dir, name))
+
+            with self.lock(fcntl.LOCK_EX):
+                entry_dir = os.path.join(self.cache_dir, key)
+                try:
+                    os.rename(tmp_dir, entry_dir)
+                except OSError:
+                    if not os.path.isdir(entry_dir):
+                        raise
+                    # another writer cached the same result first
+                    logging.debug(f"Cache entry already stored: {key}")
+                self.evict()
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+        (must be called with the exclusive lock held)
+        """
+        remove_abandoned(self.cache_dir)
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            if key.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, name)) \
+                            for name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logging.debug(f"Evicting cache entry {entry_dir}")
+            shutil.rmtree(entry_dir)
+            total -= size
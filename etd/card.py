@@ -1,152 +1,923 @@
 #!/usr/bin/env python
 import json
+import array
 import math
 import itertools
 import numpy as np
 import glob
 import re
 import os
-from Bio import SeqIO
-from Bio.SubsMat.MatrixInfo import blosum62
+import shutil
+import logging
+import tempfile
+import collections
+import functools
+import collections.abc
+import joblib
+import pandas as pd
+from Bio.Seq import Seq
+try:
+    from Bio.SubsMat.MatrixInfo import blosum62
+except ImportError:
+    # Bio.SubsMat was removed in Biopython 1.80
+    from Bio.Align import substitution_matrices
+    blosum62 = substitution_matrices.load('BLOSUM62')
+
+from etd import align
+from etd import cache
+
+# bumped whenever the layout of the compiled cache changes
+COMPILED_FORMAT = 2
+
+# sequences kept from each supported model and their SequenceStore encoding
+SEQUENCE_TYPES = {'protein_sequence': 'proteins', 'dna_sequence': 'nucleotides'}
+SEQUENCE_ENCODINGS = {'proteins': 'raw', 'nucleotides': '2bit'}
+
+
+def card_header(accession, aro, aro_name):
+    """
+    FASTA header of a CARD model sequence
+    """
+    return ">gb|{}|{}|{}|".format(accession, aro, aro_name.replace(' ', '_'))
+
+
+# 2-bit codes of the nucleotides, other characters (N, IUPAC codes, lower
+# case) are kept aside as exceptions
+NUCLEOTIDES = np.frombuffer(b'ACGT', dtype=np.uint8)
+NUCLEOTIDE_CODES = np.full(256, 255, dtype=np.uint8)
+NUCLEOTIDE_CODES[NUCLEOTIDES] = np.arange(4, dtype=np.uint8)
+PACK_SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+
+# bases buffered before packing and records decoded at once when exporting
+PACK_BLOCK = 1 << 20
+EXPORT_BLOCK = 1 << 10
+
+
+def pack_nucleotides(sequence, first_position):
+    """
+    Pack nucleotides four to a byte
+
+    Parameters:
+        sequence: (bytes) nucleotides, a multiple of 4 long
+        first_position: (int) position of the first base in the store
+    Returns:
+        packed: (np.array) uint8 2-bit codes
+        exception_positions: (np.array) store positions of non-ACGT bases
+        exception_bases: (np.array) uint8 non-ACGT bases
+    """
+    bases = np.frombuffer(sequence, dtype=np.uint8)
+    codes = NUCLEOTIDE_CODES[bases]
+    exceptions = np.flatnonzero(codes == 255)
+    codes[exceptions] = 0
+    codes = codes.reshape(-1, 4)
+    packed = codes[:, 0] << 6 | codes[:, 1] << 4 | codes[:, 2] << 2 | codes[:, 3]
+    return packed, exceptions + first_position, bases[exceptions]
+
+
+# the four nucleotides packed in each byte value
+UNPACKED = NUCLEOTIDES[(np.arange(256, dtype=np.uint8)[:, None] >> PACK_SHIFTS) & 3]
+
+
+def unpack_records(packed, starts, stops, exception_positions,
+                   exception_bases):
+    """
+    Nucleotides of several ranges [start, stop) of a packed store, unpacking
+    whole bytes and trimming the bases of neighbouring records
+
+    Parameters:
+        packed: (np.array) 2-bit codes (see pack_nucleotides)
+        starts, stops: (np.array) ascending ranges
+        exception_positions, exception_bases: non-ACGT bases of the store
+    Returns:
+        bases: (np.array) uint8 nucleotides of every range, one after the other
+        bounds: (np.array) offsets of each range in bases
+    """
+    byte_positions, byte_bounds = gather_positions(starts >> 2, (stops + 3) >> 2)
+    bases = UNPACKED[packed[byte_positions]].reshape(-1)
+    keep = np.ones(len(bases), dtype=bool)
+    heads, tails = starts & 3, -stops & 3
+    for k in range(1, 4):
+        keep[4 * byte_bounds[:-1][heads >= k] + k - 1] = False
+        keep[4 * byte_bounds[1:][tails >= k] - k] = False
+    bases = bases[keep]
+
+    bounds = np.zeros(len(starts) + 1, dtype=np.int64)
+    bounds[1:] = np.cumsum(stops - starts)
+    if len(starts) > 0:
+        lower, upper = np.searchsorted(exception_positions,
+                                       [starts[0], stops[-1]])
+        exceptions = exception_positions[lower:upper]
+        records = np.searchsorted(starts, exceptions, side='right') - 1
+        within = exceptions < stops[records]
+        bases[bounds[records[within]] + exceptions[within] - starts[records[within]]] = \
+                exception_bases[lower:upper][within]
+    return bases, bounds
+
+
+def gather_positions(starts, stops):
+    """
+    Buffer positions covered by ranges [start, stop)
+
+    Returns:
+        positions: (np.array) positions of every range, one after the other
+        bounds: (np.array) offsets of each range in positions
+    """
+    lengths = np.asarray(stops) - np.asarray(starts)
+    bounds = np.zeros(len(lengths) + 1, dtype=np.int64)
+    bounds[1:] = np.cumsum(lengths)
+    positions = np.arange(bounds[-1], dtype=np.int64) + \
+            np.repeat(np.asarray(starts) - bounds[:-1], lengths)
+    return positions, bounds
+
+
+class SequenceStoreBuilder():
+    """
+    Appends (aro, header, sequence) records to a new SequenceStore, packing
+    nucleotides as they arrive so the sequences are never all held as strings
+    """
+    def __init__(self, encoding='raw'):
+        self.encoding = encoding
+        self.aros = {}
+        self.aro_ix = array.array('q')
+        self.headers = bytearray()
+        self.header_offsets = array.array('q', [0])
+        self.data = bytearray()
+        self.offsets = array.array('q', [0])
+        self.pending = bytearray()
+        self.packed_length = 0
+        self.exception_positions = []
+        self.exception_bases = []
+
+    def append(self, aro, header, sequence):
+        """
+        Append a record, header and sequence as str or bytes
+        """
+        if isinstance(header, str):
+            header = header.encode()
+        if isinstance(sequence, str):
+            sequence = sequence.encode()
+        self.aro_ix.append(self.aros.setdefault(aro, len(self.aros)))
+        self.headers += header
+        self.header_offsets.append(len(self.headers))
+        self.offsets.append(self.offsets[-1] + len(sequence))
+        if self.encoding == 'raw':
+            self.data += sequence
+        else:
+            self.pending += sequence
+            if len(self.pending) >= PACK_BLOCK:
+                self.pack(len(self.pending) // 4 * 4)
+
+    def pack(self, length):
+        packed, positions, bases = pack_nucleotides(bytes(self.pending[:length]),
+                                                    self.packed_length)
+        self.data += packed.tobytes()
+        self.exception_positions.append(positions)
+        self.exception_bases.append(bases)
+        del self.pending[:length]
+        self.packed_length += length
+
+    def store(self):
+        """
+        The SequenceStore of the appended records
+        """
+        if self.encoding == '2bit':
+            # padded to a whole byte, the padding is never read
+            self.pending += b'A' * (-len(self.pending) % 4)
+            self.pack(len(self.pending))
+        arrays = {'aro_ix': np.array(self.aro_ix, dtype=np.int64),
+                  'headers': np.frombuffer(self.headers, dtype=np.uint8),
+                  'header_offsets': np.array(self.header_offsets, dtype=np.int64),
+                  'data': np.frombuffer(self.data, dtype=np.uint8),
+                  'offsets': np.array(self.offsets, dtype=np.int64),
+                  'exception_positions': np.concatenate(
+                        [np.zeros(0, dtype=np.int64)] + self.exception_positions),
+                  'exception_bases': np.concatenate(
+                        [np.zeros(0, dtype=np.uint8)] + self.exception_bases)}
+        return SequenceStore(self.encoding, list(self.aros), arrays)
+
+
+class SequenceStore(collections.abc.Mapping):
+    """
+    Array-backed sequence records (e.g. the proteins or nucleotides of CARD
+    models) rather than a header and sequence string per record
+
+    store_dir/
+        store.json                  encoding ('raw' or '2bit') and AROs
+        aro_ix.npy                  ARO (index into AROs) of each record
+        headers.npy                 concatenated headers
+        header_offsets.npy          offsets of each header in headers
+        data.npy                    concatenated sequences, 4 bases per
+                                    byte for 2bit
+        offsets.npy                 offsets of each sequence (in bases)
+        exception_positions.npy     positions of the non-ACGT bases (2bit)
+        exception_bases.npy         non-ACGT bases (2bit)
+
+    As a mapping it stands in for the {aro: (header, sequence)} dicts CARD
+    used to keep, giving the first record of each ARO.
+    """
+    ARRAYS = ['aro_ix', 'headers', 'header_offsets', 'data', 'offsets',
+              'exception_positions', 'exception_bases']
+
+    def __init__(self, encoding, aros, arrays):
+        self.encoding = encoding
+        self.aros = aros
+        self.arrays = arrays
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+        aro_ix, first_rows = np.unique(self.aro_ix, return_index=True)
+        order = np.argsort(first_rows)
+        self.index = {aros[aro]: int(row) for aro, row in \
+                        zip(aro_ix[order], first_rows[order])}
+
+    @classmethod
+    def load(cls, store_dir):
+        """
+        Store memory-mapped from disk (see save)
+        """
+        with open(os.path.join(store_dir, 'store.json')) as fh:
+            meta = json.load(fh)
+        arrays = {name: np.load(os.path.join(store_dir, name + '.npy'),
+                                mmap_mode='r') for name in cls.ARRAYS}
+        return cls(meta['encoding'], meta['aros'], arrays)
+
+    def save(self, store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+        with open(os.path.join(store_dir, 'store.json'), 'w') as fh:
+            json.dump({'encoding': self.encoding, 'aros': self.aros}, fh)
+        for name in self.ARRAYS:
+            np.save(os.path.join(store_dir, name + '.npy'), self.arrays[name])
+
+    @property
+    def n_records(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def select(self, start, stop):
+        """
+        Records [start, stop) as a store sharing this store's buffers
+        """
+        arrays = dict(self.arrays,
+                      aro_ix=self.aro_ix[start:stop],
+                      header_offsets=self.header_offsets[start:stop + 1],
+                      offsets=self.offsets[start:stop + 1])
+        return SequenceStore(self.encoding, self.aros, arrays)
+
+    def span(self, start, stop):
+        """
+        Bases (or residues) [start, stop) of the concatenated sequences, a
+        view of the buffer unless they are 2-bit packed
+        """
+        if self.encoding == 'raw':
+            return self.data[start:stop]
+        bases, _ = unpack_records(self.data, np.array([start]), np.array([stop]),
+                                  self.exception_positions,
+                                  self.exception_bases)
+        return bases.tobytes()
+
+    def aro(self, ix):
+        return self.aros[self.aro_ix[ix]]
+
+    def header(self, ix):
+        return bytes(self.headers[self.header_offsets[ix]:
+                                  self.header_offsets[ix + 1]]).decode()
+
+    def sequence(self, ix):
+        return bytes(self.span(self.offsets[ix], self.offsets[ix + 1])).decode()
+
+    def records(self):
+        """
+        Every (aro, header, sequence) record in the store
+        """
+        for ix in range(self.n_records):
+            yield self.aro(ix), self.header(ix), self.sequence(ix)
+
+    def gather(self, rows):
+        """
+        Concatenated headers and sequences of records, decoded together
+
+        Parameters:
+            rows: (array) records in ascending order
+        Returns:
+            headers: (bytes) concatenated headers
+            header_bounds: (np.array) offsets of each header in headers
+            sequences: (bytes) concatenated sequences
+            bounds: (np.array) offsets of each sequence in sequences
+        """
+        header_positions, header_bounds = gather_positions(
+                self.header_offsets[rows], self.header_offsets[rows + 1])
+        starts, stops = self.offsets[rows], self.offsets[rows + 1]
+        if self.encoding == 'raw':
+            positions, bounds = gather_positions(starts, stops)
+            sequences = self.data[positions]
+        else:
+            sequences, bounds = unpack_records(self.data, starts, stops,
+                                               self.exception_positions,
+                                               self.exception_bases)
+        return self.headers[header_positions].tobytes(), header_bounds, \
+                sequences.tobytes(), bounds
+
+    def fasta_blocks(self, rows=None):
+        """
+        FASTA of records, decoding EXPORT_BLOCK records at a time
+
+        Parameters:
+            rows: (array) records to include in ascending order (all by
+                  default)
+        Returns:
+            blocks: generator of FASTA bytes
+        """
+        rows = np.arange(self.n_records) if rows is None else np.asarray(rows)
+        for block in range(0, len(rows), EXPORT_BLOCK):
+            headers, header_bounds, sequences, bounds = \
+                    self.gather(rows[block:block + EXPORT_BLOCK])
+            lines = []
+            for ix in range(len(bounds) - 1):
+                lines.append(headers[header_bounds[ix]:header_bounds[ix + 1]])
+                lines.append(sequences[bounds[ix]:bounds[ix + 1]])
+            lines.append(b'')
+            yield b'\n'.join(lines)
+
+    def write_fasta(self, fh, rows=None):
+        """
+        Write records to a binary file handle as FASTA (see fasta_blocks)
+        """
+        for block in self.fasta_blocks(rows):
+            fh.write(block)
+
+    def __getitem__(self, aro):
+        ix = self.index[aro]
+        return self.header(ix), self.sequence(ix)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+# whitespace between JSON tokens
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_card_json(card_json_fp, metadata, chunk_size=1 << 20):
+    """
+    Stream the model entries of card.json one at a time, reading it in
+    chunks so only the current entry is held in memory rather than the whole
+    document
+
+    Parameters:
+        card_json_fp: path to card.json
+        metadata: (dict) filled with the _version, _timestamp and _comment
+                  entries as they are read
+        chunk_size: (int) characters read at a time
+    Returns:
+        entries: generator of (key, model) entries
+    """
+    decoder = json.JSONDecoder()
+    with open(card_json_fp) as fh:
+        buffer = ''
+        pos = 0
+        eof = False
+
+        def fill():
+            nonlocal buffer, pos, eof
+            chunk = fh.read(chunk_size)
+            eof = chunk == ''
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        def peek():
+            nonlocal pos
+            while True:
+                pos = JSON_WHITESPACE.match(buffer, pos).end()
+                if pos < len(buffer):
+                    return buffer[pos]
+                if eof:
+                    raise ValueError(f"{card_json_fp} ended unexpectedly")
+                fill()
+
+        def expect(tokens):
+            nonlocal pos
+            token = peek()
+            if token not in tokens:
+                raise ValueError(f"Malformed {card_json_fp}: expected one of "
+                                 f"{tokens!r} but found {token!r}")
+            pos += 1
+            return token
+
+        def value():
+            nonlocal pos
+            peek()
+            while True:
+                try:
+                    decoded, end = decoder.raw_decode(buffer, pos)
+                    # a value running to the end of the buffer may have been
+                    # cut short by the chunk (e.g. a number)
+                    if end < len(buffer) or eof:
+                        pos = end
+                        return decoded
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        expect('{')
+        if peek() == '}':
+            return
+        while True:
+            key = value()
+            expect(':')
+            entry = value()
+            if key.startswith('_'):
+                metadata[key] = entry
+            else:
+                yield key, entry
+            if expect(',}') == '}':
+                return
+
+
+def compile_card(card_items, supported_models):
+    """
+    Extract everything CARD uses from the models of card.json in one pass
+
+    Parameters:
+        card_items: iterable of (key, model) entries of card.json without
+                    its _version, _timestamp and _comment entries
+        supported_models: (list) model types to keep the sequences of
+    Returns:
+        model_types: (dict) {aro: model type}
+        aro_gene_families: (dict) {aro: [AMR gene families]}
+        sequences: (dict) {'proteins': SequenceStore of the first protein of
+                           each ARO, 'nucleotides': SequenceStore of every
+                           nucleotide sequence}
+    """
+    model_types = {}
+    aro_gene_families = {}
+    # appended to as each model is read
+    sequences = {name: SequenceStoreBuilder(encoding) \
+                    for name, encoding in SEQUENCE_ENCODINGS.items()}
+    protein_aros = set()
+    for key, card_item in card_items:
+        aro = card_item['ARO_accession']
+        model_types[aro] = card_item['model_type']
+        aro_gene_families[aro] = gene_families(card_item)
+
+        if card_item['model_type'] not in supported_models:
+            continue
+        model_sequences = card_item['model_sequences']['sequence']
+        for seq_ix in model_sequences:
+            for sequence_type, name in SEQUENCE_TYPES.items():
+                if sequence_type not in model_sequences[seq_ix]:
+                    continue
+                if name == 'proteins':
+                    # only the first protein of each ARO is used
+                    if aro in protein_aros:
+                        continue
+                    protein_aros.add(aro)
+                sequence = model_sequences[seq_ix][sequence_type]
+                sequences[name].append(aro,
+                                       card_header(sequence['accession'], aro,
+                                                   card_item['ARO_name']),
+                                       sequence['sequence'])
+
+    sequences = {name: builder.store() for name, builder in sequences.items()}
+    return model_types, aro_gene_families, sequences
+
+
+def gene_families(card_item):
+    """
+    AMR gene families of a card.json model
+    """
+    ## as multiple gene families are possible per ARO
+    ## although they are relatively rare so maybe I should talk with
+    ## Andrew about making them unique
+    gene_families = []
+    for category in card_item['ARO_category'].values():
+        if category['category_aro_class_name'] == 'AMR Gene Family':
+            gene_families.append(category['category_aro_name'])
+
+    ## fix the situations where there are multiple gene families manually
+    ## all glycopeptide resistant gene clusters have 2 gene families one
+    ## indicating that it is a grgc and the other with its class
+    ## for now we are just using the cluster level and will deal with
+    ## the specifics at ARO level.
+    #if "glycopeptide resistance gene cluster" in gene_families:
+    #    gene_families = ['glycopeptide resistance gene cluster']
+
+    ## this is a fusion protein so can be assigned to a new class
+    #if ARO_acc == '3002598':
+    #    gene_families = ["AAC(6')_ANT(3'')"]
+    #if ARO_acc == '3002597':
+    #    gene_families = ["APH(2'')_AAC(6')"]
+    #if ARO_acc in ['3002546', '3002600']:
+    #    gene_families = ["AAC(3)_AAC(6')"]
+
+    ## also a fusion so assigned a new fusion class
+    #if 'class C LRA beta-lactamase' in gene_families and \
+    #        'class D LRA beta-lactamase' in gene_families:
+    #    gene_families = ['class D/class C beta-lactamase fusion']
+
+    ## 23S with multiple resistance classes
+    #if ARO_acc == '3004181':
+    #    gene_families = ['23S rRNA with mutation conferring resistance '
+    #                     'to macrolide and streptogramins antibiotics']
+
+    ## additional self-resistance class to indicate resistance genes made by
+    ## antibiotic producer removing the self resistant term
+    #if "fluoroquinolone resistant parC" in gene_families and \
+    #        "fluoroquinolone self resistant parC" in gene_families:
+    #    gene_families = ['fluoroquinolone resistant parC']
+
+    #if "kirromycin self resistant EF-Tu" in gene_families and \
+    #        'elfamycin resistant EF-Tu' in gene_families:
+    #    gene_families = ['elfamycin resistant EF-Tu']
+
+    #if 'aminocoumarin self resistant parY' in gene_families and \
+    #        'aminocoumarin resistant parY' in gene_families:
+    #    gene_families = ['aminocoumarin resistant parY']
+
+    ## efflux components
+    #if ARO_acc in ['3000263', '3000833', '3003382', '3000832',
+    #               '3000815', '3003896', '3000823', '3003511',
+    #               '3003381', '3000817', '3003895', '3000676',
+    #               '3003383', '3003585', '3004107', '3003820']:
+    #    gene_families = ['efflux regulator']
+    #if ARO_acc == '3000237':
+    #    gene_families = ['efflux component']
+
+
+    ## They are homologous parts of topo IV and II but it looks like this is actually parC
+    #if 'fluoroquinolone resistant parC' in gene_families and \
+    #        'fluoroquinolone resistant gyrA' in gene_families:
+    #    gene_families = ['fluoroquinolone resistant parC']
+
+
+    ## things that need fixed
+    ## this looks like a mistake and is only UhpA
+    #if 'UhpT' in gene_families and 'UhpA' in gene_families:
+    #    gene_families = ['UhpA']
+
+    ## missing families
+    #if ARO_acc == "3004450":
+    #    gene_families = ['TRU beta-lactamase']
+    #if ARO_acc == "3004294":
+    #    gene_families = ['BUT beta-lactamase']
+
+    return gene_families
+
+
+def compiled_name(version, rrna):
+    """
+    Directory name of a compiled card.json in the cache
+    """
+    return f"{version}_rrna" if rrna else version
+
+
+def read_cache_index(cache_dir):
+    """
+    {card.json realpath: {'size', 'mtime', 'version'}} of the card.json
+    files compiled into the cache
+    """
+    index_fp = os.path.join(cache_dir, 'index.json')
+    if not os.path.exists(index_fp):
+        return {}
+    with open(index_fp) as fh:
+        return json.load(fh)
+
+
+def find_compiled(cache_dir, card_json_fp, rrna):
+    """
+    Compiled cache of a card.json, found from the size and modification time
+    recorded for it so the card.json itself isn't read
+
+    Parameters:
+        cache_dir: path to the compiled CARD cache
+        card_json_fp: path to card.json
+        rrna: (bool) whether the rRNA gene variant models are used
+    Returns:
+        compiled_dir: path to the compiled card.json or None if it hasn't
+                      been compiled (or has changed since)
+    """
+    entry = read_cache_index(cache_dir).get(os.path.realpath(card_json_fp))
+    stat = os.stat(card_json_fp)
+    if entry is None or entry['size'] != stat.st_size \
+            or entry['mtime'] != stat.st_mtime:
+        return None
+    compiled_dir = os.path.join(cache_dir, compiled_name(entry['version'], rrna))
+    if read_compiled_format(compiled_dir) != COMPILED_FORMAT:
+        return None
+    return compiled_dir
+
+
+def read_compiled_format(compiled_dir):
+    """
+    Format of a compiled card.json (None if it doesn't exist)
+    """
+    meta_fp = os.path.join(compiled_dir, 'card.json')
+    if not os.path.exists(meta_fp):
+        return None
+    with open(meta_fp) as fh:
+        return json.load(fh).get('format')
+
+
+def update_cache_index(cache_dir, card_json_fp, version):
+    """
+    Record the version of a card.json against its size and modification time
+    """
+    index = read_cache_index(cache_dir)
+    stat = os.stat(card_json_fp)
+    index[os.path.realpath(card_json_fp)] = {'size': stat.st_size,
+                                             'mtime': stat.st_mtime,
+                                             'version': version}
+    tmp_fd, tmp_fp = tempfile.mkstemp(prefix='.index-', dir=cache_dir)
+    try:
+        with os.fdopen(tmp_fd, 'w') as fh:
+            json.dump(index, fh, indent=1)
+        os.replace(tmp_fp, os.path.join(cache_dir, 'index.json'))
+    finally:
+        if os.path.exists(tmp_fp):
+            os.remove(tmp_fp)
+
+
+# memory buffered and file handles kept open when writing per-family FASTA
+FAMILY_BUFFER = 1 << 26
+FAMILY_HANDLES = 256
+
+
+class FamilyWriter():
+    """
+    Appends FASTA to many per-family files, buffering it in memory and
+    keeping a bounded pool of the most recently used file handles open
+    rather than opening a file for every record
+    """
+    def __init__(self, max_buffered=FAMILY_BUFFER, max_open=FAMILY_HANDLES):
+        self.max_buffered = max_buffered
+        self.max_open = max_open
+        self.buffers = {}
+        self.buffered = 0
+        self.handles = collections.OrderedDict()
+
+    def write(self, fp, data):
+        self.buffers.setdefault(fp, []).append(data)
+        self.buffered += len(data)
+        if self.buffered > self.max_buffered:
+            self.flush()
+
+    def handle(self, fp):
+        if fp in self.handles:
+            self.handles.move_to_end(fp)
+            return self.handles[fp]
+        if len(self.handles) >= self.max_open:
+            self.handles.popitem(last=False)[1].close()
+        self.handles[fp] = open(fp, 'ab')
+        return self.handles[fp]
+
+    def flush(self):
+        for fp, chunks in self.buffers.items():
+            self.handle(fp).write(b''.join(chunks))
+        self.buffers = {}
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        for fh in self.handles.values():
+            fh.close()
+        self.handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def prevalence_aro(nt_fp, header):
+    """
+    ARO of a CARD prevalence allele from its FASTA header
+    """
+    try:
+        return header.split(b'|')[2].replace(b'ARO:', b'').decode()
+    except IndexError:
+        raise ValueError(f"No ARO in {nt_fp} header: {header.decode()}")
+
+
+def read_prevalence_fasta(nt_fp, chunk_size=1 << 24):
+    """
+    Read the alleles of a CARD prevalence nucleotide_fasta_* file, a chunk
+    of whole records at a time
+
+    Parameters:
+        nt_fp: path to the FASTA file
+        chunk_size: (int) bytes read at a time
+    Returns:
+        alleles: (SequenceStore) 2-bit packed alleles keyed by ARO
+    """
+    builder = SequenceStoreBuilder('2bit')
+    remainder = b''
+    with open(nt_fp, 'rb') as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            data = remainder + chunk
+            if chunk:
+                # hold back the last (possibly partial) record
+                last = data.rfind(b'\n>')
+                if last == -1:
+                    remainder = data
+                    continue
+                data, remainder = data[:last + 1], data[last + 1:]
+            for record in data.split(b'\n>'):
+                header, _, sequence = record.partition(b'\n')
+                header = b'>' + header.lstrip(b'>').rstrip()
+                if header == b'>' and not sequence.strip():
+                    continue
+                builder.append(prevalence_aro(nt_fp, header), header,
+                               sequence.replace(b'\n', b'').replace(b'\r', b'')
+                                       .replace(b' ', b''))
+            if not chunk:
+                break
+    return builder.store()
+
+
+def translate(dna):
+    """
+    Protein of a predicted ARG (bacterial genetic code, up to the first stop)
+    """
+    dna = dna[:len(dna) // 3 * 3]
+    return str(Seq(dna).translate(table=11, to_stop=True))
+
 
 class CARD():
     """
     Parser for the CARD database
     """
-    def __init__(self, card_json_fp, rrna=False):
-        with open(card_json_fp) as fh:
+    def __init__(self, card_json_fp, rrna=False, cache_dir=None, stream=True):
+        """
+        Parameters:
+            card_json_fp: path to card.json
+            rrna: (bool) also use the rRNA gene variant models
+            cache_dir: path to keep card.json compiled in so it is only
+                       parsed once per CARD version (None to always parse)
+            stream: (bool) parse card.json one model at a time to bound
+                    memory use instead of loading the whole document
+        """
+
+        """
+        All models currently in card.json:
+            {'efflux pump system meta-model',
+            'gene cluster meta-model',
+            'protein domain meta-model',
+            'protein homolog model',
+            'protein knockout model',
+            'protein overexpression model',
+            'protein variant model',
+            'rRNA gene variant model'}
+        """
+
+        self.supported_models = ['protein homolog model',
+                                 'protein variant model',
+                                 'protein overexpression model']
+        if rrna:
+            self.supported_models.append('rRNA gene variant model')
+
+        compiled_dir = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            compiled_dir = find_compiled(cache_dir, card_json_fp, rrna)
+
+        if compiled_dir is not None:
+            logging.debug(f"Loading compiled CARD: {compiled_dir}")
+            self.load_compiled(compiled_dir)
+        else:
+            self.parse(card_json_fp, stream)
+            if cache_dir is not None:
+                self.save_compiled(cache_dir, card_json_fp, rrna)
+
+    def parse(self, card_json_fp, stream=True):
+        """
+        Parse card.json and gather the sequences and gene families of its
+        models
+
+        Parameters:
+            card_json_fp: path to card.json
+            stream: (bool) read card.json one model at a time (see
+                    iter_card_json) rather than loading the whole document
+        """
+        logging.info(f"Parsing {card_json_fp}")
+        metadata = {}
+        if stream:
+            entries = iter_card_json(card_json_fp, metadata)
+        else:
             with open(card_json_fp) as fh:
-                self.card = json.load(fh)
-            self.version = self.card['_version']
+                card = json.load(fh)
 
             # to avoid having to except them later when parsing the other
             # entries
-            del self.card['_version']
-            del self.card['_timestamp']
-            del self.card['_comment']
-
-            """
-            All models currently in card.json:
-                {'efflux pump system meta-model',
-                'gene cluster meta-model',
-                'protein domain meta-model',
-                'protein homolog model',
-                'protein knockout model',
-                'protein overexpression model',
-                'protein variant model',
-                'rRNA gene variant model'}
-            """
-
-            self.supported_models = ['protein homolog model',
-                                     'protein variant model',
-                                     'protein overexpression model']
-            if rrna:
-                self.supported_models.append('rRNA gene variant model')
-
-            self.proteins, self.nucleotides = self.get_sequences()
-            self.aro_to_gene_family = self.build_aro_to_gene_family()
-            self.gene_family_to_aro = self.build_gene_family_to_aro()
-
-    def build_aro_to_gene_family(self):
-        aro_to_gene_family = {}
-        for card_item in self.card.values():
-            ARO_acc = card_item['ARO_accession']
-
-            ## as multiple gene families are possible per ARO
-            ## although they are relatively rare so maybe I should talk with
-            ## Andrew about making them unique
-            gene_families = []
-            for category in card_item['ARO_category'].values():
-                if category['category_aro_class_name'] == 'AMR Gene Family':
-                    gene_families.append(category['category_aro_name'])
-
-            ## fix the situations where there are multiple gene families manually
-            ## all glycopeptide resistant gene clusters have 2 gene families one
-            ## indicating that it is a grgc and the other with its class
-            ## for now we are just using the cluster level and will deal with
-            ## the specifics at ARO level.
-            #if "glycopeptide resistance gene cluster" in gene_families:
-            #    gene_families = ['glycopeptide resistance gene cluster']
-
-            ## this is a fusion protein so can be assigned to a new class
-            #if ARO_acc == '3002598':
-            #    gene_families = ["AAC(6')_ANT(3'')"]
-            #if ARO_acc == '3002597':
-            #    gene_families = ["APH(2'')_AAC(6')"]
-            #if ARO_acc in ['3002546', '3002600']:
-            #    gene_families = ["AAC(3)_AAC(6')"]
-
-            ## also a fusion so assigned a new fusion class
-            #if 'class C LRA beta-lactamase' in gene_families and \
-            #        'class D LRA beta-lactamase' in gene_families:
-            #    gene_families = ['class D/class C beta-lactamase fusion']
-
-            ## 23S with multiple resistance classes
-            #if ARO_acc == '3004181':
-            #    gene_families = ['23S rRNA with mutation conferring resistance '
-            #                     'to macrolide and streptogramins antibiotics']
-
-            ## additional self-resistance class to indicate resistance genes made by
-            ## antibiotic producer removing the self resistant term
-            #if "fluoroquinolone resistant parC" in gene_families and \
-            #        "fluoroquinolone self resistant parC" in gene_families:
-            #    gene_families = ['fluoroquinolone resistant parC']
-
-            #if "kirromycin self resistant EF-Tu" in gene_families and \
-            #        'elfamycin resistant EF-Tu' in gene_families:
-            #    gene_families = ['elfamycin resistant EF-Tu']
-
-            #if 'aminocoumarin self resistant parY' in gene_families and \
-            #        'aminocoumarin resistant parY' in gene_families:
-            #    gene_families = ['aminocoumarin resistant parY']
-
-            ## efflux components
-            #if ARO_acc in ['3000263', '3000833', '3003382', '3000832',
-            #               '3000815', '3003896', '3000823', '3003511',
-            #               '3003381', '3000817', '3003895', '3000676',
-            #               '3003383', '3003585', '3004107', '3003820']:
-            #    gene_families = ['efflux regulator']
-            #if ARO_acc == '3000237':
-            #    gene_families = ['efflux component']
-
-
-            ## They are homologous parts of topo IV and II but it looks like this is actually parC
-            #if 'fluoroquinolone resistant parC' in gene_families and \
-            #        'fluoroquinolone resistant gyrA' in gene_families:
-            #    gene_families = ['fluoroquinolone resistant parC']
-
-
-            ## things that need fixed
-            ## this looks like a mistake and is only UhpA
-            #if 'UhpT' in gene_families and 'UhpA' in gene_families:
-            #    gene_families = ['UhpA']
-
-            ## missing families
-            #if ARO_acc == "3004450":
-            #    gene_families = ['TRU beta-lactamase']
-            #if ARO_acc == "3004294":
-            #    gene_families = ['BUT beta-lactamase']
-
-            aro_to_gene_family.update({ARO_acc: gene_families})
+            for key in ['_version', '_timestamp', '_comment']:
+                metadata[key] = card.pop(key)
+            entries = card.items()
+
+        self.model_types, aro_gene_families, sequences = \
+                compile_card(entries, self.supported_models)
+        self.version = metadata['_version']
+        self.proteins = sequences['proteins']
+        self.nucleotides = sequences['nucleotides']
+        self.aro_to_gene_family = self.build_aro_to_gene_family(aro_gene_families)
+        self.gene_family_to_aro = self.build_gene_family_to_aro()
+
+    def save_compiled(self, cache_dir, card_json_fp, rrna):
+        """
+        Compile the parsed card.json into the cache, keyed by its version
+
+        cache_dir/
+            index.json              version of each compiled card.json
+            <version>[_rrna]/
+                card.json           version, model types and gene families
+                proteins/           first protein of each ARO (SequenceStore)
+                nucleotides/        2-bit packed nucleotides (SequenceStore)
+        """
+        name = compiled_name(self.version, rrna)
+        compiled_dir = os.path.join(cache_dir, name)
+        if read_compiled_format(compiled_dir) != COMPILED_FORMAT:
+            # written to a temporary directory (unique per call) and renamed
+            # so concurrent readers never see a partial cache
+            cache.remove_abandoned(cache_dir)
+            tmp_dir = tempfile.mkdtemp(prefix=f"{cache.TMP_PREFIX}{name}-",
+                                       dir=cache_dir)
+            try:
+                with open(os.path.join(tmp_dir, 'card.json'), 'w') as fh:
+                    json.dump({'format': COMPILED_FORMAT,
+                               'version': self.version,
+                               'supported_models': self.supported_models,
+                               'model_types': self.model_types,
+                               'aro_to_gene_family': self.aro_to_gene_family,
+                               'gene_family_to_aro': self.gene_family_to_aro},
+                              fh)
+                self.proteins.save(os.path.join(tmp_dir, 'proteins'))
+                self.nucleotides.save(os.path.join(tmp_dir, 'nucleotides'))
+
+                if os.path.exists(compiled_dir) and \
+                        read_compiled_format(compiled_dir) != COMPILED_FORMAT:
+                    logging.info(f"Replacing outdated compiled CARD: {compiled_dir}")
+                    shutil.rmtree(compiled_dir, ignore_errors=True)
+                try:
+                    os.rename(tmp_dir, compiled_dir)
+                    logging.info(f"Compiled CARD {self.version}: {compiled_dir}")
+                except OSError:
+                    if read_compiled_format(compiled_dir) != COMPILED_FORMAT:
+                        raise
+                    # another process compiled the same version first
+                    logging.debug(f"Compiled CARD already stored: {compiled_dir}")
+            finally:
+                if os.path.exists(tmp_dir):
+                    shutil.rmtree(tmp_dir)
+        update_cache_index(cache_dir, card_json_fp, self.version)
+
+    def load_compiled(self, compiled_dir):
+        """
+        Load a compiled card.json, memory-mapping its sequences
+        """
+        with open(os.path.join(compiled_dir, 'card.json')) as fh:
+            compiled = json.load(fh)
+        self.version = compiled['version']
+        self.model_types = compiled['model_types']
+        self.aro_to_gene_family = compiled['aro_to_gene_family']
+        self.gene_family_to_aro = compiled['gene_family_to_aro']
+        self.proteins = SequenceStore.load(os.path.join(compiled_dir, 'proteins'))
+        self.nucleotides = SequenceStore.load(os.path.join(compiled_dir,
+                                                           'nucleotides'))
+
+    def build_aro_to_gene_family(self, aro_gene_families):
+        """
+        Unique AMR gene family of each ARO with a protein sequence, AROs
+        with several (or no) gene families are left out
+
+        Parameters:
+            aro_gene_families: (dict) {aro: [AMR gene families]} of every
+                               model (see compile_card)
+        """
+        aro_to_gene_family = dict(aro_gene_families)
 
         # tidy up and make unique aro:amr family relationship
-        mapping_failure = False
+        unmapped = []
         aros_without_protein = []
         for aro, gene_families in aro_to_gene_family.items():
             if len(gene_families) != 1:
-                mapping_failure = True
-                print(aro, gene_families)
+                unmapped.append(aro)
+                logging.warning(f"Skipping ARO:{aro} which has "
+                                f"{len(gene_families)} AMR gene families: "
+                                f"{gene_families}")
             else:
                 aro_to_gene_family[aro] = gene_families[0]
 
             if aro not in self.proteins:
                 aros_without_protein.append(aro)
 
-        if mapping_failure:
-            raise ValueError("AROs and gene families don't map 1:1")
-
-        # remove any aro without a protein sequence
-        for aro in aros_without_protein:
+        # remove any aro without a unique gene family or a protein sequence
+        for aro in set(unmapped + aros_without_protein):
             del aro_to_gene_family[aro]
 
         return aro_to_gene_family
@@ -161,34 +932,11 @@ class CARD():
 
         return gene_family_to_aro
 
-    def get_sequences(self):
-        """
-        Gather list of accession, prot and nucleotide sequence tuples from
-        the card.json
-        """
-        data = {'protein_sequence': {}, 'dna_sequence': {}}
-        for key, card_item in self.card.items():
-            if card_item['model_type'] in self.supported_models:
-                aro = card_item['ARO_accession']
-                aro_name = card_item['ARO_name']
-                sequences = card_item['model_sequences']['sequence']
-                for seq_ix in sequences:
-                    for sequence_type in sequences[seq_ix]:
-                        if sequence_type in ['protein_sequence', 'dna_sequence']:
-                            sequence = sequences[seq_ix][sequence_type]
-                            if aro not in data[sequence_type]:
-                                acc = ">gb|{}|{}|{}|".format(sequence['accession'],
-                                                             aro,
-                                                             aro_name.replace(' ', '_'))
-                                data[sequence_type].update({aro: (acc,
-                                                                  sequence['sequence'])})
-        return data['protein_sequence'], data['dna_sequence']
-
-    def write_seqs(self, seq_dict, seq_file_fp):
+    def write_seqs(self, seq_store, seq_file_fp):
         if not os.path.exists(seq_file_fp):
-            with open(seq_file_fp, 'w') as fh:
-                for seq in seq_dict.values():
-                    fh.write("{}\n{}\n".format(seq[0], seq[1]))
+            with open(seq_file_fp, 'wb') as fh:
+                # first sequence of each ARO
+                seq_store.write_fasta(fh, list(seq_store.index.values()))
 
     def write_proteins(self, seq_file_fp):
         self.write_seqs(self.proteins, seq_file_fp)
@@ -196,41 +944,141 @@ class CARD():
     def write_nucleoties(self, seq_file_fp):
         self.write_seqs(self.nucleotides, seq_file_fp)
 
-    def get_nucleotide_per_family(self):
+    def get_nucleotide_per_family(self, family_dir='family_fasta'):
         """
         Write nucleotides sequences to per family fasta files
+
+        Parameters:
+            family_dir: folder of the per family fasta files
         """
-        if not os.path.exists('family_fasta'):
-            os.mkdir('family_fasta')
-
-        for key, card_item in self.card.items():
-            if card_item['model_type'] in self.supported_models:
-                aro = card_item['ARO_accession']
-                aro_name = card_item['ARO_name']
-                sequences = card_item['model_sequences']['sequence']
-                for seq_ix in sequences:
-                    for sequence_type in sequences[seq_ix]:
-                        if sequence_type == 'dna_sequence':
-                            sequence = sequences[seq_ix][sequence_type]
-                            with open(self.convert_amr_family_to_filename(self.aro_to_gene_family[aro]), 'a') as out_fh:
-                                acc = ">gb|{}|{}|{}|".format(sequence['accession'],
-                                                             aro,
-                                                             aro_name.replace(' ', '_'))
-                                seq = sequence['sequence']
-                                out_fh.write(acc + '\n' + seq + '\n')
-
-    def convert_amr_family_to_filename(self, family):
-        fp = os.path.join('family_fasta', family.replace(' ', '_').replace('/', '_'))
+        if not os.path.exists(family_dir):
+            os.mkdir(family_dir)
+
+        with FamilyWriter() as writer:
+            self.write_families(self.nucleotides, writer, family_dir)
+
+    def write_families(self, store, writer, family_dir='family_fasta'):
+        """
+        Append the records of a SequenceStore to the fasta file of their
+        ARO's gene family in one write per family (records of AROs without
+        a unique gene family are skipped)
+
+        Parameters:
+            store: (SequenceStore) records keyed by ARO
+            writer: (FamilyWriter)
+            family_dir: folder of the per family fasta files
+        """
+        family_fps = np.array([self.convert_amr_family_to_filename(
+                                    self.aro_to_gene_family[aro], family_dir) \
+                                if aro in self.aro_to_gene_family else '' \
+                                for aro in store.aros], dtype=object)
+        family_fps, aro_families = np.unique(family_fps, return_inverse=True)
+        record_families = aro_families[np.asarray(store.aro_ix)]
+        # records grouped by family, in their original order within each
+        order = np.argsort(record_families, kind='stable')
+        breaks = np.flatnonzero(np.diff(record_families[order])) + 1
+        for rows in np.split(order, breaks):
+            if len(rows) > 0 and family_fps[record_families[rows[0]]] != '':
+                writer.write(family_fps[record_families[rows[0]]],
+                             b''.join(store.fasta_blocks(rows)))
+
+    def convert_amr_family_to_filename(self, family, family_dir='family_fasta'):
+        fp = os.path.join(family_dir, family.replace(' ', '_').replace('/', '_'))
         return fp
 
-    def add_prevalence_to_family(self, prevalence_folder):
-        for nt_fp in glob.glob(os.path.join(prevalence_folder, 'nucleotide_fasta_*')):
-            for record in SeqIO.parse(nt_fp, "fasta"):
-                try:
-                    aro = record.description.split('|')[2].replace('ARO:', '')
-                except:
-                    print(record)
-                    assert False
-                with open(self.convert_amr_family_to_filename(self.aro_to_gene_family[aro]), 'a') as out_fh:
-                    SeqIO.write(record, out_fh, "fasta")
+    def add_prevalence_to_family(self, prevalence_folder, cores=1,
+                                 family_dir='family_fasta'):
+        """
+        Add the CARD prevalence alleles to the per family fasta files,
+        reading the nucleotide_fasta_* files in parallel
 
+        Parameters:
+            prevalence_folder: path to the extracted CARD prevalence data
+            cores: (int) number of files read at once
+            family_dir: folder of the per family fasta files
+        """
+        # absolute as worker processes may not share the working directory
+        nt_fps = sorted(os.path.abspath(nt_fp) for nt_fp in glob.glob(
+                            os.path.join(prevalence_folder, 'nucleotide_fasta_*')))
+        with FamilyWriter() as writer:
+            # a batch at a time so only cores files are held in memory
+            for batch in range(0, len(nt_fps), cores):
+                stores = joblib.Parallel(n_jobs=cores)(
+                        joblib.delayed(read_prevalence_fasta)(nt_fp) \
+                                for nt_fp in nt_fps[batch:batch + cores])
+                for nt_fp, store in zip(nt_fps[batch:batch + cores], stores):
+                    logging.info(f"Adding {store.n_records} alleles from {nt_fp}")
+                    self.write_families(store, writer, family_dir)
+
+    def score_novelty(self, sequences, gap_open=align.GAP_OPEN,
+                      gap_extend=align.GAP_EXTEND):
+        """
+        Score how novel each ARG of an isolate is within its gene family by
+        aligning its translation to every reference protein of the family
+        (BLOSUM62 Smith-Waterman, all pairs in one batch)
+
+        The BLAST score ratio (BSR) of a reference is the alignment score
+        over the ARG's score against itself and the ARG's novelty is 1 -
+        its best BSR in the family.
+
+        Parameters:
+            sequences: (dict) {ARO: (ARG name, DNA sequence)} of the ARGs
+                       (see diff.get_unique_sequences)
+            gap_open: (int) penalty of the first residue of a gap
+            gap_extend: (int) penalty of each further residue of a gap
+        Returns:
+            novelty: (pd.df) ARO, ARG name, gene family, references in the
+                     family, best reference ARO, score, self score, BSR and
+                     novelty of each ARG
+        """
+        proteins = {}
+        pairs = []
+        for aro, (arg_name, dna) in sequences.items():
+            aro = str(aro)
+            family = self.aro_to_gene_family.get(aro)
+            if family is None:
+                logging.warning(f"ARO {aro} ({arg_name}) isn't a gene family "
+                                f"member in CARD {self.version}, not scoring "
+                                "its novelty")
+                continue
+            proteins[aro] = translate(dna)
+            # the ARG against itself and then its family's references
+            pairs.append((aro, aro, proteins[aro]))
+            for reference in self.gene_family_to_aro[family]:
+                pairs.append((aro, reference, self.proteins[reference][1]))
+
+        scores = align.smith_waterman([proteins[aro] for aro, _, _ in pairs],
+                                      [protein for _, _, protein in pairs],
+                                      align.substitution_array(blosum62),
+                                      gap_open, gap_extend)
+        pair_scores = pd.DataFrame({'ARO': [aro for aro, _, _ in pairs],
+                                    'Reference': [ref for _, ref, _ in pairs],
+                                    'Score': scores})
+
+        rows = []
+        for aro, (arg_name, _) in sequences.items():
+            aro = str(aro)
+            if aro not in proteins:
+                continue
+            family = self.aro_to_gene_family[aro]
+            arg_scores = pair_scores[pair_scores['ARO'] == aro]
+            self_score = int(arg_scores['Score'].iloc[0])
+            references = arg_scores.iloc[1:]
+            best = references.loc[references['Score'].idxmax()]
+            bsr = best['Score'] / self_score if self_score > 0 else 0.0
+            rows.append([aro, arg_name, family, len(references),
+                         best['Reference'], int(best['Score']), self_score,
+                         bsr, 1 - bsr])
+
+        return pd.DataFrame(rows, columns=['ARO', 'ARG_Name', 'Gene_Family',
+                                           'References', 'Best_Reference_ARO',
+                                           'Score', 'Self_Score', 'BSR',
+                                           'Novelty'])
+
+
+@functools.lru_cache(maxsize=None)
+def load_card(card_json_fp, cache_dir=None):
+    """
+    Load CARD once per process (e.g. shared by a cohort)
+    """
+    return CARD(card_json_fp, cache_dir=cache_dir)
@@ -1,14 +1,28 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import logging
 import pandas as pd
 import os
 import sys
+import threading
+import functools
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+from etd import bundle
+
+# pyplot state is global so only draw one plot at a time
+PLOT_LOCK = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
 def load_metadata(database_dir):
+    etd_bundle = bundle.load_bundle(database_dir)
+    if etd_bundle is not None and 'metadata' in etd_bundle:
+        return pd.read_csv(io.BytesIO(etd_bundle.bytes('metadata')),
+                           sep='\t', compression="gzip")
+
     card_prev_metadata_path = os.path.join(database_dir, "index", "card_prevalence.txt.gz")
     if os.path.exists(card_prev_metadata_path):
         card_prev_metadata_df = pd.read_csv(card_prev_metadata_path,
@@ -55,7 +69,8 @@ def get_genomic_context(aro, amr_name, seq_paths, database_dir):
 
     logging.info(f"Overall mobility for {aro}: {overall_mobility['mean']}")
 
-    generate_context_plots(aro, amr_name, card_prev_data, context_output_dir)
+    with PLOT_LOCK:
+        generate_context_plots(aro, amr_name, card_prev_data, context_output_dir)
 
 
 def generate_context_plots(aro, amr_name, metadata, context_output_dir):
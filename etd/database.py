@@ -8,8 +8,34 @@ import tarfile
 import time
 import json
 import logging
+import io
+import math
+import itertools
+import shutil
+import tempfile
+import threading
+import functools
+import collections
 import joblib
 import subprocess
+import numpy as np
+import pandas as pd
+
+from etd import sketch
+from etd import presence
+from etd import pipeline
+from etd import cache
+from etd import bundle
+from etd import placement
+
+# inputs and outputs of each taxa of the last (possibly interrupted) build
+MANIFEST = 'build_manifest.json'
+
+# genomes per `mash sketch` invocation (and multi-genome sketch file)
+MASH_SKETCH_GROUP = 500
+
+# paths stat'd by each thread pool task when checking the index
+STAT_BATCH = 1024
 
 
 def check_dependencies():
@@ -17,17 +43,33 @@ def check_dependencies():
     Check all dependencies exist and work
     """
     missing=False
-    for program in ['mashtree', 'mash']:
+    tree_builders = []
+    for program, version in [('mash', '--version'), ('mashtree', '--version'),
+                             ('quicktree', '-v')]:
         try:
-            output = subprocess.run([program, '--version'],
+            output = subprocess.run([program, version],
                                     check=True,
                                     stdout=subprocess.PIPE,
                                     encoding='utf-8')
             one_line_output = output.stdout.strip()
             logging.debug(f"Tool {program} is installed: {one_line_output}")
+            if program != 'mash':
+                tree_builders.append(program)
         except:
-            logging.error(f"Tool {program} is not installed")
-            missing = True
+            if program == 'mash':
+                logging.error(f"Tool {program} is not installed")
+                missing = True
+            else:
+                logging.debug(f"Tool {program} is not installed")
+
+    # genome trees are built with mashtree, or quicktree when mashtree can't
+    # be used (see build_mashtree)
+    if len(tree_builders) == 0:
+        logging.error("Tool mashtree (or quicktree) is not installed")
+        missing = True
+    elif 'mashtree' not in tree_builders:
+        logging.warning("Tool mashtree is not installed, genome trees will be "
+                        "built with quicktree")
 
     if missing:
         logging.error("One or more dependencies are missing please install")
@@ -36,77 +78,844 @@ def check_dependencies():
         logging.debug("All dependencies found")
 
 
-def build_db(database_dir, cores):
+def build_db(database_dir, cores, force=False, stream=False, rebuild=(),
+             collapse_distance=sketch.COLLAPSE_DISTANCE):
     """
     Parse the database dir and get the paths to all genomes with paired
     rgi results
-    """
-
-    etd_db = {'accessions': {}, 'amr': {}, 'genome_sketch': None}
-    # accessions -> acc -> rgi
-    #                   -> mashtree
-    # amr        -> aro -> tree
-    # sketch     -> genome_sketch
 
+    Taxa are only extracted, sketched and treed when their tarballs changed
+    since the last build (see the build manifest) so that a new CARD
+    prevalence release or an interrupted build only redoes the affected taxa
+
+    Parameters:
+        database_dir: (str) path to the directory containing card-prev data
+        cores: (int) number of parallel jobs
+        force: (bool) ignore the build manifest and rebuild every taxa
+        stream: (bool) sketch and index the genomes and RGI results straight
+                from the tarballs instead of extracting them
+        rebuild: (set) taxa to rebuild even if their tarballs are unchanged
+                 (e.g. with missing outputs reported by check_index)
+        collapse_distance: (float) mash distance below which genomes are
+                           collapsed into near-duplicate clusters
+    Returns:
+        etd_db: (dict) database index
+    """
     rgi_dir = os.path.join(database_dir, 'rgi_results')
     genome_dir = os.path.join(database_dir, 'genomes')
     etd_db_dir = os.path.join(database_dir, 'etd_db')
     if not os.path.exists(etd_db_dir):
         os.mkdir(etd_db_dir)
 
-    missing_count = 0
-    all_sketches = []
+    manifest = load_manifest(etd_db_dir)
+    if force:
+        logging.info("Forcing rebuild of all taxa")
+        manifest = {'params': sketch.DEFAULT_PARAMS, 'taxa': {},
+                    'reference_sketch': []}
+        mash_sketch_dir = os.path.join(etd_db_dir, 'mash_sketches')
+        if os.path.exists(mash_sketch_dir):
+            shutil.rmtree(mash_sketch_dir)
+
+    taxa_tarballs = {get_taxa(genome_tarball): genome_tarball \
+            for genome_tarball in sorted(glob.glob(os.path.join(genome_dir,
+                                                                '*.tar.gz')))}
+
+    for taxa in sorted(set(manifest['taxa']) - set(taxa_tarballs)):
+        logging.info(f"Removing taxa no longer in the database: {taxa}")
+        remove_taxa_outputs(manifest['taxa'].pop(taxa), database_dir)
+    write_manifest(manifest, etd_db_dir)
+
+    # schedule the taxa that changed, largest first, with cores in
+    # proportion to their size
+    manifest_lock = threading.Lock()
+    jobs = {}
+    to_build = {}
+    for taxa, genome_tarball in taxa_tarballs.items():
+        previous = manifest['taxa'].get(taxa)
+        tarballs = {'genome_tarball': tarball_stats(genome_tarball,
+                                        previous and previous['genome_tarball']),
+                    'rgi_tarball': tarball_stats(get_rgi_tarball(genome_tarball,
+                                                                 rgi_dir),
+                                        previous and previous['rgi_tarball'])}
+        taxa_fingerprint = pipeline.fingerprint(
+                dict({name: stats and stats['sha256'] \
+                        for name, stats in tarballs.items()},
+                     collapse_distance=collapse_distance))
+
+        if previous is not None and previous['fingerprint'] == taxa_fingerprint \
+                and taxa not in rebuild:
+            logging.info(f"Taxa unchanged since last build: {taxa}")
+            # keep refreshed size/mtime so the checksum isn't recomputed
+            previous.update(tarballs)
+            continue
+
+        if previous is not None and previous['fingerprint'] is not None:
+            logging.info(f"Taxa changed since last build: {taxa}")
+            if len(previous.get('added', [])) > 0:
+                logging.warning(f"Removing {len(previous['added'])} genomes "
+                                f"added to {taxa} with `etd.py database add`")
+            remove_stale_files(taxa, genome_tarball, rgi_dir, database_dir,
+                               previous, tarballs)
+            # mark as in progress so a resumed build keeps partial files
+            manifest['taxa'][taxa] = dict(tarballs, fingerprint=None,
+                                          accessions={}, outputs={})
+        elif previous is not None:
+            logging.info(f"Resuming interrupted build of taxa: {taxa}")
+        to_build[taxa] = (genome_tarball, tarballs, taxa_fingerprint)
+    write_manifest(manifest, etd_db_dir)
+
+    total_size = sum(tarballs['genome_tarball']['size'] \
+                        for _, tarballs, _ in to_build.values())
+    for taxa, (genome_tarball, tarballs, taxa_fingerprint) in to_build.items():
+        size = tarballs['genome_tarball']['size']
+        taxa_cores = max(1, min(cores, math.ceil(cores * size / \
+                                                 max(total_size, 1))))
+
+        def finished(record, taxa=taxa, taxa_fingerprint=taxa_fingerprint):
+            record['fingerprint'] = taxa_fingerprint
+            record['collapse_distance'] = collapse_distance
+            # record progress so an interrupted build resumes from here
+            with manifest_lock:
+                manifest['taxa'][taxa] = record
+                write_manifest(manifest, etd_db_dir)
+
+        jobs.update(taxa_jobs(taxa, genome_tarball, rgi_dir, database_dir,
+                              tarballs, taxa_cores, -size, finished, stream,
+                              collapse_distance))
+
+    if len(to_build) > 0:
+        logging.info(f"Building {len(to_build)} taxa with {cores} cores")
+        pipeline.run_jobs(jobs, cores)
+
+    etd_db = assemble_db(database_dir, manifest, cores)
+
+    logging.info(f"Database index written with "
+                 f"{len(etd_db['accessions'])} accessions")
+
+    return etd_db
+
+
+def get_taxa(genome_tarball):
+    """
+    Taxa name of a genome tarball
+    """
+    return os.path.basename(genome_tarball).replace('.tar.gz', '')
+
+
+def get_rgi_tarball(genome_tarball, rgi_dir):
+    """
+    Path of the RGI results tarball paired with a genome tarball
+    """
+    rgi_tarball = os.path.join(rgi_dir, os.path.basename(genome_tarball))
+    # genomes contain FASTA and the rgi_results contain NCBI so swap
+    return rgi_tarball.replace('FASTA', 'NCBI')
+
+
+def tarball_stats(tarball, previous=None):
+    """
+    Size, modification time and checksum of a tarball, reusing the previous
+    checksum when the size and modification time haven't changed
+
+    Parameters:
+        tarball: path to the tarball
+        previous: (dict) stats recorded by the last build or None
+    Returns:
+        stats: (dict) {'size', 'mtime', 'sha256'} or None if missing
+    """
+    if not os.path.exists(tarball):
+        return None
+    stat = os.stat(tarball)
+    stats = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if previous is not None and previous['size'] == stats['size'] \
+            and previous['mtime'] == stats['mtime']:
+        stats['sha256'] = previous['sha256']
+    else:
+        logging.debug(f"Computing checksum of {tarball}")
+        stats['sha256'] = cache.file_digest(tarball)
+    return stats
+
+
+def load_manifest(etd_db_dir):
+    """
+    Load the build manifest recording the inputs and outputs of each taxa
+
+    build_manifest.json
+        params              reference sketch parameters
+        taxa -> taxa -> genome_tarball     size, mtime and sha256
+                     -> rgi_tarball        size, mtime and sha256 (or None)
+                     -> fingerprint        of the tarball checksums
+                     -> built              time the taxa was built
+                     -> accessions -> acc  index entry with its taxon_row
+                     -> outputs            per-taxa sketch, mash sketch,
+                                           genome tree, ARGs and added genomes
+                     -> directories        mtimes of the extracted genome
+                                           and RGI result directories
+                     -> added              accessions added with
+                                           `etd.py database add`
+        reference_sketch    [taxa, build time, first taxa row, last taxa
+                             row + 1] blocks in combined sketch order
+    (paths are relative to the database_dir)
+    """
+    manifest_fp = os.path.join(etd_db_dir, MANIFEST)
+    manifest = None
+    if os.path.exists(manifest_fp):
+        with open(manifest_fp) as fh:
+            manifest = json.load(fh)
+        if manifest.get('params') != sketch.DEFAULT_PARAMS:
+            logging.info("Sketch parameters changed: rebuilding all taxa")
+            manifest = None
+    if manifest is None:
+        manifest = {'params': sketch.DEFAULT_PARAMS, 'taxa': {},
+                    'reference_sketch': []}
+    return manifest
+
+
+def write_manifest(manifest, etd_db_dir):
+    """
+    Atomically replace the build manifest
+    """
+    manifest_fp = os.path.join(etd_db_dir, MANIFEST)
+    with open(manifest_fp + '.tmp', 'w') as fh:
+        json.dump(manifest, fh)
+    os.replace(manifest_fp + '.tmp', manifest_fp)
+
 
-    for genome_tarball in glob.glob(os.path.join(genome_dir, '*.tar.gz')):
+def remove_taxa_outputs(record, database_dir):
+    """
+    Remove the outputs built for a taxa
+    """
+    for output in record['outputs'].values():
+        output = os.path.join(database_dir, output)
+        if os.path.isdir(output):
+            shutil.rmtree(output)
+        elif os.path.exists(output):
+            os.remove(output)
 
+
+def remove_stale_files(taxa, genome_tarball, rgi_dir, database_dir, previous,
+                       tarballs):
+    """
+    Remove the outputs, extracted files and genome sketches of a taxa whose
+    tarballs changed since the last build
+    """
+    remove_taxa_outputs(previous, database_dir)
+    stale = [genome_tarball.replace('.tar.gz', ''),
+             os.path.join(database_dir, 'etd_db', 'mash_sketches', taxa)]
+    if previous['rgi_tarball'] != tarballs['rgi_tarball']:
+        stale.append(get_rgi_tarball(genome_tarball,
+                                     rgi_dir).replace('.tar.gz', ''))
+    for path in stale:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+
+def taxa_jobs(taxa, genome_tarball, rgi_dir, database_dir, tarballs, cores,
+              priority, finished, stream=False,
+              collapse_distance=sketch.COLLAPSE_DISTANCE):
+    """
+    Jobs extracting, sketching and building the genome tree of one taxa for
+    pipeline.run_jobs so that the stages of different taxa overlap
+
+        extract -> mash sketch -------> genome tree -> finish
+                -> reference sketch ---^--------------^
+                -> ARGs ------------------------------^
+
+    (the genome tree joins the leaders of the near-duplicate clusters of the
+    reference sketch and grafts the rest of the genomes onto them)
+
+    or when streaming the tarballs (see stream_taxa)
+
+        stream -> genome tree -> finish
+
+    Parameters:
+        taxa: (str) taxa name
+        genome_tarball: path to the taxa's genome tarball
+        rgi_dir: path to the RGI results tarballs
+        database_dir: (str) path to the directory containing card-prev data
+        tarballs: (dict) current tarball stats (see tarball_stats)
+        cores: (int) number of cores for the sketching and tree jobs
+        priority: sort key of the taxa (lower starts first)
+        finished: callable taking the taxa's manifest record
+        stream: (bool) read the tarballs without extracting them
+        collapse_distance: (float) mash distance below which genomes are
+                           collapsed into near-duplicate clusters
+    Returns:
+        jobs: (dict) {job name: (function, dependencies, cores, priority)}
+    """
+    etd_db_dir = os.path.join(database_dir, 'etd_db')
+    taxa_dir = os.path.join(etd_db_dir, 'taxa', taxa)
+    taxa_sketch_dir = os.path.join(taxa_dir, 'sketch')
+    mash_dir = os.path.join(etd_db_dir, 'mash_sketches', taxa)
+
+    def extract(results):
+        if os.path.exists(taxa_dir):
+            shutil.rmtree(taxa_dir)
+        os.makedirs(taxa_dir)
         # get the files to use in the database
         seqs_to_use, rgi_to_use, \
-                genomes_to_use, rgi_folder = get_files(genome_tarball,
-                                                       rgi_dir)
-
-        # sketch all the genomes
-        sketches = create_genome_sketches(genomes_to_use, etd_db_dir, cores)
-        # add to list of all sketches for combining
-        all_sketches.extend(sketches)
-
-        ## build mashtree
-        mashtree = build_mashtree(sketches, etd_db_dir, cores)
-
-        # add to the database
-        for accession in seqs_to_use:
-            entry = {}
-            entry['rgi'] = os.path.join(rgi_folder, accession) + ".json"
-            entry['genome_tree'] = mashtree
-            etd_db['accessions'][accession] = entry
+                genomes_to_use, rgi_folder = get_files(genome_tarball, rgi_dir)
+        if len(genomes_to_use) == 0:
+            logging.warning(f"No genomes with paired RGI results for taxa: {taxa}")
+        return list(seqs_to_use), genomes_to_use, rgi_folder
+
+    def mash_sketch(results):
+        _, genomes_to_use, _ = results[f"{taxa}:extract"]
+        if len(genomes_to_use) == 0:
+            return []
+        return create_genome_sketches(genomes_to_use, mash_dir, cores)
+
+    def reference_sketch(results):
+        # memory-mapped MinHash sketches of the taxa
+        _, genomes_to_use, _ = results[f"{taxa}:extract"]
+        if len(genomes_to_use) == 0:
+            return {}
+        sketch.create_reference_sketch(taxa_sketch_dir)
+        sketch_rows = sketch.add_to_reference_sketch(taxa_sketch_dir, taxa,
+                                                     genomes_to_use, cores)
+        sketch.build_representatives(taxa_sketch_dir, cores)
+        sketch.cluster_sketches(taxa_sketch_dir, collapse_distance, cores)
+        return sketch_rows
+
+    def genome_args(results):
+        # ARGs of each genome in taxa sketch row order
+        seqs_to_use, _, rgi_folder = results[f"{taxa}:extract"]
+        args = presence.read_genome_args(
+                [os.path.join(rgi_folder, accession) + ".json" \
+                        for accession in seqs_to_use], 1)
+        with open(os.path.join(taxa_dir, 'genome_args.json'), 'w') as fh:
+            json.dump([sorted(genome) for genome in args], fh)
+
+    def stream_tarballs(results):
+        if os.path.exists(taxa_dir):
+            shutil.rmtree(taxa_dir)
+        os.makedirs(taxa_dir)
+        return stream_taxa(taxa, genome_tarball, rgi_dir, database_dir, cores,
+                           collapse_distance)
+
+    def mashtree(results):
+        if stream:
+            # the genomes are never extracted for mashtree to read
+            sketches = results[f"{taxa}:stream"][1]
+            genome_fps = None
+        else:
+            sketches = results[f"{taxa}:mash_sketch"]
+            seqs_to_use, genomes_to_use, _ = results[f"{taxa}:extract"]
+            genome_fps = dict(zip(seqs_to_use, genomes_to_use))
+        if len(sketches) == 0:
+            return None
+        return build_mashtree(sketches, taxa, etd_db_dir, cores,
+                              collapsed_genomes(taxa_sketch_dir), genome_fps)
+
+    def finish(results):
+        if stream:
+            entries, _ = results[f"{taxa}:stream"]
+        else:
+            seqs_to_use, genomes_to_use, rgi_folder = results[f"{taxa}:extract"]
+            sketch_rows = results[f"{taxa}:reference_sketch"]
+            entries = {}
+            for accession, genome in zip(seqs_to_use, genomes_to_use):
+                entry = {}
+                entry['rgi'] = os.path.relpath(os.path.join(rgi_folder, accession) \
+                                                + ".json", database_dir)
+                entry['genome'] = os.path.relpath(genome, database_dir)
+                entry['taxon'] = taxa
+                entry['taxon_row'] = sketch_rows[accession]
+                entries[accession] = entry
+
+        finished(taxa_record(taxa, database_dir, tarballs, entries,
+                             results[f"{taxa}:mashtree"]))
+
+    if stream:
+        stream_job = f"{taxa}:stream"
+        return {stream_job: (stream_tarballs, [], cores, (priority, 0)),
+                f"{taxa}:mashtree": (mashtree, [stream_job], cores,
+                                     (priority, 2)),
+                f"{taxa}:finish": (finish, [f"{taxa}:mashtree"], 1,
+                                   (priority, 3))}
+
+    extract_job = f"{taxa}:extract"
+    return {extract_job: (extract, [], 1, (priority, 0)),
+            f"{taxa}:mash_sketch": (mash_sketch, [extract_job], cores,
+                                    (priority, 1)),
+            f"{taxa}:reference_sketch": (reference_sketch, [extract_job],
+                                         cores, (priority, 1)),
+            f"{taxa}:genome_args": (genome_args, [extract_job], 1,
+                                    (priority, 1)),
+            f"{taxa}:mashtree": (mashtree, [f"{taxa}:mash_sketch",
+                                            f"{taxa}:reference_sketch"],
+                                 cores, (priority, 2)),
+            f"{taxa}:finish": (finish, [f"{taxa}:mashtree",
+                                        f"{taxa}:reference_sketch",
+                                        f"{taxa}:genome_args"], 1,
+                               (priority, 3))}
+
+
+def taxa_record(taxa, database_dir, tarballs, entries, mashtree):
+    """
+    Manifest record of a built taxa
+
+    Parameters:
+        taxa: (str) taxa name
+        database_dir: (str) path to the directory containing card-prev data
+        tarballs: (dict) current tarball stats (see tarball_stats)
+        entries: (dict) {accession: index entry}
+        mashtree: path to the genome tree of the taxa
+    Returns:
+        record: (dict) manifest record of the taxa
+    """
+    etd_db_dir = os.path.join(database_dir, 'etd_db')
+    record = dict(tarballs)
+    # identifies this build of the taxa sketch in the reference sketch
+    record['built'] = time.time()
+    record['accessions'] = {}
+    record['outputs'] = {
+            'taxa': os.path.relpath(os.path.join(etd_db_dir, 'taxa', taxa),
+                                    database_dir),
+            'mash_sketch': os.path.relpath(os.path.join(etd_db_dir,
+                                                        'mash_sketches', taxa),
+                                           database_dir)}
+    if len(entries) == 0:
+        return record
+
+    record['outputs']['genome_tree'] = os.path.relpath(mashtree, database_dir)
+
+    # add to the database
+    for accession, entry in entries.items():
+        entry['genome_tree'] = os.path.relpath(mashtree, database_dir)
+        record['accessions'][accession] = entry
 
-    ## combine/simplify sketches
-    card_prev_sketch = combine_mash_sketches(all_sketches, etd_db_dir, cores)
-    etd_db['genome_sketch'] = card_prev_sketch
+    record['directories'] = entry_directories(record['accessions'],
+                                              database_dir)
 
-    # prepare AMR phylogenies
-    card = get_card(args.version)
+    return record
 
-    # generate
 
+def entry_directories(entries, database_dir):
+    """
+    Modification times of the directories holding the extracted genomes and
+    RGI results of index entries (see check_index)
+
+    Parameters:
+        entries: (dict) {accession: index entry}
+        database_dir: (str) path to the directory containing card-prev data
+    Returns:
+        directories: (dict) {directory relative to database_dir: mtime}
+    """
+    directories = set(os.path.dirname(os.path.join(database_dir, entry[artifact])) \
+                        for entry in entries.values() \
+                        for artifact in ['genome', 'rgi'] \
+                        if artifact + '_member' not in entry)
+    return {os.path.relpath(directory, database_dir): \
+                os.stat(directory).st_mtime for directory in directories}
+
+
+def stream_taxa(taxa, genome_tarball, rgi_dir, database_dir, cores,
+                collapse_distance=sketch.COLLAPSE_DISTANCE):
+    """
+    Sketch the genomes of a taxa and read their ARGs while streaming the
+    tarballs so the genome and RGI folders are never extracted
+
+    mash only sketches files so each group of MASH_SKETCH_GROUP genomes is
+    written to a temporary directory as the members are read, sketched (with
+    mash and the MinHash sketch) and removed, so a single genome at a time is
+    held in memory.
+
+    The index entries point at the tarballs and name the genome_member and
+    rgi_member of each accession.
+
+    Parameters:
+        taxa: (str) taxa name
+        genome_tarball: path to the taxa's genome tarball
+        rgi_dir: path to the RGI results tarballs
+        database_dir: (str) path to the directory containing card-prev data
+        cores: (int) number of parallel sketching jobs
+        collapse_distance: (float) mash distance below which genomes are
+                           collapsed into near-duplicate clusters
+    Returns:
+        entries: (dict) {accession: index entry}
+        sketches: (list) multi-genome mash sketches (see create_genome_sketches)
+    """
+    etd_db_dir = os.path.join(database_dir, 'etd_db')
+    taxa_dir = os.path.join(etd_db_dir, 'taxa', taxa)
+
+    # RGI results are small so are read first to pick the genomes to sketch
+    rgi_tarball = get_rgi_tarball(genome_tarball, rgi_dir)
+    rgi_members = {}
+    rgi_args = {}
+    if os.path.exists(rgi_tarball):
+        logging.info(f"Streaming RGI results: {rgi_tarball}")
+        for member, data in sketch.iter_tar_members(rgi_tarball,
+                                                    ('.json', '.txt')):
+            if member.endswith('.json'):
+                rgi_members[os.path.basename(member).replace('.json', '')] = member
+            else:
+                rgi = pd.read_csv(io.BytesIO(data), sep='\t')
+                rgi_args[os.path.basename(member).replace('.txt', '')] = \
+                        presence.table_args(rgi)
+    no_table = set(rgi_members) - set(rgi_args)
+    if len(no_table) > 0:
+        logging.warning(f"{len(no_table)} rgi tables missing in {rgi_tarball}: {no_table}")
+
+    mash_dir = os.path.join(etd_db_dir, 'mash_sketches', taxa)
+    if os.path.exists(mash_dir):
+        shutil.rmtree(mash_dir)
+    os.makedirs(mash_dir)
+    genome_members = {}
+    genome_accessions = set()
+
+    def paired_genomes():
+        for member, data in sketch.iter_tar_members(genome_tarball, ('.fa',)):
+            accession = os.path.basename(member).replace('.fa', '')
+            genome_accessions.add(accession)
+            if accession in rgi_members and accession in rgi_args:
+                genome_members[accession] = member
+                yield accession, data
+
+    logging.info(f"Streaming and sketching genomes for taxa: {taxa}")
+    genomes = paired_genomes()
+    sketches = []
+    hashes = []
+    while True:
+        # mash needs files so each group of genomes is only written to a
+        # temporary directory while it is sketched.  Members are written out
+        # as they are read so only one genome is held in memory at a time.
+        with tempfile.TemporaryDirectory(dir=mash_dir) as tmp_dir:
+            genome_fps = []
+            for accession, data in itertools.islice(genomes,
+                                                    MASH_SKETCH_GROUP):
+                genome_fp = os.path.join(tmp_dir, accession + '.fa')
+                with open(genome_fp, 'wb') as fh:
+                    fh.write(data)
+                genome_fps.append(genome_fp)
+            if len(genome_fps) == 0:
+                break
+            hashes.extend(joblib.Parallel(n_jobs=cores)(
+                    joblib.delayed(sketch.sketch_genome)(genome_fp) \
+                            for genome_fp in genome_fps))
+            sketches.append(sketch_mash_group(genome_fps, mash_dir,
+                                              len(sketches), cores))
+
+    rgi_only = set(rgi_members) - genome_accessions
+    if len(rgi_only) > 0:
+        logging.warning(f"{len(rgi_only)} genomes missing in {genome_tarball}: {rgi_only}")
+    genome_only = genome_accessions - set(rgi_members)
+    if len(genome_only) > 0:
+        logging.warning(f"{len(genome_only)} rgi output missing in {rgi_tarball}: {genome_only}")
+
+    if len(hashes) == 0:
+        logging.warning(f"No genomes with paired RGI results for taxa: {taxa}")
+        return {}, []
+
+    # memory-mapped MinHash sketches and ARGs of the taxa in the same order
+    accessions = list(genome_members)
+    taxa_sketch = os.path.join(taxa_dir, 'sketch')
+    sketch.create_reference_sketch(taxa_sketch)
+    sketch.append_sketches(taxa_sketch, accessions, taxa, hashes)
+    sketch.build_representatives(taxa_sketch, cores)
+    sketch.cluster_sketches(taxa_sketch, collapse_distance, cores)
+    with open(os.path.join(taxa_dir, 'genome_args.json'), 'w') as fh:
+        json.dump([sorted(rgi_args[accession]) for accession in accessions], fh)
+
+    entries = {}
+    for row, accession in enumerate(accessions):
+        entries[accession] = {'rgi': os.path.relpath(rgi_tarball, database_dir),
+                              'rgi_member': rgi_members[accession],
+                              'genome': os.path.relpath(genome_tarball,
+                                                        database_dir),
+                              'genome_member': genome_members[accession],
+                              'taxon': taxa,
+                              'taxon_row': row}
+
+    return entries, sketches
+
+
+def assemble_db(database_dir, manifest, cores):
+    """
+    Combine the per-taxa outputs of the manifest into the reference sketch,
+    presence matrix and index used by `etd.py run`
+
+    The reference sketch is only appended to when the taxa it already holds
+    are unchanged (new taxa and genomes added to a taxa since are appended),
+    otherwise it is rebuilt by copying the per-taxa sketches.
+
+    Parameters:
+        database_dir: (str) path to the directory containing card-prev data
+        manifest: (dict) build manifest (see load_manifest)
+        cores: (int) number of parallel jobs
+    Returns:
+        etd_db: (dict) database index
+    """
+    etd_db = {'accessions': {}, 'amr': {}, 'genome_sketch': None}
+    # accessions -> acc -> rgi
+    #                   -> genome
+    #                   -> genome_tree
+    #                   -> taxon
+    #                   -> taxon_row (row in the taxa sketch)
+    #                   -> sketch (row in reference sketch)
+    # amr        -> aro -> tree
+    # sketch     -> genome_sketch
+    # (paths are relative to the database_dir)
+    etd_db_dir = os.path.join(database_dir, 'etd_db')
+    taxa_records = {taxa: record for taxa, record in manifest['taxa'].items() \
+                        if len(record['accessions']) > 0}
+
+    # memory-mapped MinHash sketches used by `etd.py run` made of blocks of
+    # rows copied from the per-taxa sketches: one per built taxa plus one
+    # for each batch of genomes added with `etd.py database add`
+    reference_sketch_dir = os.path.join(etd_db_dir, 'sketch')
+    combined = manifest['reference_sketch']
+    covered = {}
+    current = os.path.exists(reference_sketch_dir)
+    for block in combined:
+        # [taxa, build time, first taxa row, last taxa row + 1]
+        if not current or len(block) != 4 or block[0] not in taxa_records or \
+                taxa_records[block[0]].get('built') != block[1] or \
+                covered.get(block[0], 0) != block[2] or \
+                len(taxa_records[block[0]]['accessions']) < block[3]:
+            current = False
+            break
+        covered[block[0]] = block[3]
+    if current and len(sketch.ReferenceSketch(reference_sketch_dir)) == \
+            sum(stop - start for _, _, start, stop in combined):
+        logging.info("Appending to the reference sketch")
+    else:
+        sketch.create_reference_sketch(reference_sketch_dir)
+        combined = []
+        covered = {}
+        logging.info(f"Rebuilding the reference sketch from "
+                     f"{len(taxa_records)} taxa")
+    for taxa, record in sorted(taxa_records.items()):
+        block = [taxa, record.get('built'), covered.get(taxa, 0),
+                 len(record['accessions'])]
+        if block[2] < block[3]:
+            taxa_dir = os.path.join(database_dir, record['outputs']['taxa'])
+            sketch.append_reference_sketch(reference_sketch_dir,
+                                           os.path.join(taxa_dir, 'sketch'),
+                                           first_source_row=block[2])
+            combined.append(block)
+    manifest['reference_sketch'] = combined
+    write_manifest(manifest, etd_db_dir)
+
+    # rows of each taxa sketch in the reference sketch
+    combined_rows = {taxa: np.zeros(len(record['accessions']), dtype=np.int64) \
+                        for taxa, record in taxa_records.items()}
+    first_row = 0
+    for taxa, _, start, stop in combined:
+        combined_rows[taxa][start:stop] = np.arange(first_row,
+                                                    first_row + stop - start)
+        first_row += stop - start
+
+    # index, representatives, near-duplicate clusters and ARGs in reference
+    # sketch order
+    representatives = {}
+    leaders = np.arange(first_row)
+    leader_distances = np.zeros(first_row)
+    taxa_args = {}
+    for taxa, record in taxa_records.items():
+        rows = combined_rows[taxa]
+        taxa_dir = os.path.join(database_dir, record['outputs']['taxa'])
+        for accession, entry in record['accessions'].items():
+            entry = dict(entry)
+            entry['sketch'] = int(rows[entry['taxon_row']])
+            etd_db['accessions'][accession] = entry
 
+        taxa_sketch = sketch.ReferenceSketch(os.path.join(taxa_dir, 'sketch'))
+        representatives[taxa] = \
+                (rows[taxa_sketch.representatives['row'].values].tolist(),
+                 taxa_sketch.representatives['radius'].max())
+        if taxa_sketch.leaders is not None:
+            leaders[rows] = rows[taxa_sketch.leaders]
+            leader_distances[rows] = taxa_sketch.leader_distances
+
+        with open(os.path.join(taxa_dir, 'genome_args.json')) as fh:
+            taxa_args[taxa] = json.load(fh)
+    genome_args = [args for taxa, _, start, stop in combined \
+                        for args in taxa_args[taxa][start:stop]]
+
+    # representatives of each taxa to route queries and the clusters whose
+    # leaders are searched first
+    sketch.write_representatives(reference_sketch_dir, representatives)
+    sketch.write_clusters(reference_sketch_dir, leaders, leader_distances)
+    etd_db['reference_sketch'] = os.path.relpath(reference_sketch_dir,
+                                                 database_dir)
+
+    # multi-genome mash sketches of every taxa (mash_sketches/<taxa>/*.msh)
+    # replace the single pasted card_prev.msh of earlier builds
+    card_prev_sketch = os.path.join(etd_db_dir, 'card_prev.msh')
+    if os.path.exists(card_prev_sketch):
+        os.remove(card_prev_sketch)
+    etd_db['genome_sketch'] = os.path.relpath(os.path.join(etd_db_dir,
+                                                           'mash_sketches'),
+                                              database_dir)
+
+    # genome x ARG presence matrix with rows matching the reference sketch
+    presence_dir = os.path.join(etd_db_dir, 'presence')
+    presence.write_presence_matrix(genome_args, presence_dir)
+    etd_db['presence'] = os.path.relpath(presence_dir, database_dir)
 
     with open(os.path.join(etd_db_dir, 'etd_db_index.json'), 'w') as fh:
         json.dump(etd_db, fh)
 
-    print(etd_db)
+    # single memory-mappable file used by `etd.py run`
+    bundle.write_database_bundle(database_dir, etd_db)
 
     return etd_db
 
 
+def add_genomes(database_dir, taxa, genome_fps, rgi_dir, cores):
+    """
+    Add genomes with their RGI results to a taxa of a built database without
+    rebuilding it
+
+    The genomes are copied to etd_db/added/<taxa>, sketched and appended to
+    the taxa sketch (keeping its representatives and near-duplicate
+    clusters), sketched with mash into a
+    new multi-genome sketch of the taxa and grafted into the taxa's genome
+    tree using their distances to its genomes (see placement.graft).  Only
+    the new rows are then appended to the reference sketch so the cost of
+    adding genomes grows with their number rather than the database size
+    (apart from rewriting the index, presence matrix and bundle).
+
+    Parameters:
+        database_dir: (str) path to the directory containing card-prev data
+        taxa: (str) taxa to add the genomes to
+        genome_fps: (list) paths to the genome fastas (named <accession>.fa)
+        rgi_dir: path to the RGI results (<accession>.json and .txt) of the
+                 genomes
+        cores: (int) number of parallel jobs
+    Returns:
+        etd_db: (dict) database index
+    """
+    etd_db_dir = os.path.join(database_dir, 'etd_db')
+    manifest = load_manifest(etd_db_dir)
+    record = manifest['taxa'].get(taxa)
+    if record is None or record['fingerprint'] is None or \
+            len(record['accessions']) == 0:
+        logging.error(f"Taxa {taxa} isn't in the built database, build it "
+                      f"with `etd.py database` first (built taxa: "
+                      f"{sorted(manifest['taxa'])})")
+        sys.exit(1)
+
+    # genomes with RGI results that aren't already in the database
+    indexed = set(accession for taxa_record in manifest['taxa'].values() \
+                    for accession in taxa_record['accessions'])
+    to_add = {}
+    for genome_fp in genome_fps:
+        accession = os.path.splitext(os.path.basename(genome_fp))[0]
+        rgi_fp = os.path.join(rgi_dir, accession + '.json')
+        if accession in indexed or accession in to_add:
+            logging.warning(f"{accession} is already in the database, skipping")
+        elif not os.path.exists(rgi_fp):
+            logging.warning(f"No RGI results for {accession} ({rgi_fp}), skipping")
+        else:
+            to_add[accession] = (genome_fp, rgi_fp)
+    if len(to_add) == 0:
+        logging.error("No genomes to add")
+        sys.exit(1)
+
+    # mark as in progress so an interrupted add rebuilds the taxa
+    taxa_fingerprint = record['fingerprint']
+    record['fingerprint'] = None
+    write_manifest(manifest, etd_db_dir)
+
+    logging.info(f"Adding {len(to_add)} genomes to taxa: {taxa}")
+    added_dir = os.path.join(etd_db_dir, 'added', taxa)
+    os.makedirs(added_dir, exist_ok=True)
+    entries = {}
+    for accession, (genome_fp, rgi_fp) in to_add.items():
+        shutil.copyfile(genome_fp, os.path.join(added_dir, accession + '.fa'))
+        shutil.copyfile(rgi_fp, os.path.join(added_dir, accession + '.json'))
+        table_fp = presence.rgi_table_path(rgi_fp)
+        if table_fp != rgi_fp:
+            shutil.copyfile(table_fp, os.path.join(added_dir, accession + '.txt'))
+        entries[accession] = {
+                'rgi': os.path.relpath(os.path.join(added_dir, accession + '.json'),
+                                       database_dir),
+                'genome': os.path.relpath(os.path.join(added_dir, accession + '.fa'),
+                                          database_dir),
+                'taxon': taxa}
+    accessions = list(entries)
+    added_genomes = [os.path.join(database_dir, entries[accession]['genome']) \
+                        for accession in accessions]
+
+    # taxa sketch and ARGs (in taxa sketch row order)
+    taxa_dir = os.path.join(database_dir, record['outputs']['taxa'])
+    taxa_sketch_dir = os.path.join(taxa_dir, 'sketch')
+    taxa_sketch = sketch.ReferenceSketch(taxa_sketch_dir)
+    representatives = taxa_sketch.representatives
+    clusters = None
+    if taxa_sketch.leaders is not None:
+        clusters = (taxa_sketch.leaders, taxa_sketch.leader_distances)
+    sketch_rows = sketch.add_to_reference_sketch(taxa_sketch_dir, taxa,
+                                                 added_genomes, cores)
+    if representatives is None:
+        sketch.build_representatives(taxa_sketch_dir, cores)
+    else:
+        sketch.extend_representatives(taxa_sketch_dir, representatives,
+                                      list(sketch_rows.values()))
+    # added genomes join the clusters of the genomes they duplicate
+    sketch.cluster_sketches(taxa_sketch_dir,
+                            record.get('collapse_distance',
+                                       sketch.COLLAPSE_DISTANCE),
+                            cores, clusters)
+    for accession in accessions:
+        entries[accession]['taxon_row'] = sketch_rows[accession]
+
+    genome_args_fp = os.path.join(taxa_dir, 'genome_args.json')
+    with open(genome_args_fp) as fh:
+        genome_args = json.load(fh)
+    genome_args.extend(sorted(args) for args in presence.read_genome_args(
+            [os.path.join(database_dir, entries[accession]['rgi']) \
+                for accession in accessions], cores))
+    with open(genome_args_fp, 'w') as fh:
+        json.dump(genome_args, fh)
+
+    # new multi-genome mash sketch alongside the taxa's existing ones
+    mash_dir = os.path.join(database_dir, record['outputs']['mash_sketch'])
+    os.makedirs(mash_dir, exist_ok=True)
+    groups = len(glob.glob(os.path.join(mash_dir, 'group_*.msh')))
+    for group, start in enumerate(range(0, len(added_genomes),
+                                        MASH_SKETCH_GROUP)):
+        sketch_mash_group(added_genomes[start:start + MASH_SKETCH_GROUP],
+                          mash_dir, groups + group, cores)
+
+    # graft each genome next to its closest relatives (including the
+    # genomes grafted before it)
+    tree_fp = os.path.join(database_dir, record['outputs']['genome_tree'])
+    tree, leaves = placement.read_tree(tree_fp)
+    taxa_sketch = sketch.ReferenceSketch(taxa_sketch_dir)
+    for accession in accessions:
+        row = sketch_rows[accession]
+        distances = taxa_sketch.distances(taxa_sketch.row_sketch(row),
+                                          np.arange(row))
+        placement.graft(tree, leaves, accession,
+                        dict(zip(taxa_sketch.names[:row], distances)))
+    placement.write_tree(tree, tree_fp)
+    logging.info(f"Grafted {len(accessions)} genomes into {tree_fp}")
+
+    for accession, entry in entries.items():
+        entry['genome_tree'] = record['outputs']['genome_tree']
+        record['accessions'][accession] = entry
+    record['added'] = record.get('added', []) + accessions
+    record['outputs']['added'] = os.path.relpath(added_dir, database_dir)
+    record['directories'] = entry_directories(record['accessions'],
+                                              database_dir)
+    record['fingerprint'] = taxa_fingerprint
+    write_manifest(manifest, etd_db_dir)
+
+    etd_db = assemble_db(database_dir, manifest, cores)
+    logging.info(f"Database index written with "
+                 f"{len(etd_db['accessions'])} accessions")
+    return etd_db
+
+
 def get_files(genome_tarball, rgi_dir):
     """
     Handle extracting and gathering the genomes with paired RGI predictions
     """
     genome_folder = genome_tarball.replace('.tar.gz', '')
     # check if there is a corresponding rgi tarball
-    rgi_tarball = os.path.join(rgi_dir, os.path.basename(genome_tarball))
-    # genomes contain FASTA and the rgi_results contain NCBI so swap
-    rgi_tarball = rgi_tarball.replace('FASTA', 'NCBI')
+    rgi_tarball = get_rgi_tarball(genome_tarball, rgi_dir)
     rgi_folder = rgi_tarball.replace('.tar.gz', '')
 
     # rgi_results extract
@@ -152,139 +961,380 @@ def execute_cmd(cmd):
                     stderr=subprocess.DEVNULL)
 
 
-def combine_mash_sketches(sketches, etd_db_dir, cores):
+def build_mashtree(sketches, taxa, etd_db_dir, cores, clusters={},
+                   genome_fps=None):
     """
-    Combine all the mash sketches using paste
+    Build the genome tree of a taxa with mashtree
+
+    mashtree only reads genome fastas or single-genome sketches, so when the
+    genomes aren't extracted (streamed builds) or mashtree isn't installed
+    the tree is built as mashtree builds it (quicktree neighbour-joining of
+    the `mash triangle` distances) directly from the multi-genome sketches
+    of the taxa.
+
+    Only the leaders of near-duplicate clusters are joined, the collapsed
+    genomes are grafted next to their leader afterwards (see
+    placement.graft_clusters) so the cubic neighbour-joining shrinks with the
+    redundancy of the taxa.
+
+    Parameters:
+        sketches: (list) multi-genome mash sketches of the taxa
+        taxa: (str) taxa name
+        etd_db_dir: path to the etd_db directory
+        cores: (int) number of mash threads
+        clusters: (dict) {leader: {collapsed genome: distance to the leader}}
+        genome_fps: (dict) {genome: path to its fasta} for mashtree or None
+    Returns:
+        mashtree_fp: path to the genome tree
     """
-    card_prev_msh_fp = os.path.join(etd_db_dir, 'card_prev.msh')
-
-    if os.path.exists(card_prev_msh_fp):
-        logging.info(f"Removing previous combined mash sketch: {card_prev_msh_fp}")
-        os.remove(card_prev_msh_fp)
+    # make the directory
+    genome_tree_folder = os.path.join(etd_db_dir, 'genome_trees')
+    os.makedirs(genome_tree_folder, exist_ok=True)
 
-    mash_text_file = os.path.join(etd_db_dir, 'mash_list.txt')
-    with open(mash_text_file, 'w') as fh:
-        for sketch in sketches:
-            fh.write(sketch + "\n")
-    logging.info(f"Combining {len(sketches)} sketches into {card_prev_msh_fp}")
+    mashtree_fp = os.path.join(genome_tree_folder, taxa + ".tree")
 
-    mash_paste_cmd = ["mash", "paste", card_prev_msh_fp, "-l", mash_text_file]
-    execute_cmd(mash_paste_cmd)
+    logging.info(f"Building genome tree for taxa: {taxa}")
+    use_mashtree = genome_fps is not None and shutil.which('mashtree') is not None
+    if use_mashtree:
+        names = list(genome_fps)
+    else:
+        triangle = subprocess.run(['mash', 'triangle', '-p', str(cores)] + sketches,
+                                  check=True, stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL, encoding='utf-8')
+        names, distances = parse_mash_triangle(triangle.stdout)
+
+    in_tree = set(names)
+    clusters = {leader: {member: distance \
+                            for member, distance in members.items() \
+                            if member in in_tree} \
+                    for leader, members in clusters.items() if leader in in_tree}
+    collapsed = set(member for members in clusters.values() \
+                        for member in members)
+    joined = [ix for ix, name in enumerate(names) if name not in collapsed]
+    if len(collapsed) > 0:
+        logging.info(f"Joining {len(joined)} cluster leaders of "
+                     f"{len(names)} genomes for taxa: {taxa}")
+
+    # mashtree and quicktree need at least 3 genomes to join
+    if len(joined) < 3:
+        with open(mashtree_fp, 'w') as fh:
+            fh.write(f"({','.join(names[ix] for ix in joined)});\n")
+    elif use_mashtree:
+        seq_file_list = os.path.join(genome_tree_folder,
+                                     taxa + '_genome_list.txt')
+        with open(seq_file_list, 'w') as fh:
+            for ix in joined:
+                fh.write(genome_fps[names[ix]] + '\n')
+        execute_cmd(['mashtree', '--numcpus', str(cores),
+                     '--file-of-files', seq_file_list,
+                     '--outtree', mashtree_fp])
+        os.remove(seq_file_list)
+    else:
+        distance_fp = os.path.join(genome_tree_folder,
+                                   taxa + '_distances.phylip')
+        with open(distance_fp, 'w') as fh:
+            fh.write(f"{len(joined)}\n")
+            for ix in joined:
+                fh.write(names[ix] + "\t" + "\t".join(f"{d:.6g}" \
+                        for d in distances[ix, joined]) + "\n")
+        with open(mashtree_fp, 'w') as fh:
+            subprocess.run(['quicktree', '-in', 'm', '-out', 't', distance_fp],
+                           check=True, stdout=fh, stderr=subprocess.DEVNULL)
+        os.remove(distance_fp)
+
+    if len(collapsed) > 0:
+        tree, leaves = placement.read_tree(mashtree_fp)
+        placement.graft_clusters(tree, leaves, clusters)
+        placement.write_tree(tree, mashtree_fp)
 
-    # tidy up files that are not needed anymore
-    os.remove(mash_text_file)
-    for sketch in sketches:
-        os.remove(sketch)
-    sketch_dir = os.path.join(etd_db_dir, 'genome_sketches')
-    for taxa_sketch_dir in os.listdir(sketch_dir):
-        os.rmdir(os.path.join(sketch_dir, taxa_sketch_dir))
-    os.rmdir(sketch_dir)
+    return mashtree_fp
 
-    return card_prev_msh_fp
 
+def collapsed_genomes(sketch_dir):
+    """
+    Genomes of a reference sketch collapsed into near-duplicate clusters
 
-def build_mashtree(sketches, etd_db_dir, cores):
+    Returns:
+        clusters: (dict) {leader: {collapsed genome: distance to the leader}}
     """
-    Build a mashtree for all the sketches of each taxa
+    reference = sketch.ReferenceSketch(sketch_dir)
+    if reference.leaders is None:
+        return {}
+    clusters = {}
+    for row, leader in enumerate(reference.leaders):
+        if row != leader:
+            clusters.setdefault(reference.names[leader], {})\
+                    [reference.names[row]] = float(reference.leader_distances[row])
+    return clusters
+
+
+def parse_mash_triangle(triangle):
     """
-    # make the directory
-    genome_tree_folder = os.path.join(etd_db_dir, 'genome_trees')
-    if not os.path.exists(genome_tree_folder):
-        os.mkdir(genome_tree_folder)
-
-    taxa = sketches[0].split(os.path.sep)[-2]
-
-    mashtree_fp = os.path.join(genome_tree_folder, taxa + ".tree")
+    Parse the lower triangle distance matrix written by `mash triangle`
 
-    # make list of taxafiles
-    seq_file_list = os.path.join(genome_tree_folder, taxa + '_genome_list.txt')
-    with open(seq_file_list, 'w') as fh:
-        for sketch in sketches:
-            fh.write(sketch + '\n')
+    Parameters:
+        triangle: (str) mash triangle output
+    Returns:
+        names: (list) genome accessions (sketched file names without .fa)
+        distances: (np.array) square distance matrix
+    """
+    lines = triangle.strip('\n').split('\n')
+    n_genomes = int(lines[0].strip())
+    names = []
+    distances = np.zeros((n_genomes, n_genomes))
+    for row, line in enumerate(lines[1:n_genomes + 1]):
+        fields = line.rstrip('\n').split('\t')
+        names.append(os.path.basename(fields[0]).replace('.fa', ''))
+        distances[row, :row] = [float(field) for field in fields[1:row + 1]]
+    return names, distances + distances.T
+
+
+def create_genome_sketches(genome_fps, mash_dir, cores):
+    """
+    Sketch all the genomes for one taxa with one multi-threaded mash sketch
+    per group of MASH_SKETCH_GROUP genomes, writing the multi-genome sketches
+    straight into mash_dir
+    """
+    if os.path.exists(mash_dir):
+        shutil.rmtree(mash_dir)
+    os.makedirs(mash_dir)
 
-    mashtree_cmd = ['mashtree', '--numcpus', str(cores),
-                    "--file-of-files", seq_file_list,
-                    '--outtree', mashtree_fp]
+    logging.info(f"Sketching {len(genome_fps)} genomes into {mash_dir}")
+    return [sketch_mash_group(genome_fps[start:start + MASH_SKETCH_GROUP],
+                              mash_dir, group, cores) \
+                for group, start in enumerate(range(0, len(genome_fps),
+                                                    MASH_SKETCH_GROUP))]
 
-    logging.info(f"Running mashtree for taxa: {taxa}")
 
-    execute_cmd(mashtree_cmd)
+def sketch_mash_group(genome_fps, mash_dir, group, cores):
+    """
+    Sketch a group of genomes into one multi-genome mash sketch
+    """
+    group_fp = os.path.join(mash_dir, f"group_{group}.msh")
+    list_fp = os.path.join(mash_dir, f"group_{group}_genomes.txt")
+    with open(list_fp, 'w') as fh:
+        for genome_fp in genome_fps:
+            fh.write(genome_fp + "\n")
 
-    os.remove(seq_file_list)
+    execute_cmd(['mash', 'sketch', '-p', str(cores), '-o', group_fp,
+                 '-l', list_fp])
+    os.remove(list_fp)
 
-    return mashtree_fp
+    return group_fp
 
 
-def create_genome_sketches(genome_fps, etd_db_dir, cores):
+def check_index(database_dir, cores=1, collapse_distance=None):
     """
-    Run mash sketch on all the genomes for one taxa in parallel
+    Check whether the database index is current with its inputs using the
+    build manifest, without rebuilding anything
+
+    Tarballs are compared by size and mtime, and the directories holding
+    each taxa's extracted genomes and RGI results by mtime (files can't have
+    been added or removed from a directory whose mtime is unchanged).  Only
+    the indexed files of changed directories are stat'd, in batches over a
+    thread pool.
+
+    Parameters:
+        database_dir: (str) path to the directory containing card-prev data
+        cores: (int) number of threads to spread the stat calls over
+        collapse_distance: (float) near-duplicate collapse distance the
+                           database should be built with (None to not check)
+    Returns:
+        stale: (dict) {taxa (or 'etd_db' for the combined outputs):
+                       [reasons it needs rebuilding]}, empty if current
     """
-    taxa = genome_fps[0].split(os.path.sep)[-2]
-    sketch_dir = os.path.join(etd_db_dir, 'genome_sketches')
-    if not os.path.exists(sketch_dir):
-        os.mkdir(sketch_dir)
-
-    taxa_sketch_dir = os.path.join(etd_db_dir, 'genome_sketches', taxa)
-    if not os.path.exists(taxa_sketch_dir):
-        os.mkdir(taxa_sketch_dir)
+    etd_db_dir = os.path.join(database_dir, 'etd_db')
+    rgi_dir = os.path.join(database_dir, 'rgi_results')
+    genome_dir = os.path.join(database_dir, 'genomes')
+    stale = collections.defaultdict(list)
+
+    if not os.path.exists(os.path.join(etd_db_dir, MANIFEST)):
+        stale['etd_db'].append("no build manifest")
+        return dict(stale)
+    manifest = load_manifest(etd_db_dir)
+
+    for output in ['etd_db_index.json', bundle.BUNDLE_NAME, 'sketch',
+                   'presence', 'mash_sketches']:
+        if not os.path.exists(os.path.join(etd_db_dir, output)):
+            stale['etd_db'].append(f"missing {output}")
+    built = [block[0] for block in manifest['reference_sketch']]
+    for taxa, record in manifest['taxa'].items():
+        if len(record['accessions']) > 0 and taxa not in built:
+            stale['etd_db'].append(f"{taxa} not in the reference sketch")
+
+    taxa_tarballs = {get_taxa(genome_tarball): genome_tarball \
+            for genome_tarball in glob.glob(os.path.join(genome_dir,
+                                                         '*.tar.gz'))}
+    for taxa in set(manifest['taxa']) - set(taxa_tarballs):
+        stale[taxa].append("tarball removed")
+    for taxa in set(taxa_tarballs) - set(manifest['taxa']):
+        stale[taxa].append("new tarball")
+
+    # (taxa, path, expected stats, description)
+    checks = []
+    for taxa, record in manifest['taxa'].items():
+        if taxa not in taxa_tarballs:
+            continue
+        if record['fingerprint'] is None:
+            stale[taxa].append("build was interrupted")
+            continue
+        if collapse_distance is not None and \
+                record.get('collapse_distance') != collapse_distance:
+            stale[taxa].append(f"collapse distance changed to {collapse_distance}")
+        genome_tarball = taxa_tarballs[taxa]
+        checks.append((taxa, genome_tarball, record['genome_tarball'],
+                       "genome tarball"))
+        checks.append((taxa, get_rgi_tarball(genome_tarball, rgi_dir),
+                       record['rgi_tarball'], "RGI tarball"))
+        for output in record['outputs'].values():
+            checks.append((taxa, os.path.join(database_dir, output), {},
+                           "output"))
+        for directory, mtime in record.get('directories', {}).items():
+            checks.append((taxa, os.path.join(database_dir, directory),
+                           {'mtime': mtime}, "directory"))
+
+    changed_dirs = set()
+    # builds that didn't record directory mtimes have all their files checked
+    for taxa, record in manifest['taxa'].items():
+        if taxa in taxa_tarballs and record['fingerprint'] is not None \
+                and 'directories' not in record:
+            changed_dirs.update((taxa, os.path.dirname(os.path.join(
+                                    database_dir, entry[artifact]))) \
+                    for entry in record['accessions'].values() \
+                    for artifact in ['genome', 'rgi'] \
+                    if artifact + '_member' not in entry)
+    for (taxa, path, expected, kind), stat in zip(checks, stat_paths(
+            [path for _, path, _, _ in checks], cores)):
+        if expected is None:
+            if stat is not None:
+                stale[taxa].append(f"{kind} added: {path}")
+        elif stat is None:
+            stale[taxa].append(f"{kind} missing: {path}")
+        elif kind == "directory":
+            if stat.st_mtime != expected['mtime']:
+                changed_dirs.add((taxa, path))
+        elif 'size' in expected and (stat.st_size != expected['size'] or \
+                                     stat.st_mtime != expected['mtime']):
+            stale[taxa].append(f"{kind} modified: {path}")
+
+    # indexed genomes and RGI results of the directories that changed
+    file_checks = []
+    for taxa, directory in sorted(changed_dirs):
+        for entry in manifest['taxa'][taxa]['accessions'].values():
+            for artifact in ['genome', 'rgi']:
+                path = os.path.join(database_dir, entry[artifact])
+                if os.path.dirname(path) == directory:
+                    file_checks.append((taxa, path))
+    for (taxa, path), stat in zip(file_checks, stat_paths(
+            [path for _, path in file_checks], cores)):
+        if stat is None:
+            stale[taxa].append(f"file missing: {path}")
+
+    return dict(stale)
+
+
+def forced_rebuilds(stale):
+    """
+    Taxa of check_index's stale report that have to be rebuilt whatever
+    their tarball checksums are, i.e. those with missing outputs or files
 
-    sketch_fps = []
-    for genome_fp in genome_fps:
-        sketch_fp = os.path.basename(genome_fp).replace('.fa', '.msh')
-        sketch_fps.append(os.path.join(taxa_sketch_dir, sketch_fp))
-
-    logging.info(f"Sketching genomes for taxa: {taxa}")
-    sketch_cmds = []
-    already_exists = 0
-    for genome, sketch in zip(genome_fps, sketch_fps):
-        # don't remake sketches that already exist
-        # could be a problem if newer versions change the k-mer size etc
-        if not os.path.exists(sketch):
-            sketch_cmds.append(['mash', 'sketch', '-o', sketch, genome])
-        else:
-            already_exists += 1
-    if already_exists > 0:
-        logging.debug(f"Using {already_exists} sketches that already exist")
-    logging.debug(f"Running {len(sketch_cmds)} genomic sketches")
-    joblib.Parallel(n_jobs=cores)(joblib.delayed(execute_cmd)(cmd) for \
-                                                        cmd in sketch_cmds)
+    Modified, added or removed tarballs are left to build_db, which only
+    rebuilds a taxa when the content checksum of its tarballs changed (so
+    a touched tarball doesn't discard the taxa and its added genomes).
 
-    return sketch_fps
+    Parameters:
+        stale: (dict) {taxa: [reasons it needs rebuilding]} (see check_index)
+    Returns:
+        rebuild: (set) taxa to pass to build_db's rebuild
+    """
+    return set(taxa for taxa, reasons in stale.items() if taxa != 'etd_db' \
+                and any(' missing: ' in reason for reason in reasons))
 
 
-def check_index(index_filepath):
+def stat_paths(paths, cores):
     """
-    Validate index and
+    Stat paths in batches spread over a thread pool
 
-    Return False if index is invalid and return dict if valid
+    Parameters:
+        paths: (list) paths to stat
+        cores: (int) number of threads
+    Returns:
+        stats: (list) os.stat_result of each path or None if it doesn't exist
     """
-    return False
-    with open(index_filepath) as fh:
-        index = json.load(fh)
+    def stat_batch(batch):
+        stats = []
+        for path in batch:
+            try:
+                stats.append(os.stat(path))
+            except FileNotFoundError:
+                stats.append(None)
+        return stats
+
+    batches = [paths[start:start + STAT_BATCH] \
+                    for start in range(0, len(paths), STAT_BATCH)]
+    return [stat for stats in pipeline.run_in_pool(stat_batch, batches,
+                                                   max(1, cores)) \
+                for stat in stats]
+
+
+@functools.lru_cache(maxsize=None)
+def load_index(database_dir):
+    """
+    Load the database index once per process so relatives' files can be
+    looked up by accession without scanning the database directories
 
-    valid = True
+    Parameters:
+        database_dir: (str) path to the directory containing card-prev data
+    Returns:
+        etd_db: (dict) database index (see build_db)
+    """
+    etd_bundle = bundle.load_bundle(database_dir)
+    if etd_bundle is not None:
+        return etd_bundle.json('index')
+
+    index_filepath = os.path.join(database_dir, 'etd_db', "etd_db_index.json")
+    if not os.path.exists(index_filepath):
+        logging.error(f"Database index {index_filepath} doesn't exist, "
+                      "(re)build the database with `etd.py database`")
+        sys.exit(1)
 
-    for access in index:
-        if not os.path.exists(index[access]['genome']):
-            valid = False
-            logging.warning(f"Genome Missing: {index[access]['genome']}")
+    logging.debug(f"Loading database index: {index_filepath}")
+    with open(index_filepath) as fh:
+        etd_db = json.load(fh)
+    return etd_db
 
-        if not os.path.exists(index[access]['rgi_results']):
-            valid = False
-            logging.warning(f"RGI Result Missing: {index[access]['rgi_results']}")
 
-    # check other db parts TODO
-    if not os.path.exists(index['genome_sketch']):
-        valid = False
-        logging.warning(f"Genome MASH sketch missing: {index['genome_sketch']}")
+def get_accession_paths(accession, database_dir):
+    """
+    Resolve the RGI, genome, sketch and genome tree of an accession from the
+    database index
+
+    Parameters:
+        accession: (str) genome accession
+        database_dir: (str) path to the directory containing card-prev data
+    Returns:
+        paths: (dict) {'rgi', 'genome', 'genome_tree': path,
+                       'taxon': taxon, 'sketch': row in reference sketch}
+               databases built with --stream give the tarballs as the rgi
+               and genome paths and add 'rgi_member' and 'genome_member'
+               (names of the files in the tarballs)
+    """
+    etd_db = load_index(database_dir)
+    if accession not in etd_db['accessions']:
+        logging.error(f"{accession} is not in the database index")
+        sys.exit(1)
 
-    return valid
+    paths = dict(etd_db['accessions'][accession])
+    for artifact in ['rgi', 'genome', 'genome_tree']:
+        paths[artifact] = os.path.join(database_dir, paths[artifact])
+    return paths
 
 
-def prepare_db(args):
-    # start logging
-    run_name = f"ETD_DB_preparation_{int(time.time())}"
-    if args.verbose:
+def start_logging(run_name, verbose):
+    """
+    Log to the terminal and {run_name}.log
+    """
+    if verbose:
         logging.basicConfig(format='%(levelname)s:%(message)s',
                             level=logging.DEBUG,
                             handlers=[logging.FileHandler(f"{run_name}.log"),
@@ -295,6 +1345,32 @@ def prepare_db(args):
                             handlers=[logging.FileHandler(f"{run_name}.log"),
                                       logging.StreamHandler()])
 
+
+def verify_database_bundle(database_dir, etd_db):
+    """
+    Check the database bundle against its checksums and rewrite it from
+    the built database if it is corrupt
+
+    Parameters:
+        database_dir: (str) path to the directory containing card-prev data
+        etd_db: (dict) database index
+    """
+    bundle_fp = bundle.bundle_path(database_dir)
+    logging.info(f"Verifying database bundle: {bundle_fp}")
+    problems = bundle.verify_bundle(bundle_fp)
+    if len(problems) == 0:
+        logging.info("Database bundle verified")
+        return
+    for problem in problems:
+        logging.warning(f"Database bundle is corrupt: {problem}")
+    bundle.write_database_bundle(database_dir, etd_db)
+
+
+def prepare_db(args):
+    # start logging
+    run_name = f"ETD_DB_preparation_{int(time.time())}"
+    start_logging(run_name, args.verbose)
+
     logging.info(f"Started ETD '{run_name}' in '{args.database_dir}'")
 
     check_dependencies()
@@ -307,18 +1383,27 @@ def prepare_db(args):
     if os.path.exists(index_filepath):
         logging.info(f"Pre-existing index found: {index_filepath}")
 
-        db_valid = check_index(index_filepath)
-        if db_valid and not args.force:
+        stale = check_index(args.database_dir, args.num_threads,
+                            args.collapse_distance)
+        if len(stale) == 0 and not args.force:
             logging.info(f"Using pre-existing index (use --force to rebuild): {index_filepath}")
             with open(index_filepath) as fh:
                 etd_db = json.load(fh)
+            if args.verify:
+                verify_database_bundle(args.database_dir, etd_db)
             return etd_db
         else:
+            for name, reasons in sorted(stale.items()):
+                for reason in reasons:
+                    logging.info(f"Needs rebuilding: {name}: {reason}")
             logging.info(f"Index incomplete: removing and rebuilding")
             os.remove(index_filepath)
     else:
+        stale = {}
         logging.info(f"No database found ({index_filepath}): building")
 
-    etd_db = build_db(args.database_dir, args.num_threads)
+    etd_db = build_db(args.database_dir, args.num_threads, args.force,
+                      args.stream, rebuild=forced_rebuilds(stale),
+                      collapse_distance=args.collapse_distance)
 
     return etd_db
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import pandas as pd
+import numpy as np
 import os
 import logging
 
@@ -40,6 +41,72 @@ def find_rgi_differences(input_rgi, closest_relatives_rgi):
     logging.info(f"Unique ARG in isolate compared to relatives {str(unique_to_isolate)}")
     logging.debug(f"Missing ARGs in isolate compared to relatives {str(missing_from_isolate)}")
 
+    sequences_uniq_to_isolate = get_unique_sequences(input_rgi,
+                                                     unique_to_isolate)
+
+    return unique_to_isolate, sequences_uniq_to_isolate, missing_from_isolate
+
+
+def find_presence_differences(input_rgi, presence_matrix, relative_rows):
+    """
+    As find_rgi_differences but using the database's precomputed ARG
+    presence matrix for the closest relatives instead of their RGI tables
+
+    Parameters:
+        input_rgi: (pd.df) dataframe of RGI TSV for input genome
+        presence_matrix: (presence.PresenceMatrix) database ARG presence
+        relative_rows: (list) presence matrix rows of the closest relatives
+
+    Returns:
+        unique_to_isolate: (set) Names of ARGs unique to input compared to relatives
+        sequences_uniq_to_isolate: (dict) {ARG name: DNA sequence} for sequences
+                                    only found in isolate
+        missing_from_isolate: (set) Names of ARGs not found in isolate but found in
+                                    relatives
+        relatives_prevalence: (pd.df) number of relatives carrying each ARG
+                                    found in the isolate or its relatives
+    """
+    logging.info("Determining differences in RGI predictions")
+    args_in_input = set((int(aro), arg_name) for aro, arg_name in \
+            input_rgi[['ARO', 'Best_Hit_ARO']].itertuples(index=False, name=None))
+
+    in_input, input_only = presence_matrix.args_to_vector(args_in_input)
+    in_relatives = presence_matrix.union(relative_rows)
+    columns = presence_matrix.columns
+
+    unique_to_isolate = input_only.union(columns[col] for col in \
+            np.flatnonzero(in_input & ~in_relatives))
+    missing_from_isolate = set(columns[col] for col in \
+            np.flatnonzero(in_relatives & ~in_input))
+
+    logging.info(f"Unique ARG in isolate compared to relatives {str(unique_to_isolate)}")
+    logging.debug(f"Missing ARGs in isolate compared to relatives {str(missing_from_isolate)}")
+
+    prevalence = presence_matrix.prevalence(relative_rows)
+    observed = np.flatnonzero(in_input | in_relatives)
+    relatives_prevalence = pd.DataFrame(
+            [columns[col] + (bool(in_input[col]), int(prevalence[col])) \
+                    for col in observed] + \
+            [arg + (True, 0) for arg in sorted(input_only)],
+            columns=['ARO', 'Best_Hit_ARO', 'In_Isolate', 'Relatives_With_ARG'])
+
+    sequences_uniq_to_isolate = get_unique_sequences(input_rgi,
+                                                     unique_to_isolate)
+
+    return unique_to_isolate, sequences_uniq_to_isolate, \
+            missing_from_isolate, relatives_prevalence
+
+
+def get_unique_sequences(input_rgi, unique_to_isolate):
+    """
+    Grab the predicted DNA sequence of each ARG unique to the input
+
+    Parameters:
+        input_rgi: (pd.df) dataframe of RGI TSV for input genome
+        unique_to_isolate: (set) (ARO, ARG name) unique to the input
+    Returns:
+        sequences_uniq_to_isolate: (dict) {ARO: (ARG name, DNA sequence)}
+    """
     logging.debug(f"Grabbing predicted DNA sequences for unique ARGs in input")
     sequences_uniq_to_isolate = {}
     for aro, arg_name in unique_to_isolate:
@@ -52,7 +119,7 @@ def find_rgi_differences(input_rgi, closest_relatives_rgi):
         sequences_uniq_to_isolate[str(aro)] = (arg_name, arg_sequence)
     logging.debug(f"Sequences unique to isolate {str(sequences_uniq_to_isolate)}")
 
-    return unique_to_isolate, sequences_uniq_to_isolate, missing_from_isolate
+    return sequences_uniq_to_isolate
 
 
 def prepare_context_analysis(run_name, unique_arg_seqs_in_isolate):
@@ -21,6 +21,15 @@ from etd import context
 from etd import phylo
 from etd import metadata
 from etd import database
+from etd import presence
+from etd import pipeline
+from etd import cache
+from etd import bundle
+from etd import placement
+from etd import card
+
+# genome fasta extensions picked up from a cohort directory
+COHORT_EXTENSIONS = ['.fa', '.fna', '.fasta', '.fas']
 
 def check_dependencies():
     """
@@ -53,14 +62,16 @@ def run_main(args):
     """
     if not args.output_dir:
         # extract input filename
-        run_name = os.path.splitext(os.path.basename(args.input_genome))[0]
+        run_name = os.path.splitext(os.path.basename(
+                        os.path.normpath(args.input_genome)))[0]
         # add unix timestamp to name
         run_name = run_name + str(int(time.time()))
     else:
         run_name = args.output_dir
 
-    # make run directory
-    os.mkdir(run_name)
+    # make run directory (or resume a previous run in it)
+    resuming = os.path.exists(run_name)
+    os.makedirs(run_name, exist_ok=True)
 
     # start logging
     if args.debug or args.verbose:
@@ -75,58 +86,445 @@ def run_main(args):
                                       logging.StreamHandler()])
 
     logging.info(f"Started ETD '{run_name}' with input '{args.input_genome}'")
+    if resuming:
+        logging.info(f"Resuming run in existing output directory '{run_name}'")
 
     # check dependencies
     check_dependencies()
 
-    # run RGI on input contigs
-    rgi_output = rgi.run_rgi(args.input_genome, args.num_threads, run_name)
-
-    # find nearest relatives complements of arg genes
-    closest_relatives = relatives.find_relatives(args.input_genome,
-                                                 args.database_dir,
-                                                 args.mash_distance,
-                                                 args.num_threads,
-                                                 run_name)
-
-    # place on mashtree
-    # todo
-
-    # recover rgi tables for relatives
-    closest_relatives_rgi = relatives.get_rgi_results(closest_relatives,
-                                                     args.database_dir)
-
-    # combine outputs into one dataframe
-    # get difference between rgi hits and nearest relatives
-    unique_to_isolate, \
-            sequences_uniq_to_isolate, \
-            missing_from_isolate = diff.find_rgi_differences(rgi_output,
-                                                             closest_relatives_rgi)
+    if args.cohort:
+        run_cohort(args, run_name)
+    else:
+        run_isolate(args.input_genome, run_name, args, args.num_threads)
+
+
+def run_isolate(input_genome, run_name, args, num_threads,
+                mash_distances=None):
+    """
+    Run the ETD stages for a single genome
+
+    Parameters:
+        input_genome: path to the input genome fasta
+        run_name: path to output folder for this genome
+        args: argparse arguments
+        num_threads: (int) number of threads to use for this genome
+        mash_distances: (pd.df) closest relatives if already searched for
+                        (e.g. by a cohort run) otherwise None
+    Returns:
+        results: (dict) {stage name: result}
+    """
+    os.makedirs(run_name, exist_ok=True)
+
+    # RGI and the relative search only share the input genome so run
+    # them concurrently and split the threads between them, or one after
+    # another with all the threads when there aren't enough to split
+    split = num_threads >= 2
+    if split:
+        rgi_threads, mash_threads = pipeline.split_threads(num_threads, [3, 1])
+    else:
+        rgi_threads, mash_threads = num_threads, num_threads
+
+    # stages are checkpointed and reused when rerun with the same inputs
+    genome_digest = cache.file_digest(input_genome)
+    database_index = os.path.join(args.database_dir, 'etd_db',
+                                  'etd_db_index.json')
+    database_version = os.path.getmtime(database_index) \
+                            if os.path.exists(database_index) else None
+    rgi_output_tsv = rgi.get_output_name(run_name) + ".txt"
+    mash_output_tsv = os.path.join(run_name, 'mash', 'mash_distances.tsv')
+
+    def run_rgi(results):
+        # run RGI on input contigs, rerun when RGI or CARD are updated
+        rgi_version, card_version = rgi.get_versions()
+        return pipeline.checkpointed(
+                os.path.join(run_name, 'rgi'),
+                {'genome': genome_digest, 'rgi': rgi_version,
+                 'card': card_version, 'rgi_shards': args.rgi_shards},
+                lambda: rgi.run_rgi(input_genome, rgi_threads, run_name,
+                                    args.rgi_cache, args.rgi_cache_size,
+                                    args.rgi_shards),
+                lambda: pd.read_csv(rgi_output_tsv, sep='\t'))
+
+    def find_relatives(results):
+        # find nearest relatives complements of arg genes
+        if mash_distances is not None:
+            find = lambda: relatives.write_mash_distances(mash_distances,
+                                                          run_name)
+        else:
+            find = lambda: relatives.find_relatives(input_genome,
+                                                    args.database_dir,
+                                                    args.mash_distance,
+                                                    mash_threads, run_name,
+                                                    args.containment)
+        pipeline.checkpointed(os.path.join(run_name, 'mash'),
+                              {'genome': genome_digest,
+                               'database': database_version,
+                               'mash_distance': args.mash_distance,
+                               'containment': args.containment},
+                              find, lambda: None)
+        return pd.read_csv(mash_output_tsv, sep='\t', index_col=0).index
+
+    def place_on_tree(results):
+        # place the isolate on the genome tree of its closest relatives
+        placement_dir = os.path.join(run_name, 'placement')
+        return pipeline.checkpointed(
+                placement_dir,
+                {'relatives': cache.file_digest(mash_output_tsv),
+                 'database': database_version},
+                lambda: place_isolate(input_genome, mash_output_tsv,
+                                      args.database_dir, placement_dir),
+                lambda: load_placement(placement_dir))
+
+    def get_metadata(results):
+        # get biosample metadata for closest relatives
+        return pipeline.checkpointed(
+                os.path.join(run_name, 'relatives_metadata'),
+                {'relatives': list(results['relatives'])},
+                lambda: metadata.get_spatiotemp_context(run_name,
+                                                        results['relatives']),
+                lambda: None)
+
+    def get_differences(results):
+        return pipeline.checkpointed(
+                os.path.join(run_name, 'unique_to_isolate'),
+                {'rgi': cache.file_digest(rgi_output_tsv),
+                 'relatives': list(results['relatives']),
+                 'database': database_version},
+                lambda: find_differences(results['rgi'], results['relatives'],
+                                         args.database_dir, run_name),
+                lambda: load_differences(run_name))
+
+    def score_novelty(results):
+        # novelty of the unique ARGs within their CARD gene families
+        if args.card_json is None:
+            return None
+        novelty_dir = os.path.join(run_name, 'novelty')
+        card_stat = os.stat(args.card_json)
+        return pipeline.checkpointed(
+                novelty_dir,
+                {'sequences': results['differences']['sequences'],
+                 'card': [os.path.realpath(args.card_json), card_stat.st_size,
+                          card_stat.st_mtime]},
+                lambda: write_novelty(results['differences']['sequences'],
+                                      args.card_json, args.card_cache,
+                                      novelty_dir),
+                lambda: pd.read_csv(os.path.join(novelty_dir, 'novelty.tsv'),
+                                    sep='\t', dtype={'ARO': str,
+                                                      'Best_Reference_ARO': str}))
+
+    def analyse_unique(results):
+        return analyse_unique_args(results['differences'], args.database_dir,
+                                   num_threads, database_version)
+
+    return pipeline.run_stages({'rgi': (run_rgi, []),
+                                'relatives': (find_relatives, []),
+                                'placement': (place_on_tree, ['relatives']),
+                                'metadata': (get_metadata, ['relatives']),
+                                'differences': (get_differences,
+                                                ['rgi', 'relatives']),
+                                'novelty': (score_novelty, ['differences']),
+                                'unique_args': (analyse_unique,
+                                                ['differences'])},
+                               max_workers=None if split else 1)
+
+
+def get_cohort_genomes(cohort_input):
+    """
+    Genomes of a cohort given either as a directory of fastas or a file
+    listing one genome path per line
+
+    Parameters:
+        cohort_input: path to the directory or list of genomes
+    Returns:
+        genomes: (dict) {isolate name: genome path}
+    """
+    if os.path.isdir(cohort_input):
+        genome_fps = sorted(fp for extension in COHORT_EXTENSIONS \
+                for fp in glob.glob(os.path.join(cohort_input, '*' + extension)))
+    else:
+        with open(cohort_input) as fh:
+            genome_fps = [line.strip() for line in fh if line.strip()]
+
+    genomes = {}
+    for genome_fp in genome_fps:
+        if not os.path.exists(genome_fp):
+            logging.error(f"Cohort genome {genome_fp} does not exist")
+            sys.exit(1)
+        isolate = os.path.splitext(os.path.basename(genome_fp))[0]
+        if isolate in genomes:
+            logging.error(f"Duplicate isolate name {isolate}: "
+                          f"{genomes[isolate]} and {genome_fp}")
+            sys.exit(1)
+        genomes[isolate] = genome_fp
+
+    if len(genomes) == 0:
+        logging.error(f"No genomes found in cohort {cohort_input}")
+        sys.exit(1)
+    return genomes
+
+
+def run_cohort(args, run_name):
+    """
+    Run ETD on a cohort of genomes sharing the loaded database, with a single
+    relative search for every genome and the isolates spread over a pool
+    of workers
+
+    Parameters:
+        args: argparse arguments
+        run_name: path to the cohort output folder
+    """
+    genomes = get_cohort_genomes(args.input_genome)
+    logging.info(f"Running cohort of {len(genomes)} genomes")
+
+    cohort_distances = relatives.find_cohort_relatives(list(genomes.values()),
+                                                       args.database_dir,
+                                                       args.mash_distance,
+                                                       args.num_threads,
+                                                       containment=args.containment)
+
+    workers = max(1, min(args.num_threads, len(genomes)))
+    threads_per_isolate = max(1, args.num_threads // workers)
+
+    def run_one(isolate):
+        genome_fp = genomes[isolate]
+        logging.info(f"Running isolate {isolate}: {genome_fp}")
+        try:
+            results = run_isolate(genome_fp, os.path.join(run_name, isolate),
+                                  args, threads_per_isolate,
+                                  cohort_distances[genome_fp])
+        except (Exception, SystemExit) as error:
+            logging.error(f"Isolate {isolate} failed: {error!r}")
+            return {'isolate': isolate, 'genome': genome_fp,
+                    'status': 'failed'}
+
+        differences = results['differences']
+        return {'isolate': isolate, 'genome': genome_fp, 'status': 'complete',
+                'relatives': ",".join(results['relatives']),
+                'unique_args': ",".join(name for _, name in \
+                                        differences['unique']),
+                'missing_args': ",".join(name for _, name in \
+                                         differences['missing'])}
+
+    summary = pipeline.run_in_pool(run_one, list(genomes), workers)
+
+    summary_fp = os.path.join(run_name, 'cohort_summary.tsv')
+    pd.DataFrame(summary, columns=['isolate', 'genome', 'status', 'relatives',
+                                   'unique_args', 'missing_args'])\
+            .to_csv(summary_fp, sep='\t', index=False)
+    logging.info(f"Cohort summary written to {summary_fp}")
+
+
+def find_differences(rgi_output, closest_relatives, database_dir, run_name):
+    """
+    Find the ARGs unique to and missing from the isolate compared to its
+    closest relatives and prepare the unique ones for context analysis
+
+    Parameters:
+        rgi_output: (pd.df) RGI table of the input genome
+        closest_relatives: (list) closest relative genome names
+        database_dir: path to the ETD/CARD prevalence database
+        run_name: path to output folder
+    Returns:
+        differences: (dict) {'sequences': {ARO: (ARG name, DNA sequence)},
+                             'paths': {ARO: {'seq_file', 'folder'}},
+                             'unique': [(ARO, ARG name)],
+                             'missing': [(ARO, ARG name)]}
+    """
+    etd_bundle = bundle.load_bundle(database_dir)
+    presence_dir = os.path.join(database_dir, 'etd_db', 'presence')
+    if etd_bundle is not None or os.path.exists(presence_dir):
+        # use the precomputed ARG presence of the relatives
+        if etd_bundle is not None:
+            presence_matrix = presence.PresenceMatrix.from_bundle(etd_bundle)
+        else:
+            presence_matrix = presence.load_presence_matrix(presence_dir)
+        relative_rows = [database.get_accession_paths(relative,
+                                                      database_dir)['sketch'] \
+                            for relative in closest_relatives]
+        unique_to_isolate, \
+                sequences_uniq_to_isolate, \
+                missing_from_isolate, \
+                relatives_prevalence = diff.find_presence_differences(rgi_output,
+                                                                      presence_matrix,
+                                                                      relative_rows)
+        relatives_prevalence.to_csv(os.path.join(run_name,
+                                                 'relatives_arg_prevalence.tsv'),
+                                    sep='\t', index=False)
+    else:
+        # recover rgi tables for relatives
+        closest_relatives_rgi = relatives.get_rgi_results(closest_relatives,
+                                                         database_dir)
+
+        # combine outputs into one dataframe
+        # get difference between rgi hits and nearest relatives
+        unique_to_isolate, \
+                sequences_uniq_to_isolate, \
+                missing_from_isolate = diff.find_rgi_differences(rgi_output,
+                                                                 closest_relatives_rgi)
     unique_seq_paths = diff.prepare_context_analysis(run_name,
                                                      sequences_uniq_to_isolate)
 
-    # get biosample metadata for closest relatives
-    metadata_context = metadata.get_spatiotemp_context(run_name,
-                                                       closest_relatives)
+    differences = {'sequences': sequences_uniq_to_isolate,
+                   'paths': unique_seq_paths,
+                   'unique': sorted(unique_to_isolate),
+                   'missing': sorted(missing_from_isolate)}
+
+    # keep the differences so a resumed run can reload them
+    with open(os.path.join(run_name, 'unique_to_isolate',
+                           'differences.json'), 'w') as fh:
+        json.dump(differences, fh)
+
+    return differences
+
+
+def place_isolate(input_genome, mash_output_tsv, database_dir,
+                  placement_dir):
+    """
+    Attach the isolate to the precomputed genome tree of its closest
+    relative using its mash distances to the relatives on the same tree
+
+    Parameters:
+        input_genome: path to the input genome fasta
+        mash_output_tsv: path to the mash distances of the closest relatives
+        database_dir: path to the ETD/CARD prevalence database
+        placement_dir: path to write the tree with the isolate attached to
+    Returns:
+        placed_tree: path to the tree with the isolate attached or None if
+                     it has no relatives
+    """
+    os.makedirs(placement_dir)
+    mash_distances = pd.read_csv(mash_output_tsv, sep='\t',
+                                 index_col=0).iloc[:, 0]
+    if len(mash_distances) == 0:
+        logging.warning("No relatives found to place the isolate on a "
+                        "genome tree")
+        return None
+
+    trees = {relative: database.get_accession_paths(relative,
+                                                    database_dir)['genome_tree'] \
+                for relative in mash_distances.index}
+    tree_fp = trees[mash_distances.idxmin()]
+    distances = {relative: distance \
+                    for relative, distance in mash_distances.items() \
+                    if trees[relative] == tree_fp}
+
+    isolate = os.path.splitext(os.path.basename(input_genome))[0]
+    placed_tree = os.path.join(placement_dir, os.path.basename(tree_fp))
+    placement.place(tree_fp, isolate, distances, placed_tree)
+    return placed_tree
+
+
+def load_placement(placement_dir):
+    """
+    Reload the output of place_isolate from a completed run
+    """
+    placed_trees = glob.glob(os.path.join(placement_dir, '*.tree'))
+    return placed_trees[0] if len(placed_trees) > 0 else None
+
+
+def write_novelty(sequences_uniq_to_isolate, card_json, card_cache,
+                  novelty_dir):
+    """
+    Score the novelty of the ARGs unique to the isolate against the
+    reference proteins of their CARD gene families (see CARD.score_novelty)
+
+    Parameters:
+        sequences_uniq_to_isolate: (dict) {ARO: (ARG name, DNA sequence)}
+        card_json: path to CARD's card.json
+        card_cache: path to keep the compiled card.json in or None
+        novelty_dir: path to write novelty.tsv to
+    Returns:
+        novelty: (pd.df) novelty of each ARG
+    """
+    os.makedirs(novelty_dir)
+    card_db = card.load_card(card_json, card_cache)
+    novelty = card_db.score_novelty(sequences_uniq_to_isolate)
+    novelty.to_csv(os.path.join(novelty_dir, 'novelty.tsv'), sep='\t',
+                   index=False)
+    for row in novelty.itertuples(index=False):
+        logging.info(f"{row.ARG_Name} ({row.ARO}) novelty {row.Novelty:.3f}, "
+                     f"closest {row.Gene_Family} reference ARO "
+                     f"{row.Best_Reference_ARO}")
+    return novelty
+
+
+def load_differences(run_name):
+    """
+    Reload the output of find_differences from a completed run
+    """
+    with open(os.path.join(run_name, 'unique_to_isolate',
+                           'differences.json')) as fh:
+        return json.load(fh)
+
+
+def analyse_unique_args(differences, database_dir, num_threads,
+                        database_version=None):
+    """
+    Analyse the genomic and phylogenetic context of each ARG unique to the
+    isolate, running up to num_threads AROs at once
+
+    Parameters:
+        differences: (dict) output of find_differences
+        database_dir: path to the ETD/CARD prevalence database
+        num_threads: (int) number of threads to use
+        database_version: fingerprint of the database for checkpointing
+    Returns:
+        phylo_contexts: (dict) {ARO: guppy tree path}
+    """
+    sequences_uniq_to_isolate = differences['sequences']
+    unique_seq_paths = differences['paths']
+    unique_aros = list(sequences_uniq_to_isolate)
+    workers = max(1, min(num_threads, len(unique_aros)))
+    pplacer_threads = max(1, num_threads // workers)
 
     # Analyse the sequence changes
-    for unique_aro, seq_data in sequences_uniq_to_isolate.items():
+    def analyse(unique_aro):
         # lookup card-prev data
-        amr_name = seq_data[0]
+        amr_name = sequences_uniq_to_isolate[unique_aro][0]
         seq_paths = unique_seq_paths[unique_aro]
 
-        observed_context = context.get_genomic_context(unique_aro,
-                                                       amr_name,
-                                                       seq_paths,
-                                                       args.database_dir)
+        inputs = {'aro': unique_aro,
+                  'sequence': sequences_uniq_to_isolate[unique_aro][1],
+                  'database': database_version}
+
+        # the genomic context is only written to its output folder
+        pipeline.checkpointed(
+                os.path.join(seq_paths['folder'], 'genomic_context'), inputs,
+                lambda: context.get_genomic_context(unique_aro, amr_name,
+                                                    seq_paths, database_dir),
+                lambda: None)
 
-        phylo_context = phylo.get_phylo_context(unique_aro, seq_paths,
-                                                args.database_dir,
-                                                args.num_threads)
+        phylo_output_dir = os.path.join(seq_paths['folder'], 'pplacer')
+        phylo_context = pipeline.checkpointed(
+                phylo_output_dir, inputs,
+                lambda: phylo.get_phylo_context(unique_aro, seq_paths,
+                                                database_dir, pplacer_threads),
+                lambda: os.path.join(phylo_output_dir, 'guppy.tree'))
+        return phylo_context
+
+    phylo_contexts = pipeline.run_in_pool(analyse, unique_aros, workers)
+    return dict(zip(unique_aros, phylo_contexts))
 
 
 def run_database(args):
 
+    if args.mode == 'add':
+        # add genomes to a taxa of an already generated database
+        run_name = f"ETD_DB_addition_{int(time.time())}"
+        database.start_logging(run_name, args.verbose)
+        logging.info(f"Started ETD '{run_name}' in '{args.database_dir}'")
+        if args.taxa is None or args.input_genomes is None or \
+                args.rgi_results is None:
+            logging.error("`etd.py database add` needs --taxa, "
+                          "--input_genomes and --rgi_results")
+            sys.exit(1)
+        database.check_dependencies()
+        genomes = get_cohort_genomes(args.input_genomes)
+        database.add_genomes(args.database_dir, args.taxa,
+                             list(genomes.values()), args.rgi_results,
+                             args.num_threads)
+        return
+
     # check for already generated database
     database.prepare_db(args)
 
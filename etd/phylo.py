@@ -2,11 +2,14 @@
 # -*- coding: utf-8 -*
 
 #import ete
+import io
 import pandas as pd
 import os
 import logging
 import subprocess
 
+from etd import bundle
+
 def get_phylo_context(aro, seq_paths, database_dir, num_threads):
 
     # make the run_folder if it doesn't exist
@@ -17,7 +20,12 @@ def get_phylo_context(aro, seq_paths, database_dir, num_threads):
     #get appropriate refpkg from index in database dir
     #taxit create -l MCR -P my.refpkg --aln-fasta clean_mcr.afa --tree-stats treestats.txt --tree-file clean_mcr.tree
     phylo_db_dir = os.path.join(database_dir, 'phylo')
-    refpkg_index = pd.read_csv(os.path.join(phylo_db_dir, 'index.tsv'),
+    etd_bundle = bundle.load_bundle(database_dir)
+    if etd_bundle is not None and 'refpkg_index' in etd_bundle:
+        refpkg_index_fh = io.BytesIO(etd_bundle.bytes('refpkg_index'))
+    else:
+        refpkg_index_fh = os.path.join(phylo_db_dir, 'index.tsv')
+    refpkg_index = pd.read_csv(refpkg_index_fh,
             sep='\t', dtype={'ARO': str, 'refpkg_path': str})
 
     refpkg_name = refpkg_index[refpkg_index['ARO'] == aro]['refpkg_path'].iloc[0]
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import concurrent.futures
+
+# completion marker written into each finished stage's output directory
+STAGE_MARKER = '.etd_stage.json'
+
+
+def split_threads(num_threads, weights):
+    """
+    Divide threads between concurrently running stages
+
+    Parameters:
+        num_threads: (int) total number of threads (at least one per stage)
+        weights: (list) relative share of each stage
+    Returns:
+        threads: (list) number of threads (at least 1) for each stage,
+                 num_threads in total
+    """
+    if num_threads < len(weights):
+        raise ValueError(f"{num_threads} threads can't be split between "
+                         f"{len(weights)} concurrent stages")
+    total = sum(weights)
+    # one thread each and the rest shared by weight
+    shares = [(num_threads - len(weights)) * weight / total \
+                for weight in weights]
+    threads = [1 + int(share) for share in shares]
+    # give any threads lost to rounding to the largest remainders
+    by_remainder = sorted(range(len(weights)),
+                          key=lambda ix: int(shares[ix]) - shares[ix])
+    for ix in by_remainder[:num_threads - sum(threads)]:
+        threads[ix] += 1
+    return threads
+
+
+def run_stages(stages, max_workers=None):
+    """
+    Run a dependency graph of stages, starting each stage as soon as all the
+    stages it depends on have finished
+
+    If a stage fails the stages that haven't started are cancelled and the
+    error is raised straight away, without waiting for the running stages.
+
+    Parameters:
+        stages: (dict) {stage name: (function, [dependency stage names])}
+                where function is called with the {stage name: result} dict
+                of the finished stages
+        max_workers: (int) maximum number of stages running at once (default
+                     all of them), 1 runs the stages one after another
+    Returns:
+        results: (dict) {stage name: result}
+    """
+    results = {}
+    pending = dict(stages)
+    running = {}
+
+    pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers or max(len(stages), 1))
+    try:
+        while pending or running:
+            for name, (function, dependencies) in list(pending.items()):
+                if all(dependency in results for dependency in dependencies):
+                    logging.debug(f"Starting stage: {name}")
+                    running[pool.submit(function, dict(results))] = name
+                    del pending[name]
+
+            if not running:
+                raise ValueError(f"Stages can't be scheduled: {list(pending)}")
+
+            done, _ = concurrent.futures.wait(running,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                # re-raises any error from the stage
+                results[name] = future.result()
+                logging.debug(f"Finished stage: {name}")
+    except BaseException:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+    return results
+
+
+def run_jobs(jobs, max_cores):
+    """
+    Run a dependency graph of jobs that each use a number of cores, starting
+    ready jobs in priority order whenever enough cores are free
+
+    Parameters:
+        jobs: (dict) {job name: (function, [dependency job names], cores,
+                                 priority)}
+              where function is called with the {job name: result} dict of
+              the finished jobs and lower priorities start first
+        max_cores: (int) total cores shared by the running jobs
+    Returns:
+        results: (dict) {job name: result}
+    """
+    results = {}
+    pending = dict(jobs)
+    running = {}
+    free_cores = max_cores
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_cores) as pool:
+        while pending or running:
+            ready = sorted((name for name, (_, dependencies, _, _) in pending.items() \
+                                if all(dependency in results \
+                                       for dependency in dependencies)),
+                           key=lambda name: pending[name][3])
+            for name in ready:
+                function, _, cores, _ = pending[name]
+                cores = min(cores, max_cores)
+                # wait for cores rather than letting lower priority jobs
+                # starve the ready job
+                if cores > free_cores:
+                    break
+                logging.debug(f"Starting job: {name} ({cores} cores)")
+                running[pool.submit(function, dict(results))] = (name, cores)
+                free_cores -= cores
+                del pending[name]
+
+            if not running:
+                raise ValueError(f"Jobs can't be scheduled: {list(pending)}")
+
+            done, _ = concurrent.futures.wait(running,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name, cores = running.pop(future)
+                free_cores += cores
+                # re-raises any error from the job
+                results[name] = future.result()
+                logging.debug(f"Finished job: {name}")
+
+    return results
+
+
+def run_in_pool(function, items, max_workers):
+    """
+    Call function on each item with at most max_workers running at once
+
+    Parameters:
+        function: callable taking a single item
+        items: (list) items to process
+        max_workers: (int) maximum concurrent calls
+    Returns:
+        results: (list) function results in the order of items
+    """
+    if len(items) == 0:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(function, items))
+
+
+def fingerprint(inputs):
+    """
+    Fingerprint of the inputs a stage's output depends on
+
+    Parameters:
+        inputs: (dict) JSON serialisable description of the stage inputs
+    Returns:
+        fingerprint: (str) hex digest
+    """
+    encoded = json.dumps(inputs, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def stage_complete(stage_dir, stage_fingerprint):
+    """
+    Check whether a stage finished with the same inputs
+    """
+    marker_fp = os.path.join(stage_dir, STAGE_MARKER)
+    if not os.path.exists(marker_fp):
+        return False
+    with open(marker_fp) as fh:
+        marker = json.load(fh)
+    return marker['fingerprint'] == stage_fingerprint
+
+
+def checkpointed(stage_dir, inputs, run, reload):
+    """
+    Run a stage writing its output to stage_dir unless a previous run already
+    completed it with the same inputs, in which case its results are
+    reloaded instead.  Output of incomplete or outdated runs is removed.
+
+    Parameters:
+        stage_dir: path to the stage's output directory
+        inputs: (dict) description of the inputs the stage depends on
+        run: callable running the stage (creating stage_dir)
+        reload: callable loading the results of a completed stage
+    Returns:
+        result of run or reload
+    """
+    stage_fingerprint = fingerprint(inputs)
+    if stage_complete(stage_dir, stage_fingerprint):
+        logging.info(f"Reusing completed stage output: {stage_dir}")
+        return reload()
+
+    if os.path.exists(stage_dir):
+        logging.info(f"Removing incomplete or outdated stage output: {stage_dir}")
+        shutil.rmtree(stage_dir)
+
+    result = run()
+
+    with open(os.path.join(stage_dir, STAGE_MARKER), 'w') as fh:
+        json.dump({'fingerprint': stage_fingerprint, 'inputs': inputs,
+                   'completed': int(time.time())}, fh, default=str)
+    return result
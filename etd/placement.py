@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+from Bio import Phylo
+from Bio.Phylo.BaseTree import Clade
+
+
+def read_tree(tree_fp):
+    """
+    Read a newick genome tree (see database.build_mashtree)
+
+    Returns:
+        tree: (Bio.Phylo tree)
+        leaves: (dict) {leaf name: leaf clade}
+    """
+    tree = Phylo.read(tree_fp, 'newick')
+    return tree, {leaf.name: leaf for leaf in tree.get_terminals()}
+
+
+def write_tree(tree, tree_fp):
+    """
+    Atomically replace a newick genome tree
+    """
+    with open(tree_fp + '.tmp', 'w') as fh:
+        Phylo.write(tree, fh, 'newick')
+    os.replace(tree_fp + '.tmp', tree_fp)
+
+
+def graft(tree, leaves, name, distances):
+    """
+    Attach a new leaf to a tree next to its nearest leaf using its distances
+    to the existing leaves, without rebuilding the tree
+
+    The new leaf joins the branch above its nearest leaf a, at the point the
+    three-point (neighbour-joining) estimate puts it from the second nearest
+    leaf b: (d(q, a) + d(a, b) - d(q, b)) / 2 above a, limited to the branch.
+
+    Parameters:
+        tree: (Bio.Phylo tree)
+        leaves: (dict) {leaf name: leaf clade}, updated with the new leaf
+        name: (str) name of the new leaf
+        distances: (dict) {leaf name: distance to the new leaf}
+    Returns:
+        leaf: (Clade) the new leaf
+    """
+    nearest = sorted((distance, leaf) for leaf, distance in distances.items() \
+                        if leaf in leaves)
+    if len(nearest) == 0:
+        raise ValueError(f"No distances from {name} to leaves of the tree")
+
+    distance_a, a = nearest[0]
+    a = leaves[a]
+    branch_length = max(a.branch_length or 0.0, 0.0)
+    above_a = 0.0
+    if len(nearest) > 1:
+        distance_b, b = nearest[1]
+        above_a = (distance_a + tree.distance(a, leaves[b]) - distance_b) / 2
+    above_a = min(max(above_a, 0.0), branch_length)
+
+    leaf = Clade(name=name, branch_length=max(distance_a - above_a, 0.0))
+    path = tree.get_path(a)
+    parent = path[-2] if len(path) > 1 else tree.root
+    if parent is a:
+        # single leaf tree
+        tree.root = Clade(clades=[a, leaf])
+    else:
+        joint = Clade(branch_length=branch_length - above_a, clades=[a, leaf])
+        parent.clades[parent.clades.index(a)] = joint
+        a.branch_length = above_a
+
+    leaves[name] = leaf
+    logging.debug(f"Grafted {name} next to {a.name} ({distance_a:.6g})")
+    return leaf
+
+
+def graft_clusters(tree, leaves, clusters):
+    """
+    Attach the members of near-duplicate clusters next to their leader, each
+    cluster as a single polytomy replacing its leader's leaf, in one pass
+    over the tree
+
+    Unlike grafting the members one at a time (see graft) the tree only
+    gains one level per cluster however large the cluster is.
+
+    Parameters:
+        tree: (Bio.Phylo tree)
+        leaves: (dict) {leaf name: leaf clade}, updated with the members
+        clusters: (dict) {leader name: {member name: distance to the leader}}
+    """
+    parents = {id(child): clade for clade in tree.find_clades() \
+                    for child in clade.clades}
+    for leader_name, members in clusters.items():
+        if len(members) == 0:
+            continue
+        leader = leaves[leader_name]
+        cluster = Clade(branch_length=leader.branch_length, clades=[leader])
+        leader.branch_length = 0.0
+        for name, distance in members.items():
+            leaves[name] = Clade(name=name, branch_length=max(distance, 0.0))
+            cluster.clades.append(leaves[name])
+
+        parent = parents.get(id(leader))
+        if parent is None:
+            # single leaf tree
+            tree.root = cluster
+        else:
+            parent.clades[parent.clades.index(leader)] = cluster
+        parents[id(leader)] = cluster
+        logging.debug(f"Grafted {len(members)} genomes next to {leader_name}")
+
+
+def place(tree_fp, name, distances, placed_fp):
+    """
+    Write a copy of a genome tree with a query genome grafted onto it using
+    its distances to some of the tree's genomes (e.g. its closest relatives),
+    in time linear in the size of the tree rather than rebuilding it
+
+    Parameters:
+        tree_fp: path to the newick genome tree
+        name: (str) name of the query leaf
+        distances: (dict) {genome name: distance to the query}
+        placed_fp: path to write the tree with the query attached to
+    Returns:
+        name: (str) name given to the query leaf (suffixed with _query if
+              the tree already has a genome with that name)
+    """
+    tree, leaves = read_tree(tree_fp)
+    if name in leaves:
+        name = name + '_query'
+    leaf = graft(tree, leaves, name, distances)
+    write_tree(tree, placed_fp)
+    logging.info(f"Placed {name} on {tree_fp} ({leaf.branch_length:.6g} "
+                 f"from its attachment point): {placed_fp}")
+    return name
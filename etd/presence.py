@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import json
+import shutil
+import tarfile
+import logging
+import functools
+import joblib
+import numpy as np
+import pandas as pd
+
+
+def rgi_table_path(rgi_path):
+    """
+    RGI writes its tab-separated table (.txt) next to the .json output
+    """
+    table_path = os.path.splitext(rgi_path)[0] + '.txt'
+    if os.path.exists(table_path):
+        return table_path
+    return rgi_path
+
+
+def read_rgi_table(rgi_path, member=None):
+    """
+    Read an RGI table from disk or, when member is given, from the RGI
+    results tarball at rgi_path without extracting it
+
+    Parameters:
+        rgi_path: path to the RGI output (or RGI results tarball)
+        member: (str) name of the RGI output in the tarball
+    Returns:
+        rgi: (pd.df) RGI table
+    """
+    if member is None:
+        return pd.read_csv(rgi_table_path(rgi_path), sep='\t')
+    return read_tar_rgi_tables(rgi_path, [member])[member]
+
+
+def read_tar_rgi_tables(rgi_tarball, members):
+    """
+    Read the RGI tables of several members of an RGI results tarball in a
+    single pass over the archive without extracting it
+
+    Parameters:
+        rgi_tarball: path to the RGI results tarball
+        members: (iterable) names of the RGI outputs in the tarball
+    Returns:
+        tables: (dict) {member: RGI table}
+    """
+    table_members = {os.path.splitext(member)[0] + '.txt': member \
+                        for member in members}
+    tables = {}
+    with tarfile.open(rgi_tarball, 'r|*') as tar_fh:
+        for tar_member in tar_fh:
+            if tar_member.name in table_members:
+                data = tar_fh.extractfile(tar_member).read()
+                tables[table_members[tar_member.name]] = \
+                        pd.read_csv(io.BytesIO(data), sep='\t')
+                if len(tables) == len(table_members):
+                    break
+    missing = set(table_members) - set(os.path.splitext(member)[0] + '.txt' \
+                                       for member in tables)
+    if len(missing) > 0:
+        raise KeyError(f"RGI tables not found in {rgi_tarball}: {sorted(missing)}")
+    return tables
+
+
+def table_args(rgi):
+    """
+    The (ARO, Best_Hit_ARO) pairs predicted in an RGI table
+    """
+    return set((int(aro), name) for aro, name in \
+            rgi[['ARO', 'Best_Hit_ARO']].itertuples(index=False, name=None))
+
+
+def read_rgi_args(rgi_path):
+    """
+    Read the (ARO, Best_Hit_ARO) pairs predicted in one RGI output
+
+    Parameters:
+        rgi_path: path to the RGI output
+    Returns:
+        args: (set) of (ARO, Best_Hit_ARO) tuples
+    """
+    return table_args(read_rgi_table(rgi_path))
+
+
+def read_genome_args(rgi_paths, cores):
+    """
+    Read the ARGs predicted for each genome in parallel
+
+    Parameters:
+        rgi_paths: (list) RGI output paths, one per genome row
+        cores: (int) number of parallel parsing jobs
+    Returns:
+        genome_args: (list) set of (ARO, Best_Hit_ARO) tuples for each genome
+    """
+    logging.info(f"Reading ARGs from {len(rgi_paths)} RGI outputs")
+    return joblib.Parallel(n_jobs=cores)(
+            joblib.delayed(read_rgi_args)(rgi_path) for rgi_path in rgi_paths)
+
+
+def build_presence_matrix(rgi_paths, presence_dir, cores):
+    """
+    Build the presence matrix from the RGI outputs of every database genome
+    (see write_presence_matrix)
+
+    Parameters:
+        rgi_paths: (list) RGI output paths, one per genome row
+        presence_dir: path to write the presence matrix to
+        cores: (int) number of parallel parsing jobs
+    """
+    write_presence_matrix(read_genome_args(rgi_paths, cores), presence_dir)
+
+
+def write_presence_matrix(genome_args, presence_dir):
+    """
+    Write a bit-packed genome x ARG presence matrix (and its inverted
+    ARG -> genomes index) from the ARGs of every database genome
+
+    presence_dir/
+        presence.json       number of genomes and ARGs
+        columns.tsv         (ARO, Best_Hit_ARO) of each column
+        presence.npy        packed uint8 genome x ARG bits (np.packbits)
+        arg_offsets.npy     CSR offsets into arg_genomes for each column
+        arg_genomes.npy     genome rows that carry each column
+
+    Parameters:
+        genome_args: (list) (ARO, Best_Hit_ARO) tuples of each genome row
+        presence_dir: path to write the presence matrix to
+    """
+    if os.path.exists(presence_dir):
+        logging.info(f"Removing previous presence matrix: {presence_dir}")
+        shutil.rmtree(presence_dir)
+    os.mkdir(presence_dir)
+
+    logging.info(f"Building ARG presence matrix for {len(genome_args)} genomes")
+    columns = {}
+    genome_columns = []
+    for args in genome_args:
+        genome_columns.append(np.array(sorted(columns.setdefault(tuple(arg), len(columns)) \
+                                              for arg in args), dtype=np.int64))
+
+    n_genomes, n_args = len(genome_columns), len(columns)
+    presence = np.zeros((n_genomes, (n_args + 7) // 8), dtype=np.uint8)
+    for row, cols in enumerate(genome_columns):
+        bits = np.zeros(presence.shape[1] * 8, dtype=bool)
+        bits[cols] = True
+        presence[row] = np.packbits(bits)
+    np.save(os.path.join(presence_dir, 'presence.npy'), presence)
+
+    # inverted index: genomes carrying each ARG
+    rows = np.concatenate([np.full(len(cols), row, dtype=np.int64) \
+            for row, cols in enumerate(genome_columns)] + [np.array([], dtype=np.int64)])
+    cols = np.concatenate(genome_columns + [np.array([], dtype=np.int64)])
+    order = np.argsort(cols, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(cols, minlength=n_args))])
+    np.save(os.path.join(presence_dir, 'arg_offsets.npy'), offsets)
+    np.save(os.path.join(presence_dir, 'arg_genomes.npy'), rows[order])
+
+    with open(os.path.join(presence_dir, 'columns.tsv'), 'w') as fh:
+        fh.write("ARO\tBest_Hit_ARO\n")
+        for aro, name in columns:
+            fh.write(f"{aro}\t{name}\n")
+    with open(os.path.join(presence_dir, 'presence.json'), 'w') as fh:
+        json.dump({'genomes': n_genomes, 'args': n_args}, fh)
+
+    logging.info(f"Presence matrix has {n_genomes} genomes x {n_args} ARGs")
+
+
+class PresenceMatrix():
+    """
+    Memory-mapped genome x ARG presence matrix (see build_presence_matrix)
+    """
+    def __init__(self, presence_dir):
+        with open(os.path.join(presence_dir, 'presence.json')) as fh:
+            shape = json.load(fh)
+        self.n_genomes = shape['genomes']
+        self.n_args = shape['args']
+
+        columns = pd.read_csv(os.path.join(presence_dir, 'columns.tsv'),
+                              sep='\t', dtype={'ARO': int, 'Best_Hit_ARO': str})
+        self.columns = list(columns.itertuples(index=False, name=None))
+        self.column_index = {arg: col for col, arg in enumerate(self.columns)}
+
+        self.presence = np.load(os.path.join(presence_dir, 'presence.npy'),
+                                mmap_mode='r')
+        self.arg_offsets = np.load(os.path.join(presence_dir, 'arg_offsets.npy'),
+                                   mmap_mode='r')
+        self.arg_genomes = np.load(os.path.join(presence_dir, 'arg_genomes.npy'),
+                                   mmap_mode='r')
+
+    @classmethod
+    def from_bundle(cls, etd_bundle):
+        """
+        Presence matrix memory-mapped from a database bundle
+        """
+        matrix = cls.__new__(cls)
+        matrix.columns = [tuple(arg) for arg in etd_bundle.json('presence/columns')]
+        matrix.column_index = {arg: col for col, arg in enumerate(matrix.columns)}
+        matrix.presence = etd_bundle.array('presence/presence')
+        matrix.arg_offsets = etd_bundle.array('presence/arg_offsets')
+        matrix.arg_genomes = etd_bundle.array('presence/arg_genomes')
+        matrix.n_genomes = matrix.presence.shape[0]
+        matrix.n_args = len(matrix.columns)
+        return matrix
+
+    def union(self, rows):
+        """
+        Bit vector of the ARGs present in any of the genome rows
+        """
+        if len(rows) == 0:
+            return np.zeros(self.n_args, dtype=bool)
+        packed = np.bitwise_or.reduce(self.presence[rows], axis=0)
+        return np.unpackbits(packed)[:self.n_args].astype(bool)
+
+    def prevalence(self, rows):
+        """
+        Number of the genome rows carrying each ARG
+        """
+        if len(rows) == 0:
+            return np.zeros(self.n_args, dtype=np.int64)
+        bits = np.unpackbits(self.presence[rows], axis=1)[:, :self.n_args]
+        return bits.sum(axis=0)
+
+    def args_to_vector(self, args):
+        """
+        Bit vector of a set of (ARO, Best_Hit_ARO) pairs and the pairs that
+        aren't columns of the matrix
+        """
+        vector = np.zeros(self.n_args, dtype=bool)
+        unknown = set()
+        for arg in args:
+            if arg in self.column_index:
+                vector[self.column_index[arg]] = True
+            else:
+                unknown.add(arg)
+        return vector, unknown
+
+    def genomes_with(self, arg):
+        """
+        Genome rows carrying an (ARO, Best_Hit_ARO) pair
+        """
+        if arg not in self.column_index:
+            return np.array([], dtype=np.int64)
+        col = self.column_index[arg]
+        return np.array(self.arg_genomes[self.arg_offsets[col]:self.arg_offsets[col + 1]])
+
+
+@functools.lru_cache(maxsize=None)
+def load_presence_matrix(presence_dir):
+    """
+    Load the presence matrix once per process (e.g. shared by a cohort)
+    """
+    return PresenceMatrix(presence_dir)
@@ -2,57 +2,157 @@
 # -*- coding: utf-8 -*-
 
 import pandas as pd
-import subprocess
+import numpy as np
 import os, sys
-import glob
 import logging
+import joblib
 
-def run_mash(input_genome, database_dir, num_threads, run_name):
+from etd import sketch
+from etd import database
+from etd import presence
+from etd import bundle
+
+def load_reference_sketch(database_dir):
+    """
+    Load the memory-mapped reference sketches of the database
+    """
+    etd_bundle = bundle.load_bundle(database_dir)
+    if etd_bundle is not None:
+        return sketch.ReferenceSketch.from_bundle(etd_bundle)
+
+    sketch_dir = os.path.join(database_dir, 'etd_db', 'sketch')
+    if not os.path.exists(os.path.join(sketch_dir, 'sketch.json')):
+        logging.error(f"Reference sketch {sketch_dir} doesn't exist, "
+                      "(re)build the database with `etd.py database`")
+        sys.exit(1)
+    return sketch.ReferenceSketch(sketch_dir)
+
+
+def hits_to_distances(hits, reference, input_genome, containment=False):
+    """
+    Convert (distance, row) search hits into a mash distance dataframe (with
+    the fraction of the query each relative contains for containment hits)
+    """
+    mash_distances = pd.DataFrame({input_genome: [distance for distance, _ in hits]},
+                                  index=reference.names[[row for _, row in hits]])
+    if containment:
+        mash_distances['containment'] = \
+                (1 - mash_distances[input_genome]) ** reference.params['kmer']
+    return mash_distances
+
+
+def write_mash_distances(mash_distances, run_name):
     """
-    Run mash for the input genome vs the CARD prevalence sketch (premade)
+    Write the mash distances of the closest relatives to the run folder
+    """
+    mash_output_dir = os.path.join(run_name, 'mash')
+    os.mkdir(mash_output_dir)
+
+    mash_output_file = os.path.join(mash_output_dir, 'mash_distances.tsv')
+    mash_distances.to_csv(mash_output_file, sep='\t')
+    logging.debug(f"Mash output dumped to {mash_output_file}")
+
+
+def run_mash(input_genome, database_dir, mash_distance, num_threads, run_name,
+             top_k=10, containment=False):
+    """
+    Compare the input genome to the CARD prevalence reference sketches
+    (premade) using the in-process MinHash engine, equivalent to `mash dist`
+    or, for containment, `mash screen` (relatives ranked by how much of the
+    input genome they contain e.g. for plasmids or partial assemblies)
 
     Parameters:
         input_genome: path to the input genome fasta
         database_dir: path to the CARD prevalence database and mash sketch
+        mash_distance: (float) maximum mash distance to retain
         num_threads: (int) number of threads to use for mash
         run_name: path to output folder
+        top_k: (int) number of closest genomes to retain
+        containment: (bool) rank by containment distance (one minus the
+                     mash screen identity) instead of mash distance
     Return:
-        mash_distances: (pd.df) dataframe of mash calculated distances
+        mash_distances: (pd.df) dataframe of mash distances to the top_k
+                        closest reference genomes within mash_distance
     """
-    # create output directory
-    mash_output_dir = os.path.join(run_name, 'mash')
-    os.mkdir(mash_output_dir)
+    # load memory-mapped reference sketches
+    reference = load_reference_sketch(database_dir)
+    logging.info(f"Finding relatives in {len(reference)} reference sketches "
+                 f"with {num_threads} threads")
+
+    # sketch the query with the reference parameters
+    query = sketch.sketch_genome(input_genome, reference.params)
+
+    if containment:
+        # a partial genome is far from every representative by mash
+        # distance so every shard is screened
+        logging.info(f"Screening {len(reference)} reference sketches for "
+                     f"containment of the query")
+        hits = reference.search(query, mash_distance, top_k, num_threads,
+                                metric='containment')
+    else:
+        # only search the taxa whose representatives are close enough
+        rows, taxa = reference.route(query, mash_distance)
+        logging.info(f"Searching {len(rows)} reference sketches in "
+                     f"{len(taxa)} taxa")
+        logging.debug(f"Taxa searched: {str(taxa)}")
+
+        # near-duplicate genomes are only compared when their cluster
+        # leader is close enough
+        hits = reference.search_leaders([query], mash_distance, top_k,
+                                        num_threads, rows)[0]
+    mash_distances = hits_to_distances(hits, reference, input_genome,
+                                       containment)
+    write_mash_distances(mash_distances, run_name)
 
-    # check mash version and log it
-    mash_version = subprocess.run(["mash", "--version"],
-                                 check=True,
-                                 stdout=subprocess.PIPE,
-                                 encoding="utf-8")
-    mash_version = mash_version.stdout.strip()
-    logging.info(f"Finding relatives using Mash (v{mash_version}) with {num_threads} threads")
-
-    # run mash
-    reference_sketch = os.path.join(database_dir, 'etd_db', 'card_prev.msh')
-    mash_output = subprocess.run(['mash', 'dist', '-t', '-p', str(num_threads),
-                                  reference_sketch, input_genome],
-                                 check=True,
-                                 stdout=subprocess.PIPE,
-                                 encoding='utf-8')
-
-    # parse mash output
-    mash_output_file = os.path.join(mash_output_dir, 'mash_distances.tsv')
-    with open(mash_output_file, 'w') as fh:
-        fh.write(mash_output.stdout)
-    logging.debug(f"Mash output dumped to {mash_output_file}")
+    return mash_distances
 
-    # get dataframe and take transpose
-    mash_distances = pd.read_csv(mash_output_file, sep='\t', index_col=0).T
 
-    return mash_distances
+def find_cohort_relatives(input_genomes, database_dir, mash_distance,
+                          num_threads, top_k=10, containment=False):
+    """
+    Find the closest relatives of several genomes with a single pass over
+    the reference sketches
+
+    Parameters:
+        input_genomes: (list) paths to the input genome fastas
+        database_dir: path to the CARD prevalence database and mash sketch
+        mash_distance: (float) maximum mash distance to retain
+        num_threads: (int) number of threads to use
+        top_k: (int) number of closest genomes to retain per genome
+        containment: (bool) rank by containment distance (see run_mash)
+    Returns:
+        cohort_distances: (dict) {input genome: mash distance dataframe}
+    """
+    reference = load_reference_sketch(database_dir)
+    logging.info(f"Sketching {len(input_genomes)} genomes with "
+                 f"{num_threads} threads")
+    queries = joblib.Parallel(n_jobs=num_threads)(
+            joblib.delayed(sketch.sketch_genome)(input_genome,
+                                                 reference.params) \
+                    for input_genome in input_genomes)
+
+    if containment:
+        logging.info(f"Screening {len(reference)} reference sketches for "
+                     f"containment of {len(input_genomes)} genomes")
+        cohort_hits = reference.search_many(queries, mash_distance, top_k,
+                                            num_threads,
+                                            metric='containment')
+    else:
+        # search the taxa any of the genomes was routed to
+        rows = [reference.route(query, mash_distance)[0] for query in queries]
+        rows = np.unique(np.concatenate(rows + [np.array([], dtype=np.int64)]))
+        logging.info(f"Finding relatives of {len(input_genomes)} genomes in "
+                     f"{len(rows)} reference sketches")
+
+        cohort_hits = reference.search_leaders(queries, mash_distance, top_k,
+                                               num_threads, rows)
+    return {input_genome: hits_to_distances(hits, reference, input_genome,
+                                            containment) \
+                for input_genome, hits in zip(input_genomes, cohort_hits)}
 
 
 def find_relatives(input_genome, database_dir, mash_distance,
-                   num_threads, run_name):
+                   num_threads, run_name, containment=False):
     """
     Using MASH find the nearest reference sequences in CARD prevalence
 
@@ -61,22 +161,16 @@ def find_relatives(input_genome, database_dir, mash_distance,
         database_dir: path to the CARD prevalence database and mash sketch
         num_threads: (int) number of threads to use for mash
         run_name: path to output folder
+        containment: (bool) rank relatives by containment (see run_mash)
     Returns:
         closest_taxa: (list) of closest relative genome names
     """
-    # run mash
-    mash_distances = run_mash(input_genome, database_dir,
-                              num_threads, run_name)
-
-    # get closest relatives (distances < 0.02)
-    closest = mash_distances[mash_distances[input_genome] <= mash_distance]
-    closest = closest.sort_values(input_genome, ascending=True)
-
-    # grab top 10 or all if fewer than 10 genomes had a hit this close
-    if closest.shape[0] > 10:
-        closest_taxa = closest.head(10).values
-    else:
-        closest_taxa = closest.index
+    # run mash and grab top 10 or all if fewer than 10 genomes had a hit
+    # this close
+    closest = run_mash(input_genome, database_dir, mash_distance,
+                       num_threads, run_name, top_k=10,
+                       containment=containment)
+    closest_taxa = closest.index
 
     logging.debug(f"Closest relatives found: {str(closest_taxa)}")
     return closest_taxa
@@ -96,22 +190,31 @@ def get_rgi_results(closest_relatives, database_dir):
     """
     logging.debug("Gathering RGI outputs from CARD-prev database")
     closest_relative_rgi = {}
+    # {rgi tarball: {member: genome}}
+    tarball_members = {}
     for genome in closest_relatives:
-        rgi_glob = os.path.join(database_dir, "rgi_results", "*",
-                                genome + ".json")
-        rgi_path = glob.glob(rgi_glob)
-        if len(rgi_path) > 1:
-            logging.error(f"Duplicate matches to rgi output for {rgi_path}: {str(rgi_path)}")
-            sys.exit(1)
-        else:
-            rgi_path = rgi_path[0]
+        paths = database.get_accession_paths(genome, database_dir)
+        # databases built with --stream index RGI tarball members
+        rgi_member = paths.get('rgi_member')
+        rgi_path = paths['rgi']
+        if rgi_member is None:
+            rgi_path = presence.rgi_table_path(rgi_path)
 
         if not os.path.exists(rgi_path):
             logging.error(f"RGI output for relative {genome} cannot be found {rgi_path}")
             sys.exit(1)
-        else:
+        elif rgi_member is None:
             # store dataframe in dict keyed with genome name
-            closest_relative_rgi[genome] = pd.read_csv(rgi_path, sep='\t')
+            closest_relative_rgi[genome] = presence.read_rgi_table(rgi_path)
+        else:
+            # filled in below so each tarball is only read once
+            closest_relative_rgi[genome] = None
+            tarball_members.setdefault(rgi_path, {})[rgi_member] = genome
         logging.debug(f"Recovering RGI table for {genome}: {rgi_path}")
 
+    for rgi_tarball, members in tarball_members.items():
+        tables = presence.read_tar_rgi_tables(rgi_tarball, members)
+        for member, genome in members.items():
+            closest_relative_rgi[genome] = tables[member]
+
     return closest_relative_rgi
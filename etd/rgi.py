@@ -4,9 +4,23 @@
 import logging
 import subprocess
 import os, sys
+import json
+import heapq
+import shutil
+import hashlib
+import functools
+import joblib
 import pandas as pd
 
-def run_rgi(input_genome, num_threads, run_name):
+from etd import cache
+from etd import sketch
+
+# prodigal trains its gene model on each input so shards are kept large
+MIN_SHARD_LENGTH = 1000000
+
+
+def run_rgi(input_genome, num_threads, run_name, cache_dir=None,
+            cache_size=10, shards=1):
     """
     Run RGI on the input genome
 
@@ -14,13 +28,71 @@ def run_rgi(input_genome, num_threads, run_name):
         input_genome: path to the input genome fasta
         num_threads: (int) number of threads to use for rgi
         run_name: path to output folder
+        cache_dir: path to a persistent RGI result cache (or None to disable)
+        cache_size: (float) maximum size of the RGI result cache in GB
+        shards: (int) number of contig shards to run RGI on in parallel
+                (prodigal trains on each shard so predictions near the
+                thresholds may differ from a single run)
     """
 
     # make the run_folder
     rgi_output_dir = os.path.join(run_name, 'rgi')
     os.mkdir(rgi_output_dir)
 
-    # get the rgi and card version
+    rgi_version, card_version = get_versions()
+
+    output_name = get_output_name(run_name)
+    output_files = {'rgi.txt': output_name + ".txt",
+                    'rgi.json': output_name + ".json"}
+
+    # results are reused for identical input sequences, RGI, CARD and
+    # sharding (which can change the predicted ORFs)
+    if cache_dir:
+        rgi_cache = cache.ResultCache(cache_dir, cache_size * 1024 ** 3)
+        cache_key = hashlib.sha256(":".join([cache.file_digest(input_genome),
+                                             rgi_version,
+                                             card_version,
+                                             str(shards)]).encode()).hexdigest()
+        if rgi_cache.get(cache_key, output_files):
+            logging.info(f"Using cached RGI (v{rgi_version}) with CARD "
+                         f"(v{card_version}) results: {cache_key}")
+            return pd.read_csv(output_files['rgi.txt'], sep='\t')
+
+    logging.info(f"Running RGI (v{rgi_version}) with CARD (v{card_version})")
+    logging.debug(f"Using {num_threads} threads")
+
+    # run RGI
+    if shards > 1:
+        run_sharded_rgi(input_genome, output_name, num_threads, shards)
+    else:
+        run_rgi_main(input_genome, output_name, num_threads)
+
+    # check rgi output
+    output_tsv = output_name + ".txt"
+    if os.path.exists(output_tsv):
+        rgi_output = pd.read_csv(output_tsv, sep='\t')
+        logging.debug("RGI run successful")
+    else:
+        logging.error(f"RGI output '{output_tsv}' does not exist")
+        sys.exit(1)
+
+    if cache_dir:
+        logging.debug(f"Caching RGI results: {cache_key}")
+        rgi_cache.put(cache_key, output_files)
+
+    return rgi_output
+
+
+@functools.lru_cache(maxsize=None)
+def get_versions():
+    """
+    Versions of the installed RGI and its loaded CARD database (looked up
+    once per process)
+
+    Returns:
+        rgi_version: (str) RGI version
+        card_version: (str) CARD version
+    """
     rgi_version = subprocess.run(["rgi", "main", "--version"],
                                  check=True,
                                  stdout=subprocess.PIPE,
@@ -32,25 +104,132 @@ def run_rgi(input_genome, num_threads, run_name):
                                  stdout=subprocess.PIPE,
                                  encoding="utf-8")
     card_version = card_version.stdout.strip()
+    return rgi_version, card_version
 
-    logging.info(f"Running RGI (v{rgi_version}) with CARD (v{card_version})")
-    logging.debug(f"Using {num_threads} threads")
 
-    # run RGI
-    output_name = os.path.join(rgi_output_dir, run_name)
-    subprocess.run(['rgi', 'main', '--input_sequence', input_genome,
+def get_output_name(run_name):
+    """
+    RGI output name (without extension) for a run folder
+    """
+    return os.path.join(run_name, 'rgi',
+                        os.path.basename(os.path.normpath(run_name)))
+
+
+def run_rgi_main(input_sequence, output_name, num_threads):
+    """
+    Run `rgi main` on a set of contigs
+    """
+    subprocess.run(['rgi', 'main', '--input_sequence', input_sequence,
                     '--output_file', output_name, '--alignment_tool', 'DIAMOND',
                     '--num_threads', str(num_threads), '--clean'],
                     check=True)
 
-    # check rgi output
-    output_tsv = output_name + ".txt"
-    if os.path.exists(output_tsv):
-        rgi_output = pd.read_csv(output_tsv, sep='\t')
-        logging.debug("RGI run successful")
-    else:
-        logging.error(f"RGI output '{output_tsv}' does not exist")
-        sys.exit(1)
 
-    return rgi_output
+def shard_contigs(input_genome, shards, shard_dir):
+    """
+    Split the input contigs into shards balanced by total sequence length
+    (longest contigs first onto the currently smallest shard)
+
+    Parameters:
+        input_genome: path to the input genome fasta
+        shards: (int) maximum number of shards
+        shard_dir: path to write the shard fastas to
+    Returns:
+        shard_fps: (list) paths of the shard fastas
+        contig_order: (dict) {contig name: position in input_genome}
+    """
+    with open(input_genome, 'rb') as fh:
+        contigs = list(sketch.read_fasta(fh))
+    contig_order = {name.split()[0]: ix for ix, (name, _) in enumerate(contigs)}
+
+    # don't make shards too small for prodigal to train on
+    total_length = sum(len(seq) for _, seq in contigs)
+    shards = max(1, min(shards, len(contigs), total_length // MIN_SHARD_LENGTH))
+
+    shard_contigs = [[] for _ in range(shards)]
+    shard_lengths = [(0, shard) for shard in range(shards)]
+    for ix in sorted(range(len(contigs)), key=lambda ix: -len(contigs[ix][1])):
+        length, shard = heapq.heappop(shard_lengths)
+        shard_contigs[shard].append(ix)
+        heapq.heappush(shard_lengths, (length + len(contigs[ix][1]), shard))
+
+    shard_fps = []
+    for shard, contig_ixs in enumerate(shard_contigs):
+        shard_fp = os.path.join(shard_dir, f"shard_{shard}.fasta")
+        with open(shard_fp, 'wb') as fh:
+            for ix in sorted(contig_ixs):
+                name, seq = contigs[ix]
+                fh.write(b'>' + name.encode() + b'\n' + seq + b'\n')
+        shard_fps.append(shard_fp)
+
+    return shard_fps, contig_order
+
+
+def merge_rgi_outputs(shard_outputs, contig_order, output_name):
+    """
+    Merge per-shard RGI tables and json into a single output ordered by
+    input contig then ORF number, as a single RGI run orders its hits
+
+    Parameters:
+        shard_outputs: (list) RGI output names (without extension) per shard
+        contig_order: (dict) {contig name: position in the input genome}
+        output_name: RGI output name (without extension) to write
+    """
+    tables = [pd.read_csv(shard + ".txt", sep='\t') for shard in shard_outputs]
+    merged = pd.concat(tables, ignore_index=True)
+
+    # RGI's Contig column is the prodigal ORF name: <contig>_<orf number>
+    orf = merged['Contig'].astype(str).str.rsplit('_', n=1)
+    order = pd.DataFrame({'contig': orf.str[0].map(contig_order)\
+                                        .fillna(len(contig_order)),
+                          'orf': pd.to_numeric(orf.str[1], errors='coerce')})
+    merged = merged.loc[order.sort_values(['contig', 'orf'], kind='stable').index]
+    merged.to_csv(output_name + ".txt", sep='\t', index=False)
+
+    merged_json = {}
+    for shard in shard_outputs:
+        with open(shard + ".json") as fh:
+            merged_json.update(json.load(fh))
+    merged_json = {orf_id: merged_json[orf_id] for orf_id in \
+                    sorted(merged_json, key=lambda orf_id: \
+                           contig_order.get(orf_id.split()[0].rsplit('_', 1)[0],
+                                            len(contig_order)))}
+    with open(output_name + ".json", 'w') as fh:
+        json.dump(merged_json, fh)
+
+
+def run_sharded_rgi(input_genome, output_name, num_threads, shards):
+    """
+    Run RGI on length-balanced contig shards in parallel and merge the
+    outputs into one table in single run order
+
+    Prodigal trains its gene model on each shard rather than the whole
+    genome so the predicted ORFs, and so the hits, may differ from a single
+    RGI run.  If the genome is too small to split RGI is run on it directly.
+
+    Parameters:
+        input_genome: path to the input genome fasta
+        output_name: RGI output name (without extension)
+        num_threads: (int) total number of threads to use
+        shards: (int) number of contig shards
+    """
+    shard_dir = output_name + "_shards"
+    os.mkdir(shard_dir)
+    shard_fps, contig_order = shard_contigs(input_genome, shards, shard_dir)
+    if len(shard_fps) == 1:
+        shutil.rmtree(shard_dir)
+        run_rgi_main(input_genome, output_name, num_threads)
+        return
+
+    threads_per_shard = max(1, num_threads // len(shard_fps))
+    logging.info(f"Running RGI on {len(shard_fps)} contig shards with "
+                 f"{threads_per_shard} threads each")
+
+    shard_outputs = [os.path.splitext(shard_fp)[0] for shard_fp in shard_fps]
+    joblib.Parallel(n_jobs=len(shard_fps), prefer='threads')(
+            joblib.delayed(run_rgi_main)(shard_fp, shard_output,
+                                         threads_per_shard) \
+                    for shard_fp, shard_output in zip(shard_fps, shard_outputs))
 
+    merge_rgi_outputs(shard_outputs, contig_order, output_name)
+    shutil.rmtree(shard_dir)
@@ -0,0 +1,963 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import gzip
+import tarfile
+import json
+import shutil
+import heapq
+import itertools
+import logging
+import joblib
+import numpy as np
+import pandas as pd
+
+# mash defaults (`mash sketch -k 21 -s 1000 -S 42`)
+DEFAULT_PARAMS = {'kmer': 21, 'sketch_size': 1000, 'seed': 42}
+
+# number of k-mers hashed at once when sketching
+KMER_CHUNK = 1000000
+
+# number of reference sketches compared at once
+ROW_BLOCK = 4096
+
+# number of reference sketches searched by each parallel job
+SHARD_SIZE = 65536
+
+# representative sketches per taxon used to route queries
+REPRESENTATIVES_PER_TAXON = 10
+
+# genomes closer than this to a cluster leader are collapsed into its
+# cluster (near-duplicates, e.g. outbreak isolates)
+COLLAPSE_DISTANCE = 0.0005
+
+# rows clustered against the leaders at once
+CLUSTER_BLOCK = 1024
+
+# padding for reference sketches with fewer hashes than the sketch size
+EMPTY_HASH = np.iinfo(np.uint64).max
+
+# MurmurHash3_x64_128 constants
+C1 = np.uint64(0x87c37b91114253d5)
+C2 = np.uint64(0x4cf5ad432745937f)
+FMIX1 = np.uint64(0xff51afd7ed558ccd)
+FMIX2 = np.uint64(0xc4ceb9fe1a85ec53)
+
+# A, C, G, T -> 0-3 and everything else invalid (4) after upper-casing
+NT_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    NT_CODES[base] = code
+    NT_CODES[ord(chr(base).lower())] = code
+NT_BASES = np.frombuffer(b'ACGTN', dtype=np.uint8)
+
+
+def rotl64(x, r):
+    return (x << np.uint64(r)) | (x >> np.uint64(64 - r))
+
+
+def fmix64(k):
+    k ^= k >> np.uint64(33)
+    k *= FMIX1
+    k ^= k >> np.uint64(33)
+    k *= FMIX2
+    k ^= k >> np.uint64(33)
+    return k
+
+
+def murmurhash3_x64_64(kmers, seed):
+    """
+    Vectorised MurmurHash3_x64_128 keeping the first 64-bit word, which is
+    the hash mash uses for k > 16
+
+    Parameters:
+        kmers: (np.array) uint8 matrix with one k-mer per row
+        seed: (int) hash seed
+    Returns:
+        hashes: (np.array) uint64 hash for each k-mer
+    """
+    n, length = kmers.shape
+    h1 = np.full(n, seed, dtype=np.uint64)
+    h2 = np.full(n, seed, dtype=np.uint64)
+
+    def word(start, stop):
+        # little-endian integer from the bytes [start, stop) of each k-mer
+        k = np.zeros(n, dtype=np.uint64)
+        for byte in range(stop - 1, start - 1, -1):
+            k = (k << np.uint64(8)) | kmers[:, byte].astype(np.uint64)
+        return k
+
+    with np.errstate(over='ignore'):
+        nblocks = length // 16
+        for block in range(nblocks):
+            k1 = word(block * 16, block * 16 + 8)
+            k2 = word(block * 16 + 8, block * 16 + 16)
+
+            k1 *= C1
+            k1 = rotl64(k1, 31)
+            k1 *= C2
+            h1 ^= k1
+            h1 = rotl64(h1, 27)
+            h1 += h2
+            h1 = h1 * np.uint64(5) + np.uint64(0x52dce729)
+
+            k2 *= C2
+            k2 = rotl64(k2, 33)
+            k2 *= C1
+            h2 ^= k2
+            h2 = rotl64(h2, 31)
+            h2 += h1
+            h2 = h2 * np.uint64(5) + np.uint64(0x38495ab5)
+
+        tail = nblocks * 16
+        remaining = length & 15
+        if remaining > 8:
+            k2 = word(tail + 8, tail + remaining)
+            k2 *= C2
+            k2 = rotl64(k2, 33)
+            k2 *= C1
+            h2 ^= k2
+        if remaining > 0:
+            k1 = word(tail, tail + min(remaining, 8))
+            k1 *= C1
+            k1 = rotl64(k1, 31)
+            k1 *= C2
+            h1 ^= k1
+
+        h1 ^= np.uint64(length)
+        h2 ^= np.uint64(length)
+        h1 += h2
+        h2 += h1
+        h1 = fmix64(h1)
+        h2 = fmix64(h2)
+        h1 += h2
+
+    return h1
+
+
+def read_fasta(fh):
+    """
+    Iterate over the sequences in a FASTA file handle opened in binary mode
+
+    Parameters:
+        fh: binary file handle
+    Returns:
+        generator of (name, sequence) tuples with bytes sequences
+    """
+    name = None
+    chunks = []
+    for line in fh:
+        line = line.strip()
+        if line.startswith(b'>'):
+            if name is not None:
+                yield name, b''.join(chunks)
+            name = line[1:].decode('utf-8', 'replace')
+            chunks = []
+        elif line:
+            chunks.append(line)
+    if name is not None:
+        yield name, b''.join(chunks)
+
+
+def canonical_kmer_hashes(sequence, kmer, seed):
+    """
+    Hash every canonical k-mer made only of ACGT in a sequence in the same
+    way as `mash sketch`
+
+    Parameters:
+        sequence: (bytes) nucleotide sequence
+        kmer: (int) k-mer size
+        seed: (int) hash seed
+    Returns:
+        generator of uint64 hash arrays (one per chunk of k-mers)
+    """
+    codes = NT_CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    if codes.shape[0] < kmer:
+        return
+
+    # upper-cased forward strand and its reverse complement
+    forward = NT_BASES[codes]
+    reverse = NT_BASES[np.where(codes < 4, 3 - codes, 4)][::-1]
+    forward_kmers = np.lib.stride_tricks.sliding_window_view(forward, kmer)
+    # k-mer i on the reverse strand is the reverse complement of forward k-mer i
+    reverse_kmers = np.lib.stride_tricks.sliding_window_view(reverse, kmer)[::-1]
+
+    # k-mers containing any non-ACGT character are skipped
+    invalid = np.concatenate([[0], np.cumsum(codes == 4)])
+    valid = (invalid[kmer:] - invalid[:-kmer]) == 0
+
+    for start in range(0, forward_kmers.shape[0], KMER_CHUNK):
+        stop = start + KMER_CHUNK
+        chunk_valid = valid[start:stop]
+        fwd = forward_kmers[start:stop][chunk_valid]
+        rev = reverse_kmers[start:stop][chunk_valid]
+        if fwd.shape[0] == 0:
+            continue
+
+        # lexicographically smallest strand is the canonical k-mer
+        differs = fwd != rev
+        first = differs.argmax(axis=1)
+        rows = np.arange(fwd.shape[0])
+        use_forward = ~differs.any(axis=1) | (fwd[rows, first] < rev[rows, first])
+        canonical = np.where(use_forward[:, None], fwd, rev)
+
+        yield murmurhash3_x64_64(canonical, seed)
+
+
+def bottom_hashes(hashes, new_hashes, sketch_size):
+    """
+    Merge hashes into a sorted bottom-s MinHash sketch
+    """
+    if hashes.shape[0] == sketch_size:
+        new_hashes = new_hashes[new_hashes < hashes[-1]]
+    return np.unique(np.concatenate([hashes, new_hashes]))[:sketch_size]
+
+
+def sketch_sequences(sequences, params=DEFAULT_PARAMS):
+    """
+    Build the MinHash sketch of a genome from its sequences
+
+    Parameters:
+        sequences: iterable of (name, sequence bytes) tuples
+        params: (dict) sketch parameters (kmer, sketch_size, seed)
+    Returns:
+        hashes: (np.array) sorted uint64 bottom-s hashes
+    """
+    if params['kmer'] <= 16:
+        raise ValueError("Only 64-bit mash sketches (kmer > 16) are supported")
+
+    hashes = np.array([], dtype=np.uint64)
+    for _, sequence in sequences:
+        for kmer_hashes in canonical_kmer_hashes(sequence, params['kmer'],
+                                                 params['seed']):
+            hashes = bottom_hashes(hashes, kmer_hashes, params['sketch_size'])
+    return hashes
+
+
+def sketch_genome(genome_fp, params=DEFAULT_PARAMS):
+    """
+    Sketch a (optionally gzipped) FASTA file
+
+    Parameters:
+        genome_fp: path to the genome fasta
+        params: (dict) sketch parameters (kmer, sketch_size, seed)
+    Returns:
+        hashes: (np.array) sorted uint64 bottom-s hashes
+    """
+    opener = gzip.open if genome_fp.endswith('.gz') else open
+    with opener(genome_fp, 'rb') as fh:
+        return sketch_sequences(read_fasta(fh), params)
+
+
+def sketch_fasta_bytes(data, params=DEFAULT_PARAMS):
+    """
+    Sketch a FASTA file already read into memory (e.g. a tarball member)
+    """
+    return sketch_sequences(read_fasta(io.BytesIO(data)), params)
+
+
+def iter_tar_members(tarball, suffixes):
+    """
+    Stream the files of a (compressed) tarball in archive order without
+    extracting them to disk
+
+    Parameters:
+        tarball: path to the tarball
+        suffixes: (tuple) file name suffixes of the members to read
+    Returns:
+        generator of (member name, member bytes) tuples
+    """
+    with tarfile.open(tarball, 'r|*') as tar_fh:
+        for member in tar_fh:
+            if member.isfile() and member.name.endswith(suffixes):
+                yield member.name, tar_fh.extractfile(member).read()
+
+
+def mash_distances(query, ref_hashes, ref_counts, sketch_size, kmer):
+    """
+    Vectorised equivalent of the mash dist comparison between one query
+    sketch and a matrix of reference sketches
+
+    Parameters:
+        query: (np.array) sorted uint64 query hashes
+        ref_hashes: (np.array) reference hashes, one sorted sketch per row
+        ref_counts: (np.array) number of real hashes in each reference row
+        sketch_size: (int) sketch size of the reference sketches
+        kmer: (int) k-mer size
+    Returns:
+        distances: (np.array) mash distance to each reference
+        shared: (np.array) shared hashes within the bottom-s of the union
+    """
+    n_rows, width = ref_hashes.shape
+    if query.shape[0] == 0 or n_rows == 0:
+        return np.ones(n_rows), np.zeros(n_rows, dtype=np.int64)
+
+    columns = np.arange(width)
+    positions = np.searchsorted(query, ref_hashes)
+    in_query = query[np.minimum(positions, query.shape[0] - 1)] == ref_hashes
+    in_query &= columns < ref_counts[:, None]
+
+    # rank of each reference hash within the merged (union) hash list
+    shared_before = np.cumsum(in_query, axis=1) - in_query
+    union_rank = columns + positions - shared_before
+
+    common = (in_query & (union_rank < sketch_size)).sum(axis=1)
+    union = ref_counts + query.shape[0] - in_query.sum(axis=1)
+    denom = np.minimum(union, sketch_size)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        jaccard = common / denom
+        distances = -np.log(2 * jaccard / (1. + jaccard)) / kmer
+    distances = np.where(common == 0, 1., np.minimum(distances, 1.))
+    distances = np.where(common == denom, 0., distances)
+
+    return distances, common
+
+
+def containment_distances(query, ref_hashes, ref_counts, sketch_size, kmer):
+    """
+    Screen-style (mash screen) comparison between one query sketch and a
+    matrix of reference sketches: the fraction of the query's k-mers
+    contained in each reference, estimated from the query hashes below the
+    largest hash of both sketches, as the distance 1 - containment^(1/k)
+    (one minus the mash screen identity) so it ranks like mash_distances
+
+    Unlike the mash distance this doesn't penalise a reference for being
+    much larger than the query (e.g. a plasmid or partial assembly query).
+
+    Parameters:
+        query: (np.array) sorted uint64 query hashes
+        ref_hashes: (np.array) reference hashes, one sorted sketch per row
+        ref_counts: (np.array) number of real hashes in each reference row
+        sketch_size: (int) sketch size of the reference sketches
+        kmer: (int) k-mer size
+    Returns:
+        distances: (np.array) containment distance to each reference
+        shared: (np.array) query hashes below the threshold in each reference
+    """
+    n_rows, width = ref_hashes.shape
+    if query.shape[0] == 0 or n_rows == 0:
+        return np.ones(n_rows), np.zeros(n_rows, dtype=np.int64)
+
+    # largest hash of both sketches: the sketches hold every hash below it
+    ref_max = ref_hashes[np.arange(n_rows), np.maximum(ref_counts - 1, 0)]
+    threshold = np.minimum(ref_max, query[-1])
+
+    positions = np.searchsorted(query, ref_hashes)
+    in_query = query[np.minimum(positions, query.shape[0] - 1)] == ref_hashes
+    in_query &= np.arange(width) < ref_counts[:, None]
+    in_query &= ref_hashes <= threshold[:, None]
+
+    shared = in_query.sum(axis=1)
+    query_below = np.searchsorted(query, threshold, side='right')
+    containment = shared / np.maximum(query_below, 1)
+    distances = 1. - containment ** (1. / kmer)
+    distances = np.where(ref_counts == 0, 1., distances)
+
+    return distances, shared
+
+
+# comparisons between a query and reference sketches that search ranks by
+METRICS = {'distance': mash_distances, 'containment': containment_distances}
+
+
+def search_shard(hashes_fp, shape, params, rows, counts, queries,
+                 max_distance, top_k, offset=0, metric='distance'):
+    """
+    Search one shard of the reference sketch keeping only the closest hits
+    for each query
+
+    Parameters:
+        hashes_fp: path to the reference hashes
+        shape: (tuple) shape of the reference hash matrix
+        params: (dict) sketch parameters
+        rows: (np.array) reference rows in this shard
+        counts: (np.array) number of hashes in each of those rows
+        queries: (list) sorted uint64 hashes of each query
+        max_distance: (float) maximum mash distance to retain
+        top_k: (int) number of hits to keep per query
+        offset: (int) byte offset of the hashes in hashes_fp
+        metric: (str) comparison to rank by (see METRICS)
+    Returns:
+        hits: (list) per query, up to top_k sorted (distance, row) tuples
+    """
+    compare = METRICS[metric]
+    hashes = np.memmap(hashes_fp, dtype='<u8', mode='r', shape=shape,
+                       offset=offset)
+    hits = [[] for _ in queries]
+    for start in range(0, len(rows), ROW_BLOCK):
+        block = rows[start:start + ROW_BLOCK]
+        block_hashes = np.array(hashes[block])
+        for query_ix, query in enumerate(queries):
+            distances, _ = compare(query, block_hashes,
+                                   counts[start:start + ROW_BLOCK],
+                                   params['sketch_size'], params['kmer'])
+            keep = np.flatnonzero(distances <= max_distance)
+            hits[query_ix] = heapq.nsmallest(top_k, hits[query_ix] + \
+                    list(zip(distances[keep].tolist(), block[keep].tolist())))
+    return hits
+
+
+class ReferenceSketch():
+    """
+    Memory-mapped matrix of the reference genome MinHash sketches
+
+    sketch_dir/
+        sketch.json             sketch parameters
+        names.tsv               name, taxon and hash count of each row
+        hashes.u64              row-major uint64 hashes padded to the sketch size
+        representatives.tsv     representative rows and radius of each taxon
+        clusters.tsv            leader row of each row's near-duplicate
+                                cluster and its distance to the leader
+    """
+    def __init__(self, sketch_dir):
+        self.sketch_dir = sketch_dir
+        with open(os.path.join(sketch_dir, 'sketch.json')) as fh:
+            self.params = json.load(fh)
+
+        rows = pd.read_csv(os.path.join(sketch_dir, 'names.tsv'), sep='\t',
+                           dtype={'name': str, 'taxon': str})
+        self.names = rows['name'].values
+        self.taxa = rows['taxon'].values
+        self.counts = rows['hash_count'].values.astype(np.int64)
+
+        # absolute as search workers may not share the working directory
+        self.hashes_fp = os.path.abspath(os.path.join(sketch_dir, 'hashes.u64'))
+        self.hashes_offset = 0
+        self.hashes = np.memmap(self.hashes_fp, dtype='<u8', mode='r',
+                                shape=(len(self.names),
+                                       self.params['sketch_size']))
+
+        representatives_fp = os.path.join(sketch_dir, 'representatives.tsv')
+        if os.path.exists(representatives_fp):
+            self.representatives = pd.read_csv(representatives_fp, sep='\t',
+                                               dtype={'taxon': str})
+        else:
+            self.representatives = None
+
+        clusters_fp = os.path.join(sketch_dir, 'clusters.tsv')
+        if os.path.exists(clusters_fp):
+            clusters = pd.read_csv(clusters_fp, sep='\t')
+            self.leaders = clusters['leader'].values.astype(np.int64)
+            self.leader_distances = clusters['distance'].values
+        else:
+            self.leaders = None
+            self.leader_distances = None
+
+    @classmethod
+    def from_bundle(cls, etd_bundle):
+        """
+        Reference sketches memory-mapped from a database bundle
+        """
+        reference = cls.__new__(cls)
+        reference.sketch_dir = None
+        reference.params = etd_bundle.json('sketch/params')
+        reference.names = np.array(etd_bundle.json('sketch/names'), dtype=object)
+        reference.taxa = np.array(etd_bundle.json('sketch/taxa'), dtype=object)
+        reference.counts = etd_bundle.array('sketch/counts')
+        reference.hashes = etd_bundle.array('sketch/hashes')
+        reference.hashes_fp = os.path.abspath(etd_bundle.bundle_fp)
+        reference.hashes_offset = etd_bundle.offset('sketch/hashes')
+        if 'sketch/representatives' in etd_bundle:
+            reference.representatives = pd.DataFrame(
+                    etd_bundle.json('sketch/representatives'))
+        else:
+            reference.representatives = None
+        if 'sketch/leaders' in etd_bundle:
+            reference.leaders = etd_bundle.array('sketch/leaders')
+            reference.leader_distances = \
+                    etd_bundle.array('sketch/leader_distances')
+        else:
+            reference.leaders = None
+            reference.leader_distances = None
+        return reference
+
+    def __len__(self):
+        return len(self.names)
+
+    def distances(self, query, rows=None):
+        """
+        Mash distances from a query sketch to the reference sketches
+
+        Parameters:
+            query: (np.array) sorted uint64 query hashes
+            rows: (np.array) optional subset of row indices to compare
+        Returns:
+            distances: (np.array) mash distance for each (selected) row
+        """
+        if rows is None:
+            rows = np.arange(len(self))
+
+        distances = np.ones(len(rows))
+        for start in range(0, len(rows), ROW_BLOCK):
+            block = rows[start:start + ROW_BLOCK]
+            distances[start:start + ROW_BLOCK], _ = \
+                mash_distances(query, self.hashes[block], self.counts[block],
+                               self.params['sketch_size'],
+                               self.params['kmer'])
+        return distances
+
+    def search(self, query, max_distance, top_k, num_threads, rows=None,
+               metric='distance'):
+        """
+        Find the closest reference sketches by splitting the rows into shards
+        of SHARD_SIZE searched in parallel, each keeping its own top_k, and
+        merging the per-shard hits with a heap
+
+        Parameters:
+            query: (np.array) sorted uint64 query hashes
+            max_distance: (float) maximum mash distance to retain
+            top_k: (int) number of closest hits to return
+            num_threads: (int) number of parallel search jobs
+            rows: (np.array) optional subset of row indices to search
+            metric: (str) 'distance' (mash dist) or 'containment' (mash
+                    screen, see containment_distances)
+        Returns:
+            hits: (list) up to top_k sorted (distance, row) tuples
+        """
+        return self.search_many([query], max_distance, top_k, num_threads,
+                                rows, metric)[0]
+
+    def search_many(self, queries, max_distance, top_k, num_threads,
+                    rows=None, metric='distance'):
+        """
+        As search but for several queries in a single pass over the shards
+        (each block of reference sketches is read once for all queries)
+
+        Returns:
+            hits: (list) per query, up to top_k sorted (distance, row) tuples
+        """
+        if rows is None:
+            rows = np.arange(len(self))
+
+        shards = [rows[start:start + SHARD_SIZE] \
+                    for start in range(0, len(rows), SHARD_SIZE)]
+        shard_hits = joblib.Parallel(n_jobs=min(num_threads,
+                                                max(len(shards), 1)))(
+                joblib.delayed(search_shard)(self.hashes_fp, self.hashes.shape,
+                                             self.params, shard,
+                                             self.counts[shard], queries,
+                                             max_distance, top_k,
+                                             self.hashes_offset, metric) \
+                        for shard in shards)
+
+        return [list(itertools.islice(heapq.merge(*[hits[query_ix] \
+                                                    for hits in shard_hits]),
+                                      top_k)) \
+                    for query_ix in range(len(queries))]
+
+    def search_leaders(self, queries, max_distance, top_k, num_threads,
+                       rows=None):
+        """
+        As search_many but only comparing the queries against the leaders
+        of the near-duplicate clusters, then expanding the clusters that
+        could hold one of the top_k hits: a member is at most its cluster's
+        radius further from a query than its leader (mash distances are
+        close to a metric), so clusters whose leader is further than the
+        k-th best hit plus the radius are skipped
+
+        Returns:
+            hits: (list) per query, up to top_k sorted (distance, row) tuples
+        """
+        if self.leaders is None:
+            return self.search_many(queries, max_distance, top_k,
+                                    num_threads, rows)
+        if rows is None:
+            rows = np.arange(len(self))
+
+        leader_rows = rows[self.leaders[rows] == rows]
+        radius = np.zeros(len(self))
+        np.maximum.at(radius, self.leaders, self.leader_distances)
+        max_radius = radius[leader_rows].max() if len(leader_rows) > 0 else 0
+        members = self.cluster_members()
+        logging.debug(f"Searching {len(leader_rows)} cluster leaders of "
+                      f"{len(rows)} reference sketches")
+
+        leader_hits = self.search_many(queries, max_distance + max_radius,
+                                       len(leader_rows), num_threads,
+                                       leader_rows)
+        cohort_hits = []
+        for query, hits in zip(queries, leader_hits):
+            found = []
+            for distance, leader in hits:
+                kth = max_distance
+                if len(found) >= top_k:
+                    kth = min(kth, heapq.nsmallest(top_k, found)[-1][0])
+                if distance - max_radius > kth:
+                    break
+                if distance <= max_distance:
+                    found.append((distance, leader))
+                if leader in members and distance - radius[leader] <= kth:
+                    member_rows = members[leader]
+                    found.extend((member_distance, row) for member_distance, row \
+                            in zip(self.distances(query, member_rows).tolist(),
+                                   member_rows.tolist()) \
+                            if member_distance <= max_distance)
+            cohort_hits.append(heapq.nsmallest(top_k, found))
+        return cohort_hits
+
+    def cluster_members(self):
+        """
+        Rows collapsed into each near-duplicate cluster (leaders excluded)
+
+        Returns:
+            members: (dict) {leader row: np.array of member rows}
+        """
+        if self.leaders is None:
+            return {}
+        collapsed = np.flatnonzero(self.leaders != np.arange(len(self)))
+        order = collapsed[np.argsort(self.leaders[collapsed], kind='stable')]
+        leaders, starts = np.unique(self.leaders[order], return_index=True)
+        return dict(zip(leaders.tolist(), np.split(order, starts[1:])))
+
+    def row_sketch(self, row):
+        """
+        Sorted hashes of a single reference sketch without padding
+        """
+        return np.array(self.hashes[row, :self.counts[row]])
+
+    def taxon_rows(self):
+        """
+        Row indices of the reference sketches belonging to each taxon
+
+        Returns:
+            taxon_rows: (dict) {taxon: np.array of rows}
+        """
+        order = np.argsort(self.taxa, kind='stable')
+        taxa, starts = np.unique(self.taxa[order], return_index=True)
+        return dict(zip(taxa, np.split(order, starts[1:])))
+
+    def route(self, query, mash_distance):
+        """
+        Select the reference rows worth searching by comparing the query
+        against the representatives of each taxon first.  A taxon is kept if
+        its closest representative is within mash_distance plus the taxon
+        radius (the furthest any member is from its nearest representative).
+
+        Parameters:
+            query: (np.array) sorted uint64 query hashes
+            mash_distance: (float) maximum mash distance to retain
+        Returns:
+            rows: (np.array) reference rows in the selected taxa
+            taxa: (list) selected taxa
+        """
+        if self.representatives is None:
+            return np.arange(len(self)), sorted(set(self.taxa))
+
+        representatives = self.representatives.copy()
+        representatives['distance'] = \
+                self.distances(query, representatives['row'].values)
+        nearest = representatives.groupby('taxon').agg(
+                {'distance': 'min', 'radius': 'first'})
+        selected = nearest[nearest['distance'] <= \
+                           mash_distance + nearest['radius']].index
+
+        taxon_rows = self.taxon_rows()
+        rows = [taxon_rows[taxon] for taxon in selected]
+        if len(rows) == 0:
+            return np.array([], dtype=np.int64), []
+        return np.sort(np.concatenate(rows)), list(selected)
+
+
+def select_representatives(reference, rows, n_representatives):
+    """
+    Greedy farthest-point selection of representative sketches for a set of
+    reference rows
+
+    Parameters:
+        reference: (ReferenceSketch) reference sketches
+        rows: (np.array) rows to choose representatives from
+        n_representatives: (int) maximum number of representatives
+    Returns:
+        representatives: (list) representative rows
+        radius: (float) largest distance of any row to its nearest
+                representative
+    """
+    representatives = [rows[0]]
+    nearest = reference.distances(reference.row_sketch(rows[0]), rows)
+    while len(representatives) < min(n_representatives, len(rows)):
+        furthest = nearest.argmax()
+        if nearest[furthest] == 0:
+            break
+        representatives.append(rows[furthest])
+        nearest = np.minimum(nearest,
+                             reference.distances(
+                                 reference.row_sketch(rows[furthest]), rows))
+    return representatives, float(nearest.max())
+
+
+def build_representatives(sketch_dir, cores,
+                          n_representatives=REPRESENTATIVES_PER_TAXON):
+    """
+    Choose representative sketches for every taxon so that queries can be
+    routed to the taxa they belong to before a full search
+
+    Parameters:
+        sketch_dir: path to the reference sketch directory
+        cores: (int) number of parallel jobs
+        n_representatives: (int) maximum representatives per taxon
+    """
+    reference = ReferenceSketch(sketch_dir)
+    taxon_rows = reference.taxon_rows()
+    logging.info(f"Selecting up to {n_representatives} representative "
+                 f"sketches for {len(taxon_rows)} taxa")
+
+    selections = joblib.Parallel(n_jobs=cores)(
+            joblib.delayed(select_representatives)(reference, rows,
+                                                   n_representatives) \
+                    for rows in taxon_rows.values())
+
+    write_representatives(sketch_dir, dict(zip(taxon_rows, selections)))
+
+
+def write_representatives(sketch_dir, selections):
+    """
+    Write the representative rows of each taxon
+
+    Parameters:
+        sketch_dir: path to the reference sketch directory
+        selections: (dict) {taxon: (representative rows, radius)}
+    """
+    with open(os.path.join(sketch_dir, 'representatives.tsv'), 'w') as fh:
+        fh.write("taxon\trow\tradius\n")
+        for taxon, (rows, radius) in selections.items():
+            for row in rows:
+                fh.write(f"{taxon}\t{row}\t{radius}\n")
+
+
+def extend_representatives(sketch_dir, representatives, rows):
+    """
+    Keep the representatives chosen before rows were appended to a reference
+    sketch, growing each taxon's radius to cover the new rows, rather than
+    selecting them again from every row
+
+    Parameters:
+        sketch_dir: path to the reference sketch directory
+        representatives: (pd.df) representatives before the rows were added
+        rows: (list) appended rows
+    """
+    reference = ReferenceSketch(sketch_dir)
+    selections = {taxon: (list(taxon_reps['row']), taxon_reps['radius'].max()) \
+                    for taxon, taxon_reps in representatives.groupby('taxon')}
+    for row in rows:
+        taxon = reference.taxa[row]
+        if taxon not in selections:
+            # first row of a new taxon represents itself
+            selections[taxon] = ([row], 0.0)
+            continue
+        rep_rows, radius = selections[taxon]
+        nearest = reference.distances(reference.row_sketch(row),
+                                      np.array(rep_rows)).min()
+        selections[taxon] = (rep_rows, max(radius, float(nearest)))
+    write_representatives(sketch_dir, selections)
+
+
+def nearest_leaders(reference, rows, leader_rows):
+    """
+    Nearest leader of each row and its distance (1 if there are none)
+    """
+    nearest = np.zeros(len(rows), dtype=np.int64)
+    distances = np.ones(len(rows))
+    if len(leader_rows) == 0:
+        return nearest, distances
+    for ix, row in enumerate(rows):
+        leader_distances = reference.distances(reference.row_sketch(row),
+                                               leader_rows)
+        nearest[ix] = leader_rows[leader_distances.argmin()]
+        distances[ix] = leader_distances.min()
+    return nearest, distances
+
+
+def cluster_sketches(sketch_dir, collapse_distance, cores, clusters=None):
+    """
+    Greedily collapse near-duplicate sketches into clusters: in row order
+    each row joins the cluster of its nearest leader within
+    collapse_distance or else leads a new cluster.  Blocks of rows are
+    compared against the existing leaders in parallel.
+
+    Parameters:
+        sketch_dir: path to the reference sketch directory
+        collapse_distance: (float) maximum mash distance to a leader
+        cores: (int) number of parallel jobs
+        clusters: (tuple) leaders and leader distances of the first rows
+                  to keep (e.g. of a sketch rows were then appended to)
+    """
+    reference = ReferenceSketch(sketch_dir)
+    leaders = np.arange(len(reference))
+    leader_distances = np.zeros(len(reference))
+    first_row = 0
+    if clusters is not None:
+        first_row = len(clusters[0])
+        leaders[:first_row], leader_distances[:first_row] = clusters
+    leader_rows = list(np.flatnonzero(leaders[:first_row] == \
+                                      np.arange(first_row)))
+
+    for start in range(first_row, len(reference), CLUSTER_BLOCK):
+        block = np.arange(start, min(start + CLUSTER_BLOCK, len(reference)))
+        chunks = np.array_split(block, min(cores, len(block)))
+        nearest = joblib.Parallel(n_jobs=cores)(
+                joblib.delayed(nearest_leaders)(reference, chunk,
+                                                np.array(leader_rows,
+                                                         dtype=np.int64)) \
+                        for chunk in chunks)
+        block_leaders = []
+        for row, leader, distance in zip(block,
+                np.concatenate([leader for leader, _ in nearest]),
+                np.concatenate([distance for _, distance in nearest])):
+            # leaders found earlier in this block
+            if len(block_leaders) > 0:
+                block_distances = reference.distances(
+                        reference.row_sketch(row), np.array(block_leaders))
+                if block_distances.min() < distance:
+                    leader = block_leaders[block_distances.argmin()]
+                    distance = block_distances.min()
+            if distance <= collapse_distance:
+                leaders[row] = leader
+                leader_distances[row] = distance
+            else:
+                block_leaders.append(row)
+        leader_rows.extend(block_leaders)
+
+    logging.info(f"Collapsed {len(reference)} sketches into "
+                 f"{len(leader_rows)} near-duplicate clusters")
+    write_clusters(sketch_dir, leaders, leader_distances)
+
+
+def write_clusters(sketch_dir, leaders, leader_distances):
+    """
+    Write the near-duplicate cluster leader of every row
+
+    Parameters:
+        sketch_dir: path to the reference sketch directory
+        leaders: (np.array) leader row of each row
+        leader_distances: (np.array) distance of each row to its leader
+    """
+    with open(os.path.join(sketch_dir, 'clusters.tsv'), 'w') as fh:
+        fh.write("leader\tdistance\n")
+        for leader, distance in zip(leaders, leader_distances):
+            fh.write(f"{leader}\t{distance}\n")
+
+
+def create_reference_sketch(sketch_dir, params=DEFAULT_PARAMS):
+    """
+    Create an empty reference sketch directory (removing any previous one)
+    """
+    if os.path.exists(sketch_dir):
+        logging.info(f"Removing previous reference sketch: {sketch_dir}")
+        shutil.rmtree(sketch_dir)
+    os.mkdir(sketch_dir)
+
+    with open(os.path.join(sketch_dir, 'sketch.json'), 'w') as fh:
+        json.dump(params, fh)
+    with open(os.path.join(sketch_dir, 'names.tsv'), 'w') as fh:
+        fh.write("name\ttaxon\thash_count\n")
+    open(os.path.join(sketch_dir, 'hashes.u64'), 'wb').close()
+
+
+def append_sketches(sketch_dir, names, taxon, sketches):
+    """
+    Append already computed sketches to a reference sketch directory
+
+    Parameters:
+        sketch_dir: path to the reference sketch directory
+        names: (list) genome names
+        taxon: (str) taxon the genomes belong to
+        sketches: (list) of sorted uint64 hash arrays
+    Returns:
+        first_row: (int) row of the first appended sketch
+    """
+    with open(os.path.join(sketch_dir, 'sketch.json')) as fh:
+        sketch_size = json.load(fh)['sketch_size']
+    hashes_fp = os.path.join(sketch_dir, 'hashes.u64')
+    first_row = os.path.getsize(hashes_fp) // (sketch_size * 8)
+
+    matrix = np.full((len(sketches), sketch_size), EMPTY_HASH, dtype='<u8')
+    for row, hashes in enumerate(sketches):
+        matrix[row, :hashes.shape[0]] = hashes
+
+    with open(hashes_fp, 'ab') as fh:
+        fh.write(matrix.tobytes())
+    with open(os.path.join(sketch_dir, 'names.tsv'), 'a') as fh:
+        for name, hashes in zip(names, sketches):
+            fh.write(f"{name}\t{taxon}\t{hashes.shape[0]}\n")
+
+    # representatives and clusters no longer cover every row
+    for covering in ['representatives.tsv', 'clusters.tsv']:
+        covering_fp = os.path.join(sketch_dir, covering)
+        if os.path.exists(covering_fp):
+            os.remove(covering_fp)
+
+    return first_row
+
+
+def append_reference_sketch(sketch_dir, source_dir, chunk_rows=ROW_BLOCK,
+                            first_source_row=0):
+    """
+    Append the rows of another reference sketch directory (e.g. the sketch
+    of a single taxon) without re-sketching its genomes
+
+    Parameters:
+        sketch_dir: path to the reference sketch directory
+        source_dir: path to the reference sketch directory to copy rows from
+        first_source_row: (int) copy the source rows from this one on (e.g.
+                          only the genomes added since it was last copied)
+    Returns:
+        first_row: (int) row of the first appended sketch
+    """
+    with open(os.path.join(sketch_dir, 'sketch.json')) as fh:
+        params = json.load(fh)
+    with open(os.path.join(source_dir, 'sketch.json')) as fh:
+        if json.load(fh) != params:
+            raise ValueError(f"Sketch parameters of {source_dir} don't match "
+                             f"{sketch_dir}")
+
+    hashes_fp = os.path.join(sketch_dir, 'hashes.u64')
+    row_bytes = params['sketch_size'] * 8
+    first_row = os.path.getsize(hashes_fp) // row_bytes
+
+    with open(os.path.join(source_dir, 'hashes.u64'), 'rb') as in_fh, \
+            open(hashes_fp, 'ab') as out_fh:
+        in_fh.seek(first_source_row * row_bytes)
+        shutil.copyfileobj(in_fh, out_fh, chunk_rows * row_bytes)
+    with open(os.path.join(source_dir, 'names.tsv')) as in_fh, \
+            open(os.path.join(sketch_dir, 'names.tsv'), 'a') as out_fh:
+        # header then the rows before first_source_row
+        for _ in range(first_source_row + 1):
+            next(in_fh)
+        shutil.copyfileobj(in_fh, out_fh)
+
+    # representatives and clusters no longer cover every row
+    for covering in ['representatives.tsv', 'clusters.tsv']:
+        covering_fp = os.path.join(sketch_dir, covering)
+        if os.path.exists(covering_fp):
+            os.remove(covering_fp)
+
+    return first_row
+
+
+def add_to_reference_sketch(sketch_dir, taxon, genome_fps, cores):
+    """
+    Sketch all the genomes for one taxa in parallel and append them to the
+    reference sketch
+
+    Parameters:
+        sketch_dir: path to the reference sketch directory
+        taxon: (str) taxon the genomes belong to
+        genome_fps: (list) paths to the genome fastas
+        cores: (int) number of parallel sketching jobs
+    Returns:
+        rows: (dict) {genome name: row in the reference sketch}
+    """
+    with open(os.path.join(sketch_dir, 'sketch.json')) as fh:
+        params = json.load(fh)
+
+    logging.info(f"Sketching {len(genome_fps)} genomes for taxa: {taxon}")
+    sketches = joblib.Parallel(n_jobs=cores)(
+            joblib.delayed(sketch_genome)(genome_fp, params) \
+                    for genome_fp in genome_fps)
+
+    names = [os.path.basename(x).replace('.fa', '') for x in genome_fps]
+    first_row = append_sketches(sketch_dir, names, taxon, sketches)
+
+    return {name: first_row + i for i, name in enumerate(names)}
@@ -0,0 +1,55 @@
+"""
+Tests for `etd.align` module.
+"""
+import numpy as np
+from Bio.Align import PairwiseAligner, substitution_matrices
+from etd import align
+
+
+class TestAlign(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.matrix = substitution_matrices.load('BLOSUM62')
+        cls.scores = align.substitution_array(cls.matrix)
+
+    def test_substitution_array(self):
+        # the Bio.SubsMat triangle form gives the same scores
+        triangle = {(a, b): self.matrix[a, b]
+                    for i, a in enumerate(align.ALPHABET)
+                    for b in align.ALPHABET[:i + 1]}
+        assert np.array_equal(align.substitution_array(triangle), self.scores)
+
+    def test_smith_waterman(self):
+        rng = np.random.default_rng(0)
+        residues = list('ACDEFGHIKLMNPQRSTVWY')
+        reference = ''.join(rng.choice(residues, 120))
+        queries, references = [], []
+        for i in range(40):
+            # fragments of the reference with substitutions and indels
+            query = list(reference[rng.integers(0, 30):rng.integers(80, 120)])
+            for _ in range(rng.integers(0, 15)):
+                position = rng.integers(0, len(query))
+                if i % 3 == 0:
+                    query[position] = rng.choice(residues)
+                elif i % 3 == 1:
+                    del query[position]
+                else:
+                    query.insert(position, rng.choice(residues))
+            queries.append(''.join(query))
+            references.append(reference if i % 5 else
+                              ''.join(rng.choice(residues, 30)))
+        queries.append('mkx*')
+        references.append('MKB')
+
+        aligner = PairwiseAligner(mode='local', substitution_matrix=self.matrix,
+                                  open_gap_score=-align.GAP_OPEN,
+                                  extend_gap_score=-align.GAP_EXTEND)
+        pair_block = align.PAIR_BLOCK
+        align.PAIR_BLOCK = 8
+        try:
+            scores = align.smith_waterman(queries, references, self.scores)
+        finally:
+            align.PAIR_BLOCK = pair_block
+        assert list(scores) == [aligner.score(query.upper(), reference)
+                                for query, reference in zip(queries, references)]
@@ -0,0 +1,111 @@
+"""
+Tests for `etd.bundle` module.
+"""
+import pytest
+import shutil
+import glob
+import os.path
+import numpy as np
+from etd import bundle
+from etd import sketch
+from etd import presence
+
+
+class TestBundle(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.bundle_fp = 'bundle_test.bundle'
+        cls.sketch_dir = 'bundle_test_sketch'
+        cls.presence_dir = 'bundle_test_presence'
+
+    def test_round_trip(self):
+        hashes = np.arange(12, dtype='<u8').reshape(3, 4)
+        bundle.write_bundle(self.bundle_fp, {'hashes': hashes,
+                                             'raw': b'\x00\x01',
+                                             'index': {'a': [1, 2]}})
+        etd_bundle = bundle.Bundle(self.bundle_fp)
+        assert np.array_equal(etd_bundle.array('hashes'), hashes)
+        assert etd_bundle.offset('hashes') % bundle.ALIGNMENT == 0
+        assert etd_bundle.bytes('raw') == b'\x00\x01'
+        assert etd_bundle.json('index') == {'a': [1, 2]}
+        assert 'missing' not in etd_bundle
+        assert etd_bundle.verify() == []
+
+    def test_corruption(self):
+        bundle.write_bundle(self.bundle_fp, {'raw': b'abcd'})
+        etd_bundle = bundle.Bundle(self.bundle_fp)
+        with open(self.bundle_fp, 'r+b') as fh:
+            fh.seek(etd_bundle.offset('raw'))
+            fh.write(b'x')
+        assert bundle.Bundle(self.bundle_fp).verify() == ['raw']
+        assert bundle.verify_bundle(self.bundle_fp) == \
+                ["section raw doesn't match its checksum"]
+
+        with open(self.bundle_fp, 'r+b') as fh:
+            fh.seek(8)
+            fh.write((bundle.VERSION + 1).to_bytes(4, 'little'))
+        with pytest.raises(ValueError):
+            bundle.Bundle(self.bundle_fp)
+
+    def test_verified_when_written(self, monkeypatch):
+        bundle.write_bundle(self.bundle_fp, {'raw': b'abcd'})
+        assert bundle.verify_bundle(self.bundle_fp) == []
+        # e.g. a failing disk
+        monkeypatch.setattr(bundle.Bundle, 'verify', lambda self: ['raw'])
+        with pytest.raises(ValueError):
+            bundle.write_bundle(self.bundle_fp, {'raw': b'efgh'})
+        monkeypatch.undo()
+        # the previous bundle is kept
+        assert bundle.Bundle(self.bundle_fp).bytes('raw') == b'abcd'
+        assert not os.path.exists(self.bundle_fp + '.tmp')
+        assert bundle.verify_bundle(self.bundle_fp + '.missing') != []
+
+    def test_bundled_sketch_and_presence(self):
+        rng = np.random.default_rng(3)
+        sketches = [np.unique(rng.integers(0, 2**63, 200, dtype=np.uint64))
+                    for _ in range(4)]
+        sketch.create_reference_sketch(self.sketch_dir)
+        sketch.append_sketches(self.sketch_dir, ['g0', 'g1', 'g2', 'g3'],
+                               'toy', sketches)
+        sketch.build_representatives(self.sketch_dir, 1)
+        rgi_paths = sorted(glob.glob('test/data/references/rgi_output/*/*.json'))
+        presence.build_presence_matrix(rgi_paths, self.presence_dir, 1)
+
+        reference = sketch.ReferenceSketch(self.sketch_dir)
+        matrix = presence.PresenceMatrix(self.presence_dir)
+        bundle.write_bundle(self.bundle_fp, {
+            'sketch/params': reference.params,
+            'sketch/names': reference.names.tolist(),
+            'sketch/taxa': reference.taxa.tolist(),
+            'sketch/counts': reference.counts,
+            'sketch/hashes': reference.hashes,
+            'sketch/representatives': reference.representatives.to_dict('list'),
+            'presence/columns': matrix.columns,
+            'presence/presence': matrix.presence,
+            'presence/arg_offsets': matrix.arg_offsets,
+            'presence/arg_genomes': matrix.arg_genomes})
+
+        etd_bundle = bundle.Bundle(self.bundle_fp)
+        bundled = sketch.ReferenceSketch.from_bundle(etd_bundle)
+        assert list(bundled.names) == list(reference.names)
+        assert bundled.search(sketches[2], 1, 4, 2) == \
+                reference.search(sketches[2], 1, 4, 2)
+        bundled_rows, bundled_taxa = bundled.route(sketches[1], 0.1)
+        rows, taxa = reference.route(sketches[1], 0.1)
+        assert np.array_equal(bundled_rows, rows) and bundled_taxa == taxa
+
+        bundled_matrix = presence.PresenceMatrix.from_bundle(etd_bundle)
+        assert bundled_matrix.columns == matrix.columns
+        assert np.array_equal(bundled_matrix.union([0, 1]), matrix.union([0, 1]))
+        for arg in matrix.columns:
+            assert np.array_equal(bundled_matrix.genomes_with(arg),
+                                  matrix.genomes_with(arg))
+
+    @classmethod
+    def teardown_class(cls):
+        for path in [cls.sketch_dir, cls.presence_dir]:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        if os.path.exists(cls.bundle_fp):
+            os.remove(cls.bundle_fp)
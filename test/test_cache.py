@@ -0,0 +1,67 @@
+"""
+Tests for `etd.cache` module.
+"""
+import shutil
+import os
+import os.path
+import concurrent.futures
+from etd import cache
+
+
+class TestCache(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.cache_dir = 'cache_test'
+        cls.work_dir = 'cache_test_work'
+        os.mkdir(cls.work_dir)
+
+    def write(self, name, size):
+        fp = os.path.join(self.work_dir, name)
+        with open(fp, 'w') as fh:
+            fh.write('x' * size)
+        return fp
+
+    def test_round_trip_and_eviction(self):
+        result_cache = cache.ResultCache(self.cache_dir, 250)
+        result_cache.put('a', {'rgi.txt': self.write('a.txt', 100)})
+        result_cache.put('b', {'rgi.txt': self.write('b.txt', 100)})
+
+        # use 'a' so that 'b' is the least recently used entry
+        os.utime(os.path.join(self.cache_dir, 'b'), (0, 0))
+        destination = os.path.join(self.work_dir, 'copy.txt')
+        assert result_cache.get('a', {'rgi.txt': destination})
+        assert os.path.getsize(destination) == 100
+
+        result_cache.put('c', {'rgi.txt': self.write('c.txt', 100)})
+        assert not result_cache.get('b', {'rgi.txt': destination})
+        assert result_cache.get('a', {'rgi.txt': destination})
+        assert result_cache.get('c', {'rgi.txt': destination})
+
+    def test_concurrent_put(self):
+        result_cache = cache.ResultCache(self.cache_dir, 10000)
+        # abandoned by a killed writer
+        abandoned = os.path.join(self.cache_dir, cache.TMP_PREFIX + 'killed')
+        os.mkdir(abandoned)
+        os.utime(abandoned, (0, 0))
+
+        fp = self.write('same.txt', 10)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda _: result_cache.put('same', {'rgi.txt': fp}),
+                          range(32)))
+        destination = os.path.join(self.work_dir, 'same_copy.txt')
+        assert result_cache.get('same', {'rgi.txt': destination})
+        assert os.path.getsize(destination) == 10
+        assert [name for name in os.listdir(self.cache_dir)
+                if name.startswith(cache.TMP_PREFIX)] == []
+
+    def test_file_digest(self):
+        fp = self.write('digest.txt', 3)
+        assert cache.file_digest(fp) == \
+                'cd2eb0837c9b4c962c22d2ff8b5441b7b45805887f051d39bf133b583baf6860'
+
+    @classmethod
+    def teardown_class(cls):
+        for path in [cls.cache_dir, cls.work_dir]:
+            if os.path.exists(path):
+                shutil.rmtree(path)
@@ -0,0 +1,231 @@
+"""
+Tests for `etd.card` module.
+"""
+import os
+import json
+import shutil
+import concurrent.futures
+import numpy as np
+from etd import card
+
+
+def toy_model(aro, name, model_type, family, sequences):
+    return {'ARO_accession': aro, 'ARO_name': name, 'model_type': model_type,
+            'ARO_category': {'1': {'category_aro_class_name': 'AMR Gene Family',
+                                   'category_aro_name': family},
+                             '2': {'category_aro_class_name': 'Drug Class',
+                                   'category_aro_name': 'penam'}},
+            'model_sequences': {'sequence': {str(ix): sequence for ix, sequence
+                                             in enumerate(sequences)}}}
+
+
+def toy_sequence(accession, protein, dna):
+    return {'protein_sequence': {'accession': accession, 'sequence': protein},
+            'dna_sequence': {'accession': accession, 'sequence': dna}}
+
+
+class TestCARD(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.card_dir = 'card_test'
+        cls.card_json = os.path.join(cls.card_dir, 'card.json')
+        cls.cache_dir = os.path.join(cls.card_dir, 'cache')
+        os.makedirs(cls.card_dir, exist_ok=True)
+        cls.models = {
+            '1': toy_model('3000001', 'TEM 1', 'protein homolog model',
+                           'TEM beta-lactamase',
+                           [toy_sequence('AAA1', 'MSIQHF', 'ATGAGTATTCAACATTTC')]),
+            '2': toy_model('3000002', 'TEM 2', 'protein variant model',
+                           'TEM beta-lactamase',
+                           [toy_sequence('AAA2', 'MSIQHW', 'ATGAGTATTCAACATTGG'),
+                            toy_sequence('AAA3', 'MSIQHY', 'ATGAGTATTCAACATTAT')]),
+            '3': toy_model('3000003', 'marR', 'protein knockout model',
+                           'resistance-nodulation-cell division (RND) '
+                           'antibiotic efflux pump', []),
+            # fusion protein in two gene families
+            '4': toy_model('3000004', 'AAC-APH', 'protein homolog model',
+                           "AAC(6')", [toy_sequence('AAA4', 'MIEQ',
+                                                    'ATGATAGAACAA')])}
+        cls.models['4']['ARO_category']['3'] = {
+                'category_aro_class_name': 'AMR Gene Family',
+                'category_aro_name': "APH(2'')"}
+        cls.write_card('3.0.0')
+
+    @classmethod
+    def write_card(cls, version):
+        with open(cls.card_json, 'w') as fh:
+            json.dump(dict(cls.models, _version=version,
+                           _timestamp='2020-01-01T00:00:00',
+                           _comment='toy'), fh)
+
+    def test_parse(self):
+        parsed = card.CARD(self.card_json)
+        assert parsed.version == '3.0.0'
+        assert dict(parsed.proteins) == {
+                '3000001': ('>gb|AAA1|3000001|TEM_1|', 'MSIQHF'),
+                '3000002': ('>gb|AAA2|3000002|TEM_2|', 'MSIQHW'),
+                '3000004': ('>gb|AAA4|3000004|AAC-APH|', 'MIEQ')}
+        assert [header for _, header, _ in parsed.nucleotides.records()] == \
+                ['>gb|AAA1|3000001|TEM_1|', '>gb|AAA2|3000002|TEM_2|',
+                 '>gb|AAA3|3000002|TEM_2|', '>gb|AAA4|3000004|AAC-APH|']
+        # the knockout model has no protein sequence and the fusion protein
+        # no unique gene family
+        assert parsed.aro_to_gene_family == {'3000001': 'TEM beta-lactamase',
+                                             '3000002': 'TEM beta-lactamase'}
+        assert parsed.gene_family_to_aro == {'TEM beta-lactamase':
+                                             ['3000001', '3000002']}
+        assert parsed.model_types['3000003'] == 'protein knockout model'
+
+    def test_sequence_store(self):
+        rng = np.random.default_rng(0)
+        records = [(f"300000{i % 3}", f">gb|A{i}|300000{i % 3}|gene|",
+                    ''.join(rng.choice(list('ACGT'), 5 + 7 * i)))
+                   for i in range(20)]
+        # non-ACGT bases are kept as exceptions
+        records[3] = (records[3][0], records[3][1], 'ACNNTGRYacgt')
+
+        pack_block = card.PACK_BLOCK
+        card.PACK_BLOCK = 16
+        try:
+            builder = card.SequenceStoreBuilder('2bit')
+            for record in records:
+                builder.append(*record)
+            store = builder.store()
+        finally:
+            card.PACK_BLOCK = pack_block
+
+        assert list(store.records()) == records
+        assert len(store.data) < sum(len(seq) for _, _, seq in records) / 3
+        assert store['3000001'] == records[1][1:]
+        assert list(store.select(5, 8).records()) == records[5:8]
+
+        store_dir = os.path.join(self.card_dir, 'store')
+        store.save(store_dir)
+        loaded = card.SequenceStore.load(store_dir)
+        assert list(loaded.records()) == records
+        fasta_fp = os.path.join(self.card_dir, 'store.fasta')
+        with open(fasta_fp, 'wb') as fh:
+            loaded.write_fasta(fh, [0, 1, 2, 3, 7, 19])
+        with open(fasta_fp) as fh:
+            assert fh.read() == ''.join(f"{header}\n{seq}\n" for _, header, seq
+                                        in [records[i] for i in [0, 1, 2, 3, 7, 19]])
+
+    def test_family_fasta(self):
+        parsed = card.CARD(self.card_json)
+        prevalence_dir = os.path.join(self.card_dir, 'prevalence')
+        os.makedirs(prevalence_dir, exist_ok=True)
+        alleles = {}
+        for model in ['homolog', 'variant']:
+            alleles[model] = [(f">Prev_{model}_{i}|ID:{i}|ARO:300000{i % 2 + 1}|TEM",
+                               'ATGAGTATTCAACATTTC' * (i + 1)) for i in range(3)]
+            with open(os.path.join(prevalence_dir,
+                                   f"nucleotide_fasta_protein_{model}_model_"
+                                   "variants.fasta"), 'w') as fh:
+                for header, sequence in alleles[model]:
+                    # wrapped like CARD's files
+                    fh.write(header + '\n' + '\n'.join(
+                        sequence[i:i + 20] for i in range(0, len(sequence), 20)) + '\n')
+
+        family_dir = os.path.join(self.card_dir, 'family_fasta')
+        parsed.get_nucleotide_per_family(family_dir)
+        parsed.add_prevalence_to_family(prevalence_dir, cores=2,
+                                        family_dir=family_dir)
+        # the multi-family ARO isn't written to any family
+        assert os.listdir(family_dir) == ['TEM_beta-lactamase']
+        with open(os.path.join(family_dir, 'TEM_beta-lactamase')) as fh:
+            family_fasta = fh.read()
+
+        expected = [header + '\n' + sequence for aro, header, sequence in
+                    parsed.nucleotides.records() if aro != '3000004']
+        expected += [header + '\n' + sequence for header, sequence in
+                     alleles['homolog'] + alleles['variant']]
+        assert family_fasta == '\n'.join(expected) + '\n'
+
+    def test_family_writer(self):
+        writer_dir = os.path.join(self.card_dir, 'writer')
+        os.makedirs(writer_dir, exist_ok=True)
+        fps = [os.path.join(writer_dir, f"family_{i}") for i in range(3)]
+        # flushed on every write with a single handle open at a time
+        with card.FamilyWriter(max_buffered=0, max_open=1) as writer:
+            for i in range(9):
+                writer.write(fps[i % 3], f">{i}\nACGT\n".encode())
+            assert len(writer.handles) == 1
+        for i, fp in enumerate(fps):
+            with open(fp) as fh:
+                assert fh.read() == ''.join(f">{j}\nACGT\n" for j in range(i, 9, 3))
+
+    def test_score_novelty(self):
+        parsed = card.CARD(self.card_json)
+        novelty = parsed.score_novelty({
+                # identical to the first reference with a stop codon
+                '3000001': ('TEM-1', 'ATGAGTATTCAACATTTCTAA'),
+                # differs from both references at the last residue
+                '3000002': ('TEM-2', 'ATGAGTATTCAACATCCC'),
+                '3000004': ('AAC-APH', 'ATGATAGAACAA'),
+                '3999999': ('unknown', 'ATGAAA')})
+        assert list(novelty['ARO']) == ['3000001', '3000002']
+        assert list(novelty['References']) == [2, 2]
+        assert list(novelty['Best_Reference_ARO']) == ['3000001', '3000001']
+        assert novelty['Novelty'].iloc[0] == 0
+        assert 0 < novelty['Novelty'].iloc[1] < 1
+
+    def test_streamed_parse(self):
+        with open(self.card_json) as fh:
+            document = json.load(fh)
+        # chunks small enough to split every token
+        for chunk_size in [1, 7, 1 << 20]:
+            metadata = {}
+            entries = list(card.iter_card_json(self.card_json, metadata,
+                                               chunk_size=chunk_size))
+            assert entries == [(key, entry) for key, entry in document.items()
+                               if not key.startswith('_')]
+            assert metadata['_version'] == '3.0.0'
+
+        streamed = card.CARD(self.card_json)
+        loaded = card.CARD(self.card_json, stream=False)
+        assert list(streamed.nucleotides.records()) == \
+                list(loaded.nucleotides.records())
+        assert streamed.aro_to_gene_family == loaded.aro_to_gene_family
+
+    def test_compiled_cache(self):
+        parsed = card.CARD(self.card_json, cache_dir=self.cache_dir)
+        compiled_dir = card.find_compiled(self.cache_dir, self.card_json, False)
+        assert compiled_dir == os.path.join(self.cache_dir, '3.0.0')
+
+        loaded = card.CARD(self.card_json, cache_dir=self.cache_dir)
+        assert isinstance(loaded.nucleotides.data, np.memmap)
+        assert loaded.version == parsed.version
+        assert dict(loaded.proteins) == dict(parsed.proteins)
+        assert list(loaded.nucleotides.records()) == \
+                list(parsed.nucleotides.records())
+        assert loaded.aro_to_gene_family == parsed.aro_to_gene_family
+        assert loaded.gene_family_to_aro == parsed.gene_family_to_aro
+
+        # a new CARD release is compiled alongside the previous one
+        self.write_card('3.0.10')
+        try:
+            updated = card.CARD(self.card_json, cache_dir=self.cache_dir)
+        finally:
+            self.write_card('3.0.0')
+        assert updated.version == '3.0.10'
+        assert sorted(os.listdir(self.cache_dir)) == ['3.0.0', '3.0.10',
+                                                      'index.json']
+
+    def test_concurrent_compile(self):
+        cache_dir = os.path.join(self.card_dir, 'concurrent_cache')
+        # left behind by a killed process
+        abandoned = os.path.join(cache_dir, '.tmp-3.0.0-killed')
+        os.makedirs(abandoned)
+        os.utime(abandoned, (0, 0))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            compiled = list(pool.map(lambda _: card.CARD(self.card_json,
+                                                         cache_dir=cache_dir),
+                                     range(16)))
+        assert all(parsed.version == '3.0.0' for parsed in compiled)
+        assert sorted(os.listdir(cache_dir)) == ['3.0.0', 'index.json']
+
+    @classmethod
+    def teardown_class(cls):
+        if os.path.exists(cls.card_dir):
+            shutil.rmtree(cls.card_dir)
@@ -0,0 +1,156 @@
+"""
+Tests for `etd.database` module.
+"""
+import pytest
+import shutil
+import os
+import numpy as np
+from etd import database
+from etd import sketch
+
+
+class TestDatabase(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.etd_db_dir = 'database_test'
+        os.mkdir(cls.etd_db_dir)
+        cls.tarball = os.path.join(cls.etd_db_dir, 'Taxa_FASTA.tar.gz')
+        with open(cls.tarball, 'wb') as fh:
+            fh.write(b'genomes')
+
+    def test_tarball_stats(self):
+        stats = database.tarball_stats(self.tarball)
+        assert stats['size'] == 7
+        assert database.tarball_stats(self.tarball + '.missing') is None
+
+        # unchanged size and mtime reuse the recorded checksum
+        recorded = dict(stats, sha256='recorded')
+        assert database.tarball_stats(self.tarball, recorded)['sha256'] == 'recorded'
+
+        os.utime(self.tarball, (0, 0))
+        assert database.tarball_stats(self.tarball, recorded) == \
+                dict(stats, mtime=0)
+
+    def test_manifest(self):
+        manifest = database.load_manifest(self.etd_db_dir)
+        assert manifest['taxa'] == {}
+        manifest['taxa']['Taxa_FASTA'] = {'fingerprint': 'abc'}
+        database.write_manifest(manifest, self.etd_db_dir)
+        assert database.load_manifest(self.etd_db_dir) == manifest
+
+        # a manifest built with other sketch parameters is discarded
+        manifest['params'] = dict(manifest['params'], kmer=16)
+        database.write_manifest(manifest, self.etd_db_dir)
+        assert database.load_manifest(self.etd_db_dir)['taxa'] == {}
+
+    def test_rgi_tarball(self):
+        assert database.get_rgi_tarball('genomes/Taxa_FASTA.tar.gz',
+                                        'rgi_results') == \
+                os.path.join('rgi_results', 'Taxa_NCBI.tar.gz')
+
+    def test_parse_mash_triangle(self):
+        triangle = ("\t3\n"
+                    "genomes/Taxa_FASTA/acc1.fa\n"
+                    "genomes/Taxa_FASTA/acc2.fa\t0.1\n"
+                    "/tmp/tmpdir/acc3.fa\t0.2\t0.3\n")
+        names, distances = database.parse_mash_triangle(triangle)
+        assert names == ['acc1', 'acc2', 'acc3']
+        assert distances.tolist() == [[0, 0.1, 0.2],
+                                      [0.1, 0, 0.3],
+                                      [0.2, 0.3, 0]]
+
+    def test_check_index(self):
+        database_dir = os.path.join(self.etd_db_dir, 'check')
+        files = {'genomes/Taxa_FASTA.tar.gz': b'genomes',
+                 'rgi_results/Taxa_NCBI.tar.gz': b'rgi',
+                 'genomes/Taxa_FASTA/acc1.fa': b'>acc1\nACGT\n',
+                 'rgi_results/Taxa_NCBI/acc1.json': b'{}',
+                 'etd_db/genome_trees/Taxa_FASTA.tree': b'(acc1);'}
+        for path, content in files.items():
+            path = os.path.join(database_dir, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as fh:
+                fh.write(content)
+        for output in ['etd_db_index.json', 'etd_db.bundle']:
+            open(os.path.join(database_dir, 'etd_db', output), 'w').close()
+        for output in ['sketch', 'presence', 'mash_sketches']:
+            os.mkdir(os.path.join(database_dir, 'etd_db', output))
+
+        etd_db_dir = os.path.join(database_dir, 'etd_db')
+        manifest = database.load_manifest(etd_db_dir)
+        manifest['reference_sketch'] = [['Taxa_FASTA', 'abc']]
+        manifest['taxa']['Taxa_FASTA'] = {
+                'genome_tarball': database.tarball_stats(os.path.join(
+                    database_dir, 'genomes/Taxa_FASTA.tar.gz')),
+                'rgi_tarball': database.tarball_stats(os.path.join(
+                    database_dir, 'rgi_results/Taxa_NCBI.tar.gz')),
+                'accessions': {'acc1': {
+                    'genome': 'genomes/Taxa_FASTA/acc1.fa',
+                    'rgi': 'rgi_results/Taxa_NCBI/acc1.json'}},
+                'outputs': {'genome_tree': 'etd_db/genome_trees/Taxa_FASTA.tree'},
+                'directories': {directory: os.stat(os.path.join(
+                                    database_dir, directory)).st_mtime \
+                                for directory in ['genomes/Taxa_FASTA',
+                                                  'rgi_results/Taxa_NCBI']},
+                'fingerprint': 'abc'}
+        database.write_manifest(manifest, etd_db_dir)
+        assert database.check_index(database_dir, 2) == {}
+
+        # a touched tarball is left to build_db's checksum
+        tarball = os.path.join(database_dir, 'genomes/Taxa_FASTA.tar.gz')
+        os.utime(tarball, (0, 0))
+        stale = database.check_index(database_dir, 2)
+        assert stale == {'Taxa_FASTA': [f"genome tarball modified: {tarball}"]}
+        assert database.forced_rebuilds(stale) == set()
+        database.write_manifest(dict(manifest, taxa={'Taxa_FASTA': dict(
+                manifest['taxa']['Taxa_FASTA'],
+                genome_tarball=database.tarball_stats(tarball))}), etd_db_dir)
+
+        genome = os.path.join(database_dir, 'genomes/Taxa_FASTA/acc1.fa')
+        os.remove(genome)
+        os.utime(os.path.dirname(genome), (0, 0))
+        stale = database.check_index(database_dir, 2)
+        assert stale == {'Taxa_FASTA': [f"file missing: {genome}"]}
+        assert database.forced_rebuilds(dict(stale, etd_db=['missing sketch'])) == \
+                {'Taxa_FASTA'}
+
+    def test_collapsed_genomes(self):
+        rng = np.random.default_rng(0)
+        bases = [np.unique(rng.integers(0, 2**63, 1000, dtype=np.uint64))
+                 for _ in range(2)]
+        sketches = []
+        for base in bases:
+            for i in range(3):
+                duplicate = base.copy()
+                duplicate[:i] = rng.integers(0, 2**63, i, dtype=np.uint64)
+                sketches.append(np.unique(duplicate))
+        sketch_dir = os.path.join(self.etd_db_dir, 'sketch')
+        sketch.create_reference_sketch(sketch_dir)
+        sketch.append_sketches(sketch_dir, [f"g{i}" for i in range(6)], 'toy',
+                               sketches)
+        sketch.cluster_sketches(sketch_dir, 0.001, 1)
+
+        # the members of each cluster with their distances to its leader
+        reference = sketch.ReferenceSketch(sketch_dir)
+        clusters = database.collapsed_genomes(sketch_dir)
+        assert {leader: sorted(members) for leader, members in
+                clusters.items()} == {'g0': ['g1', 'g2'], 'g3': ['g4', 'g5']}
+        assert clusters['g0']['g2'] == pytest.approx(
+                reference.distances(sketches[0], np.array([2]))[0])
+        assert 0 < clusters['g0']['g2'] < 0.001
+
+    def test_stat_paths(self):
+        paths = [self.tarball, self.tarball + '.missing'] * 3
+        stat_batch = database.STAT_BATCH
+        database.STAT_BATCH = 4
+        try:
+            stats = database.stat_paths(paths, 2)
+        finally:
+            database.STAT_BATCH = stat_batch
+        assert [stat is None for stat in stats] == [False, True] * 3
+
+    @classmethod
+    def teardown_class(cls):
+        if os.path.exists(cls.etd_db_dir):
+            shutil.rmtree(cls.etd_db_dir)
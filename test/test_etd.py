@@ -3,7 +3,12 @@ Tests for `etd` module.
 """
 import pytest
 import shutil
+import json
+import numpy as np
+import pandas as pd
 from etd import etd
+from etd import sketch
+from etd import relatives
 import os.path
 
 
@@ -16,9 +21,51 @@ class TestEtd(object):
         cls.args.database_dir = 'test/data/references'
         cls.args.mash_distance = 0.5
         cls.args.num_threads = 1
+        cls.args.rgi_cache = None
+        cls.args.rgi_cache_size = 10
+        cls.args.rgi_shards = 1
+        cls.args.cohort = False
         cls.args.output_dir = 'run_test'
         cls.args.debug = False
         cls.args.verbose = False
+        cls.args.containment = False
+        cls.args.card_json = None
+        cls.args.card_cache = None
+
+        # small reference database of random genomes and a plasmid-sized
+        # fragment of one of them
+        cls.test_dir = 'etd_test'
+        cls.database_dir = os.path.join(cls.test_dir, 'database')
+        sketch_dir = os.path.join(cls.database_dir, 'etd_db', 'sketch')
+        os.makedirs(sketch_dir, exist_ok=True)
+        rng = np.random.default_rng(7)
+        genomes = [rng.choice(list('ACGT'), 50000) for _ in range(3)]
+        sketch.create_reference_sketch(sketch_dir)
+        sketch.append_sketches(sketch_dir, ['g0', 'g1', 'g2'], 'toy',
+                               [sketch.sketch_sequences(
+                                   [('g', ''.join(genome).encode())])
+                                for genome in genomes])
+        cls.fragment = os.path.join(cls.test_dir, 'fragment.fa')
+        with open(cls.fragment, 'w') as fh:
+            fh.write(f">fragment\n{''.join(genomes[1][20000:25000])}\n")
+
+        # CARD with a single TEM gene family
+        cls.card_json = os.path.join(cls.test_dir, 'card.json')
+        with open(cls.card_json, 'w') as fh:
+            json.dump({'1': {'ARO_accession': '3000001', 'ARO_name': 'TEM 1',
+                             'model_type': 'protein homolog model',
+                             'ARO_category': {'1': {
+                                 'category_aro_class_name': 'AMR Gene Family',
+                                 'category_aro_name': 'TEM beta-lactamase'}},
+                             'model_sequences': {'sequence': {'0': {
+                                 'protein_sequence': {'accession': 'AAA1',
+                                                      'sequence': 'MSIQHF'},
+                                 'dna_sequence': {'accession': 'AAA1',
+                                                  'sequence':
+                                                  'ATGAGTATTCAACATTTC'}}}}},
+                       '_version': '3.0.0',
+                       '_timestamp': '2020-01-01T00:00:00',
+                       '_comment': 'toy'}, fh)
 
     def test_check_data(self):
         if os.path.exists(self.args.input_genome):
@@ -31,7 +78,86 @@ class TestEtd(object):
         etd.run(self.args)
 
 
+    def test_find_relatives_containment(self):
+        run_name = os.path.join(self.test_dir, 'containment')
+        os.makedirs(run_name)
+        closest = relatives.find_relatives(self.fragment, self.database_dir,
+                                           0.01, 1, run_name,
+                                           containment=True)
+        assert list(closest) == ['g1']
+        mash_distances = pd.read_csv(os.path.join(run_name, 'mash',
+                                                  'mash_distances.tsv'),
+                                     sep='\t', index_col=0)
+        assert list(mash_distances['containment']) == [1.0]
+
+        # the fragment is far from every genome by mash distance
+        run_name = os.path.join(self.test_dir, 'distance')
+        os.makedirs(run_name)
+        assert len(relatives.find_relatives(self.fragment, self.database_dir,
+                                            0.01, 1, run_name)) == 0
+
+
+    def test_run_isolate_novelty(self, monkeypatch):
+        # RGI, placement, metadata and context analysis need external tools
+        # and a full database so only the stages around novelty scoring run
+        rgi_table = pd.DataFrame({'ORF_ID': ['contig_1'],
+                                  'ARO': [3000001],
+                                  'Best_Hit_ARO': ['TEM 1 variant']})
+
+        def run_rgi(input_genome, num_threads, run_name, *args):
+            os.makedirs(os.path.join(run_name, 'rgi'))
+            rgi_table.to_csv(etd.rgi.get_output_name(run_name) + ".txt",
+                             sep='\t', index=False)
+            return rgi_table
+
+        def find_differences(rgi_output, closest_relatives, database_dir,
+                             run_name):
+            os.makedirs(os.path.join(run_name, 'unique_to_isolate'))
+            differences = {'sequences': {'3000001':
+                                         ['TEM 1 variant',
+                                          'ATGAGTATTCAACATTGG']},
+                           'paths': {}, 'unique': [], 'missing': []}
+            with open(os.path.join(run_name, 'unique_to_isolate',
+                                   'differences.json'), 'w') as fh:
+                json.dump(differences, fh)
+            return differences
+
+        monkeypatch.setattr(etd.rgi, 'get_versions', lambda: ('6.0.0', '3.0.0'))
+        monkeypatch.setattr(etd.rgi, 'run_rgi', run_rgi)
+        monkeypatch.setattr(etd, 'place_isolate',
+                            lambda input_genome, mash_output_tsv, database_dir,
+                                   placement_dir: os.makedirs(placement_dir))
+        monkeypatch.setattr(etd.metadata, 'get_spatiotemp_context',
+                            lambda run_name, closest_relatives: os.makedirs(
+                                os.path.join(run_name, 'relatives_metadata')))
+        monkeypatch.setattr(etd, 'find_differences', find_differences)
+        monkeypatch.setattr(etd, 'analyse_unique_args',
+                            lambda differences, database_dir, num_threads,
+                                   database_version: {})
+
+        args = lambda: None
+        args.__dict__.update(self.args.__dict__)
+        args.database_dir = self.database_dir
+        args.mash_distance = 0.01
+        args.containment = True
+        args.card_json = self.card_json
+        args.card_cache = os.path.join(self.test_dir, 'card_cache')
+        run_name = os.path.join(self.test_dir, 'isolate')
+
+        for rerun in [False, True]:
+            results = etd.run_isolate(self.fragment, run_name, args, 1)
+            assert list(results['relatives']) == ['g1']
+            novelty = results['novelty']
+            assert list(novelty['ARO']) == ['3000001']
+            assert list(novelty['Gene_Family']) == ['TEM beta-lactamase']
+            assert list(novelty['Best_Reference_ARO']) == ['3000001']
+            assert 0 < novelty['Novelty'][0] < 1
+        assert os.path.exists(os.path.join(run_name, 'novelty', 'novelty.tsv'))
+        assert os.listdir(args.card_cache) != []
+
+
     @classmethod
     def teardown_class(cls):
+        shutil.rmtree(cls.test_dir)
         os.remove('run_test.log')
         shutil.rmtree('run_test')
@@ -0,0 +1,115 @@
+"""
+Tests for `etd.pipeline` module.
+"""
+import pytest
+import shutil
+import os
+import os.path
+import threading
+from etd import pipeline
+
+
+class TestPipeline(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.stage_dir = 'pipeline_test'
+
+    def test_run_stages(self):
+        results = pipeline.run_stages({
+            'a': (lambda results: 1, []),
+            'b': (lambda results: results['a'] + 1, ['a']),
+            'c': (lambda results: 10, []),
+            'd': (lambda results: results['b'] + results['c'], ['b', 'c'])})
+        assert results == {'a': 1, 'b': 2, 'c': 10, 'd': 12}
+
+        with pytest.raises(ValueError):
+            pipeline.run_stages({'a': (lambda results: 1, ['b']),
+                                 'b': (lambda results: 1, ['a'])})
+
+    def test_run_jobs(self):
+        order = []
+
+        def job(name):
+            def run(results):
+                order.append(name)
+                return name
+            return run
+
+        # one core at a time: large taxa first, stages in dependency order
+        results = pipeline.run_jobs({
+            'small:extract': (job('small:extract'), [], 1, (-1, 0)),
+            'small:tree': (job('small:tree'), ['small:extract'], 4, (-1, 1)),
+            'large:extract': (job('large:extract'), [], 1, (-5, 0)),
+            'large:tree': (job('large:tree'), ['large:extract'], 4, (-5, 1))},
+            1)
+        assert order == ['large:extract', 'large:tree',
+                         'small:extract', 'small:tree']
+        assert results['small:tree'] == 'small:tree'
+
+        with pytest.raises(ValueError):
+            pipeline.run_jobs({'a': (job('a'), ['b'], 1, 0),
+                               'b': (job('b'), ['a'], 1, 0)}, 2)
+
+    def test_run_stages_error(self):
+        release = threading.Event()
+        started = []
+
+        def fail(results):
+            raise RuntimeError("stage failed")
+
+        # raised without waiting for the slow stage, queued stages never start
+        with pytest.raises(RuntimeError):
+            pipeline.run_stages({'slow': (lambda results: release.wait(30), []),
+                                 'fail': (fail, []),
+                                 'after': (lambda results: started.append(1),
+                                           ['fail'])})
+        assert not release.is_set()
+        release.set()
+        assert started == []
+
+        # one at a time in dependency order
+        order = []
+        pipeline.run_stages({'a': (lambda results: order.append('a'), []),
+                             'b': (lambda results: order.append('b'), ['a']),
+                             'c': (lambda results: order.append('c'), [])},
+                            max_workers=1)
+        assert sorted(order) == ['a', 'b', 'c']
+        assert order.index('a') < order.index('b')
+
+    def test_split_threads(self):
+        assert pipeline.split_threads(8, [3, 1]) == [6, 2]
+        assert pipeline.split_threads(2, [3, 1]) == [1, 1]
+        assert pipeline.split_threads(4, [10, 1, 1]) == [2, 1, 1]
+        assert pipeline.split_threads(7, [1, 1, 1]) == [3, 2, 2]
+        for num_threads in range(3, 20):
+            assert sum(pipeline.split_threads(num_threads, [5, 2, 1])) == \
+                    num_threads
+        with pytest.raises(ValueError):
+            pipeline.split_threads(1, [3, 1])
+        with pytest.raises(ValueError):
+            pipeline.split_threads(2, [1, 1, 1])
+
+    def test_checkpointed(self):
+        calls = []
+
+        def run():
+            calls.append('run')
+            os.mkdir(self.stage_dir)
+            return 'ran'
+
+        # incomplete output from a previous run is removed
+        os.mkdir(self.stage_dir)
+        assert pipeline.checkpointed(self.stage_dir, {'x': 1}, run,
+                                     lambda: 'reloaded') == 'ran'
+        assert pipeline.checkpointed(self.stage_dir, {'x': 1}, run,
+                                     lambda: 'reloaded') == 'reloaded'
+        # changed inputs rerun the stage
+        assert pipeline.checkpointed(self.stage_dir, {'x': 2}, run,
+                                     lambda: 'reloaded') == 'ran'
+        assert calls == ['run', 'run']
+
+    @classmethod
+    def teardown_class(cls):
+        if os.path.exists(cls.stage_dir):
+            shutil.rmtree(cls.stage_dir)
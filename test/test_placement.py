@@ -0,0 +1,96 @@
+"""
+Tests for `etd.placement` module.
+"""
+import io
+import os
+import pytest
+from Bio import Phylo
+from etd import placement
+
+
+class TestPlacement(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.tree_fp = 'placement_test.tree'
+        with open(cls.tree_fp, 'w') as fh:
+            fh.write("((a:0.1,b:0.1):0.2,c:0.3);\n")
+
+    def test_graft(self):
+        tree, leaves = placement.read_tree(self.tree_fp)
+        # halfway along the branch above a (three-point estimate 0.05)
+        leaf = placement.graft(tree, leaves, 'q', {'a': 0.1, 'b': 0.2,
+                                                   'c': 0.6})
+        assert leaves['q'] is leaf
+        assert leaf.branch_length == pytest.approx(0.05)
+        assert tree.distance('a', 'q') == pytest.approx(0.1)
+        assert tree.distance('b', 'q') == pytest.approx(0.2)
+        assert tree.distance('c', 'q') == pytest.approx(0.6)
+
+        # limited to the branch above the nearest leaf
+        placement.graft(tree, leaves, 'r', {'c': 0.01, 'a': 1.0})
+        assert tree.distance('c', 'r') == pytest.approx(0.01)
+        assert tree.common_ancestor('c', 'r').clades == [leaves['c'],
+                                                          leaves['r']]
+
+        placement.write_tree(tree, self.tree_fp)
+        names = [leaf.name for leaf in
+                 Phylo.read(self.tree_fp, 'newick').get_terminals()]
+        assert sorted(names) == ['a', 'b', 'c', 'q', 'r']
+
+    def test_graft_single_leaf(self):
+        tree = Phylo.read(io.StringIO("a;"), 'newick')
+        leaves = {'a': tree.root}
+        placement.graft(tree, leaves, 'q', {'a': 0.1})
+        assert tree.distance('a', 'q') == pytest.approx(0.1)
+
+    def test_graft_clusters(self):
+        tree_fp = self.tree_fp + '.clusters'
+        tree = Phylo.read(io.StringIO("((a:0.1,b:0.1):0.2,c:0.3);"), 'newick')
+        leaves = {leaf.name: leaf for leaf in tree.get_terminals()}
+        # large enough to overflow the recursion limit if chained
+        clusters = {'a': {f"a{i}": 0.001 * (i % 5) for i in range(2000)},
+                    'c': {'c0': 0.002}}
+        placement.graft_clusters(tree, leaves, clusters)
+        try:
+            placement.write_tree(tree, tree_fp)
+            grafted = Phylo.read(tree_fp, 'newick')
+        finally:
+            if os.path.exists(tree_fp):
+                os.remove(tree_fp)
+
+        assert len(grafted.get_terminals()) == 2004
+        assert grafted.distance('a', 'a3') == pytest.approx(0.003)
+        assert grafted.distance('b', 'a3') == pytest.approx(0.203)
+        assert grafted.distance('c', 'c0') == pytest.approx(0.002)
+        assert grafted.distance('b', 'c0') == pytest.approx(0.602)
+        # one polytomy per cluster
+        assert len(grafted.common_ancestor('a', 'a0').clades) == 2001
+
+        # single leaf tree
+        tree = Phylo.read(io.StringIO("a;"), 'newick')
+        leaves = {'a': tree.root}
+        placement.graft_clusters(tree, leaves, {'a': {'q': 0.1}})
+        assert tree.distance('a', 'q') == pytest.approx(0.1)
+
+    def test_place(self):
+        tree_fp = self.tree_fp + '.source'
+        placed_fp = self.tree_fp + '.placed'
+        with open(tree_fp, 'w') as fh:
+            fh.write("((a:0.1,b:0.1):0.2,c:0.3);\n")
+        try:
+            name = placement.place(tree_fp, 'a', {'b': 0.05}, placed_fp)
+            placed = Phylo.read(placed_fp, 'newick')
+            unchanged = Phylo.read(tree_fp, 'newick')
+        finally:
+            for path in [tree_fp, placed_fp]:
+                if os.path.exists(path):
+                    os.remove(path)
+        assert name == 'a_query'
+        assert placed.distance('b', 'a_query') == pytest.approx(0.05)
+        assert len(unchanged.get_terminals()) == 3
+
+    @classmethod
+    def teardown_class(cls):
+        if os.path.exists(cls.tree_fp):
+            os.remove(cls.tree_fp)
@@ -0,0 +1,73 @@
+"""
+Tests for `etd.presence` module.
+"""
+import pytest
+import shutil
+import tarfile
+import glob
+import os.path
+import pandas as pd
+from etd import presence
+from etd import diff
+
+
+class TestPresence(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.rgi_paths = sorted(glob.glob('test/data/references/rgi_output/*/*.json'))
+        cls.presence_dir = 'presence_test'
+        presence.build_presence_matrix(cls.rgi_paths, cls.presence_dir, 1)
+
+    def test_matches_rgi_tables(self):
+        matrix = presence.PresenceMatrix(self.presence_dir)
+        assert matrix.n_genomes == len(self.rgi_paths)
+        for row, rgi_path in enumerate(self.rgi_paths):
+            expected = presence.read_rgi_args(rgi_path)
+            assert set(matrix.columns[col] for col, present in \
+                    enumerate(matrix.union([row])) if present) == expected
+            for arg in expected:
+                assert row in matrix.genomes_with(arg)
+
+    def test_read_tar_member(self):
+        tarball = self.presence_dir + '.tar.gz'
+        with tarfile.open(tarball, 'w:gz') as tar_fh:
+            tar_fh.add(os.path.dirname(self.rgi_paths[0]), arcname='rgi')
+        rgi_paths = [path for path in self.rgi_paths
+                     if os.path.dirname(path) == os.path.dirname(self.rgi_paths[0])]
+        members = ['rgi/' + os.path.basename(path) for path in rgi_paths]
+        try:
+            rgi = presence.read_rgi_table(tarball, members[0])
+            tables = presence.read_tar_rgi_tables(tarball, members[::-1])
+            with pytest.raises(KeyError):
+                presence.read_tar_rgi_tables(tarball, ['rgi/missing.json'])
+        finally:
+            os.remove(tarball)
+        assert presence.table_args(rgi) == presence.read_rgi_args(self.rgi_paths[0])
+        assert sorted(tables) == sorted(members)
+        for member, path in zip(members, rgi_paths):
+            assert presence.table_args(tables[member]) == \
+                    presence.read_rgi_args(path)
+
+    def test_matches_find_rgi_differences(self):
+        matrix = presence.PresenceMatrix(self.presence_dir)
+        input_rgi = pd.read_csv(presence.rgi_table_path(self.rgi_paths[0]),
+                                sep='\t')
+        relatives_rgi = {path: pd.read_csv(presence.rgi_table_path(path),
+                                           sep='\t') \
+                            for path in self.rgi_paths[1:]}
+
+        unique, sequences, missing = diff.find_rgi_differences(input_rgi,
+                                                               relatives_rgi)
+        unique_bits, sequences_bits, missing_bits, prevalence = \
+                diff.find_presence_differences(input_rgi, matrix, [1, 2])
+
+        assert unique == unique_bits
+        assert missing == missing_bits
+        assert sequences == sequences_bits
+        assert prevalence['Relatives_With_ARG'].max() <= 2
+
+    @classmethod
+    def teardown_class(cls):
+        if os.path.exists(cls.presence_dir):
+            shutil.rmtree(cls.presence_dir)
@@ -0,0 +1,110 @@
+"""
+Tests for `etd.rgi` module.
+"""
+import os
+import json
+import shutil
+import pandas as pd
+from etd import rgi
+
+
+class TestShardedRGI(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.rgi_dir = 'rgi_test'
+        os.makedirs(cls.rgi_dir, exist_ok=True)
+        cls.lengths = [48, 400, 120, 300, 80, 248, 28, 200]
+        cls.genome = os.path.join(cls.rgi_dir, 'genome.fasta')
+        with open(cls.genome, 'w') as fh:
+            for ix, length in enumerate(cls.lengths):
+                fh.write(f">NODE_{ix}_length_{length} description\n"
+                         f"{'ACGT' * (length // 4)}\n")
+
+    def shard(self, shards, min_shard_length):
+        shard_dir = os.path.join(self.rgi_dir, f"shards_{shards}")
+        os.makedirs(shard_dir, exist_ok=True)
+        min_length = rgi.MIN_SHARD_LENGTH
+        rgi.MIN_SHARD_LENGTH = min_shard_length
+        try:
+            return rgi.shard_contigs(self.genome, shards, shard_dir)
+        finally:
+            rgi.MIN_SHARD_LENGTH = min_length
+
+    def test_shard_balance(self):
+        shard_fps, contig_order = self.shard(3, 100)
+        assert contig_order == {f"NODE_{ix}_length_{length}": ix for ix, length
+                                in enumerate(self.lengths)}
+
+        shard_lengths = []
+        shard_contigs = []
+        for shard_fp in shard_fps:
+            with open(shard_fp, 'rb') as fh:
+                contigs = list(rgi.sketch.read_fasta(fh))
+            shard_lengths.append(sum(len(seq) for _, seq in contigs))
+            shard_contigs.append([contig_order[name.split()[0]]
+                                  for name, _ in contigs])
+
+        assert len(shard_fps) == 3
+        # every contig in exactly one shard, in input order within each
+        assert sorted(sum(shard_contigs, [])) == list(range(len(self.lengths)))
+        assert all(contigs == sorted(contigs) for contigs in shard_contigs)
+        # longest first onto the smallest shard: within one contig of even
+        assert max(shard_lengths) - min(shard_lengths) <= max(self.lengths)
+        assert sorted(shard_lengths) == [468, 476, 480]
+
+        # shards are kept above the minimum length
+        assert len(self.shard(3, 1000)[0]) == 1
+
+    def test_merge_outputs(self):
+        _, contig_order = self.shard(2, 100)
+        columns = ['ORF_ID', 'Contig', 'Best_Hit_ARO']
+        shard_hits = [[('NODE_5_length_248_3', 'ARO5c'),
+                       ('NODE_1_length_400_12', 'ARO1b'),
+                       ('NODE_5_length_248_1', 'ARO5a')],
+                      [('NODE_1_length_400_2', 'ARO1a'),
+                       ('NODE_3_length_300_1', 'ARO3')]]
+        shard_outputs = []
+        for shard, hits in enumerate(shard_hits):
+            output = os.path.join(self.rgi_dir, f"merge_{shard}")
+            pd.DataFrame([(f"{orf} # 1 # 10", orf, aro) for orf, aro in hits],
+                         columns=columns).to_csv(output + ".txt", sep='\t',
+                                                 index=False)
+            with open(output + ".json", 'w') as fh:
+                json.dump({f"{orf} # 1 # 10": {'aro': aro} for orf, aro in hits},
+                          fh)
+            shard_outputs.append(output)
+
+        merged_name = os.path.join(self.rgi_dir, 'merged')
+        rgi.merge_rgi_outputs(shard_outputs, contig_order, merged_name)
+
+        with open(merged_name + ".txt") as fh:
+            lines = fh.read().splitlines()
+        # a single header
+        assert lines[0] == '\t'.join(columns)
+        merged = pd.read_csv(merged_name + ".txt", sep='\t')
+        assert list(merged.columns) == columns
+        # input contig order then ORF number
+        assert list(merged['Best_Hit_ARO']) == ['ARO1a', 'ARO1b', 'ARO3',
+                                                'ARO5a', 'ARO5c']
+        with open(merged_name + ".json") as fh:
+            merged_json = json.load(fh)
+        assert [merged_json[orf_id]['aro'][:4] for orf_id in merged_json] == \
+                ['ARO1', 'ARO1', 'ARO3', 'ARO5', 'ARO5']
+
+    def test_single_shard_passthrough(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(rgi, 'run_rgi_main',
+                            lambda input_sequence, output_name, num_threads:
+                                calls.append((input_sequence, output_name,
+                                              num_threads)))
+        output_name = os.path.join(self.rgi_dir, 'single')
+        # the genome is far smaller than MIN_SHARD_LENGTH
+        rgi.run_sharded_rgi(self.genome, output_name, 4, 4)
+        assert calls == [(self.genome, output_name, 4)]
+        assert not os.path.exists(output_name + "_shards")
+
+    @classmethod
+    def teardown_class(cls):
+        if os.path.exists(cls.rgi_dir):
+            shutil.rmtree(cls.rgi_dir)
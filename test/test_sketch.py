@@ -0,0 +1,207 @@
+"""
+Tests for `etd.sketch` module.
+"""
+import shutil
+import tarfile
+import os.path
+import numpy as np
+from etd import sketch
+
+
+class TestSketch(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.genome = 'test/data/test_toy_salmonella.fna'
+        cls.sketch_dir = 'sketch_test'
+
+    def test_murmurhash(self):
+        # reference values from MurmurHash3_x64_128 (seed 42)
+        kmers = np.frombuffer(b'ACGTACGTACGTACGTACGTA' +
+                              b'AAAAAAAAAAAAAAAAAAAAA',
+                              dtype=np.uint8).reshape(2, 21)
+        hashes = sketch.murmurhash3_x64_64(kmers, 42)
+        assert list(hashes) == [13036166743686632327, 18154334747705351023]
+
+    def test_canonical_sketch(self):
+        sequence = b'ACGGTCTTAGCCATNAGGCTTACCGATCGGATCCAGTTAGCAAATCGTACCGTAG' * 3
+        reverse = sequence[::-1].translate(bytes.maketrans(b'ACGTN', b'TGCAN'))
+        forward_sketch = sketch.sketch_sequences([('f', sequence)])
+        reverse_sketch = sketch.sketch_sequences([('r', reverse.lower())])
+        assert forward_sketch.shape[0] > 0
+        assert np.array_equal(forward_sketch, reverse_sketch)
+
+    def test_tar_member_sketch(self):
+        tarball = self.sketch_dir + '.tar.gz'
+        with tarfile.open(tarball, 'w:gz') as tar_fh:
+            tar_fh.add(self.genome, arcname='toy/genome.fa')
+            tar_fh.add(self.genome, arcname='toy/genome.fna')
+        try:
+            members = list(sketch.iter_tar_members(tarball, ('.fa',)))
+        finally:
+            os.remove(tarball)
+        assert [name for name, _ in members] == ['toy/genome.fa']
+        assert np.array_equal(sketch.sketch_fasta_bytes(members[0][1]),
+                              sketch.sketch_genome(self.genome))
+
+    def test_reference_distances(self):
+        sketch.create_reference_sketch(self.sketch_dir)
+        query = sketch.sketch_genome(self.genome)
+        half = query[::2]
+        sketch.append_sketches(self.sketch_dir, ['self', 'half', 'empty'],
+                               'toy', [query, half,
+                                       np.array([], dtype=np.uint64)])
+
+        reference = sketch.ReferenceSketch(self.sketch_dir)
+        distances = reference.distances(query)
+        assert list(reference.names) == ['self', 'half', 'empty']
+        assert distances[0] == 0
+        assert 0 < distances[1] < 1
+        assert distances[2] == 1
+
+    def test_sharded_search(self):
+        rng = np.random.default_rng(1)
+        query = np.unique(rng.integers(0, 2**63, 1000, dtype=np.uint64))
+        sketches = [np.unique(np.concatenate([
+                        query[:1000 - 10 * i],
+                        rng.integers(0, 2**63, 10 * i, dtype=np.uint64)]))
+                    for i in range(20)]
+        sketch.create_reference_sketch(self.sketch_dir)
+        sketch.append_sketches(self.sketch_dir,
+                               [f"g{i}" for i in range(20)], 'toy', sketches)
+        reference = sketch.ReferenceSketch(self.sketch_dir)
+        distances = reference.distances(query)
+
+        shard_size = sketch.SHARD_SIZE
+        sketch.SHARD_SIZE = 3
+        try:
+            hits = reference.search(query, distances[6], 5, 2)
+            cohort_hits = reference.search_many([sketches[19], query],
+                                                distances[6], 5, 2)
+        finally:
+            sketch.SHARD_SIZE = shard_size
+
+        assert [row for _, row in hits] == [0, 1, 2, 3, 4]
+        assert [distance for distance, _ in hits] == list(distances[:5])
+        assert cohort_hits[1] == hits
+        assert cohort_hits[0][0] == (0, 19)
+
+    def test_taxon_routing(self):
+        rng = np.random.default_rng(0)
+        genomes = [rng.choice(list(b'ACGT'), 5000).astype(np.uint8).tobytes()
+                   for _ in range(2)]
+        # close relative of the first genome
+        genomes.insert(1, genomes[0][:2500] + b'T' + genomes[0][2501:])
+        sketches = [sketch.sketch_sequences([('g', g)]) for g in genomes]
+        sketch.create_reference_sketch(self.sketch_dir)
+        sketch.append_sketches(self.sketch_dir, ['a1', 'a2'], 'taxon_a',
+                               sketches[:2])
+        sketch.append_sketches(self.sketch_dir, ['b1'], 'taxon_b',
+                               sketches[2:])
+        sketch.build_representatives(self.sketch_dir, 1, n_representatives=1)
+
+        reference = sketch.ReferenceSketch(self.sketch_dir)
+        rows, taxa = reference.route(sketches[2], 0.01)
+        assert taxa == ['taxon_b']
+        assert list(reference.names[rows]) == ['b1']
+
+    def test_append_reference_sketch(self):
+        rng = np.random.default_rng(2)
+        sketches = [np.unique(rng.integers(0, 2**63, 100 + i, dtype=np.uint64))
+                    for i in range(3)]
+        taxa_dir = self.sketch_dir + '_taxa'
+        sketch.create_reference_sketch(taxa_dir)
+        sketch.append_sketches(taxa_dir, ['b1', 'b2'], 'taxon_b', sketches[1:])
+        sketch.create_reference_sketch(self.sketch_dir)
+        sketch.append_sketches(self.sketch_dir, ['a1'], 'taxon_a', sketches[:1])
+        try:
+            first_row = sketch.append_reference_sketch(self.sketch_dir, taxa_dir)
+        finally:
+            shutil.rmtree(taxa_dir)
+
+        reference = sketch.ReferenceSketch(self.sketch_dir)
+        assert first_row == 1
+        assert list(reference.names) == ['a1', 'b1', 'b2']
+        assert list(reference.taxa) == ['taxon_a', 'taxon_b', 'taxon_b']
+        for row, hashes in enumerate(sketches):
+            assert np.array_equal(reference.row_sketch(row), hashes)
+
+    def test_append_added_rows(self):
+        rng = np.random.default_rng(3)
+        sketches = [np.unique(rng.integers(0, 2**63, 100 + i, dtype=np.uint64))
+                    for i in range(3)]
+        taxa_dir = self.sketch_dir + '_taxa'
+        sketch.create_reference_sketch(taxa_dir)
+        sketch.append_sketches(taxa_dir, ['a1', 'a2'], 'taxon_a', sketches[:2])
+        sketch.create_reference_sketch(self.sketch_dir)
+        try:
+            sketch.append_reference_sketch(self.sketch_dir, taxa_dir)
+            sketch.build_representatives(taxa_dir, 1, n_representatives=1)
+            representatives = sketch.ReferenceSketch(taxa_dir).representatives
+            # a genome added to the taxa after it was copied
+            sketch.append_sketches(taxa_dir, ['a3'], 'taxon_a', sketches[2:])
+            sketch.extend_representatives(taxa_dir, representatives, [2])
+            sketch.append_reference_sketch(self.sketch_dir, taxa_dir,
+                                           first_source_row=2)
+            taxa_sketch = sketch.ReferenceSketch(taxa_dir)
+        finally:
+            shutil.rmtree(taxa_dir)
+
+        reference = sketch.ReferenceSketch(self.sketch_dir)
+        assert list(reference.names) == ['a1', 'a2', 'a3']
+        assert np.array_equal(reference.row_sketch(2), sketches[2])
+        assert list(taxa_sketch.representatives['row']) == \
+                list(representatives['row'])
+        assert taxa_sketch.representatives['radius'].max() == 1
+
+    def test_collapsed_search(self):
+        rng = np.random.default_rng(4)
+        bases = [np.unique(rng.integers(0, 2**63, 1000, dtype=np.uint64))
+                 for _ in range(5)]
+        query = np.unique(np.concatenate([bases[0][:900],
+                          rng.integers(0, 2**63, 100, dtype=np.uint64)]))
+        sketches = []
+        for base in bases:
+            # near-duplicates of each genome differing by a few hashes
+            for i in range(4):
+                duplicate = base.copy()
+                duplicate[:i] = rng.integers(0, 2**63, i, dtype=np.uint64)
+                sketches.append(np.unique(duplicate))
+        sketch.create_reference_sketch(self.sketch_dir)
+        sketch.append_sketches(self.sketch_dir,
+                               [f"g{i}" for i in range(len(sketches))], 'toy',
+                               sketches)
+        sketch.cluster_sketches(self.sketch_dir, 0.001, 2)
+
+        reference = sketch.ReferenceSketch(self.sketch_dir)
+        assert list(reference.leaders) == [row - row % 4
+                                           for row in range(len(sketches))]
+        assert sorted(reference.cluster_members()) == [0, 4, 8, 12, 16]
+        for top_k in [1, 3, 10]:
+            assert reference.search_leaders([query], 1, top_k, 2) == \
+                    reference.search_many([query], 1, top_k, 2)
+
+    def test_containment_search(self):
+        rng = np.random.default_rng(5)
+        genomes = [rng.choice(list(b'ACGT'), 50000).astype(np.uint8).tobytes()
+                   for _ in range(3)]
+        sketches = [sketch.sketch_sequences([('g', g)]) for g in genomes]
+        # plasmid-sized fragment of the second genome
+        query = sketch.sketch_sequences([('q', genomes[1][20000:25000])])
+        sketch.create_reference_sketch(self.sketch_dir)
+        sketch.append_sketches(self.sketch_dir, ['g0', 'g1', 'g2'], 'toy',
+                               sketches)
+        reference = sketch.ReferenceSketch(self.sketch_dir)
+
+        assert reference.search(query, 0.01, 3, 1) == []
+        hits = reference.search(query, 0.01, 3, 2, metric='containment')
+        assert hits == [(0.0, 1)]
+        distances, shared = sketch.containment_distances(
+                query, np.array(reference.hashes), reference.counts,
+                1000, 21)
+        assert shared[1] > 0 and list(shared[[0, 2]]) == [0, 0]
+
+    @classmethod
+    def teardown_class(cls):
+        if os.path.exists(cls.sketch_dir):
+            shutil.rmtree(cls.sketch_dir)